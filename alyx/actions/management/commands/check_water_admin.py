@@ -1,6 +1,8 @@
 from django.core.management import BaseCommand
-from actions.models import WaterRestriction
-from actions.notifications import check_water_administration, check_weighed
+from django.utils import timezone
+
+from actions.models import WaterRestriction, WaterStatus, create_notifications
+from actions.notifications import water_administration_notification, weighed_notification
 
 
 class Command(BaseCommand):
@@ -10,12 +12,20 @@ class Command(BaseCommand):
         pass
 
     def handle(self, *args, **options):
-        wrs = WaterRestriction.objects.select_related('subject'). \
+        wrs = WaterRestriction.objects.select_related(
+            'subject', 'subject__lab', 'subject__responsible_user'). \
             filter(
                 subject__death_date__isnull=True,
                 start_time__isnull=False,
                 end_time__isnull=True). \
             order_by('subject__responsible_user__username', 'subject__nickname')
-        for wr in wrs:
-            check_water_administration(wr.subject)
-            check_weighed(wr.subject)
+        subjects = list({wr.subject_id: wr.subject for wr in wrs}.values())
+        # The statuses that are not current are recomputed together
+        statuses = WaterStatus.for_subjects(subjects)
+        date = timezone.now()
+        notifications = []
+        for subject in subjects:
+            status = statuses[subject.pk]
+            notifications.append(water_administration_notification(subject, status, date))
+            notifications.append(weighed_notification(subject, status, date))
+        create_notifications([n for n in notifications if n])
@@ -0,0 +1,25 @@
+from django.core.management import BaseCommand
+from actions.models import WaterStatus
+from subjects.models import Subject
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = "Recompute the water status of all the alive subjects."
+
+    def add_arguments(self, parser):
+        parser.add_argument('nicknames', nargs='*',
+                            help='Nicknames of the subjects to update, defaults to all the alive '
+                                 'subjects')
+
+    def handle(self, *args, **options):
+        subjects = Subject.objects.select_related('lab').order_by('nickname')
+        if options['nicknames']:
+            subjects = subjects.filter(nickname__in=options['nicknames'])
+        else:
+            subjects = subjects.filter(cull__isnull=True, death_date__isnull=True)
+        subjects = list(subjects)
+        for i in range(0, len(subjects), BATCH_SIZE):
+            WaterStatus.update_many(subjects[i:i + BATCH_SIZE])
+        self.stdout.write('Updated the water status of %d subjects.' % len(subjects))
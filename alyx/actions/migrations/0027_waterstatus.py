@@ -0,0 +1,41 @@
+# Generated by Django 4.2.18 on 2026-10-17 09:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subjects', '0013_remove_subject_implant_weight'),
+        ('actions', '0026_alter_surgery_implant_weight'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WaterStatus',
+            fields=[
+                ('subject', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='water_status', serialize=False, to='subjects.subject')),
+                ('date', models.DateField(help_text='Day of the status, in the timezone of the subject')),
+                ('is_water_restricted', models.BooleanField(default=False)),
+                ('water_restriction_start', models.DateTimeField(blank=True, help_text='Start of the current water restriction', null=True)),
+                ('weight', models.FloatField(help_text='Last weight in grams, 0 if never weighed')),
+                ('last_weighing', models.DateTimeField(blank=True, null=True)),
+                ('implant_weight', models.FloatField(default=0)),
+                ('reference_weight', models.FloatField(default=0)),
+                ('expected_weight', models.FloatField(default=0)),
+                ('percentage_weight', models.FloatField(default=0, help_text='Weight relative to the expected weight, 0 if not available')),
+                ('min_percentage', models.FloatField(default=0)),
+                ('weight_status', models.SmallIntegerField(default=0, help_text='0: OK, 1: close to the weight threshold, 2: under it')),
+                ('expected_water', models.FloatField(default=0, help_text='Water required in milliliters')),
+                ('given_water_total', models.FloatField(default=0, help_text='Water given in milliliters')),
+                ('remaining_water', models.FloatField(default=0)),
+                ('last_water_administration', models.DateTimeField(blank=True, null=True)),
+                ('last_water_administered', models.FloatField(blank=True, null=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'water statuses',
+            },
+        ),
+    ]
@@ -1,12 +1,17 @@
+from collections import defaultdict
 from datetime import timedelta
+import hashlib
 from math import inf
 
 import structlog
 from one.alf.spec import QC
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.validators import MinValueValidator
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 
 from alyx.base import BaseModel, modify_fields, alyx_mail, BaseManager
@@ -360,6 +365,242 @@ class OtherAction(BaseAction):
     pass
 
 
+# Training days
+# ---------------------------------------------------------------------------------
+
+TRAINING_DAYS_CACHE_TIMEOUT = 30 * 24 * 3600
+
+
+def training_session_dates(start_date, end_date):
+    """The session dates of the subjects currently under water restriction.
+
+    The sessions of all the subjects are grouped by subject and date in a single query, whose
+    result is cached and keyed on the number and last modification time of the sessions, so
+    that past weeks are computed only once.
+
+    Returns
+    -------
+    list of (WaterRestriction, list of datetime.date)
+        The current water restrictions, ordered by responsible user and subject nickname, with
+        the sorted dates of the sessions of their subject from `start_date` (inclusive) to
+        `end_date` (exclusive).
+    """
+    wrs = list(WaterRestriction.objects.filter(
+        start_time__isnull=False, end_time__isnull=True,
+    ).select_related('subject', 'subject__responsible_user').order_by(
+        'subject__responsible_user__username', 'subject__nickname'))
+    subject_ids = sorted({wr.subject_id for wr in wrs})
+    sessions = Session.objects.filter(
+        subject__in=subject_ids, start_time__gte=start_date, start_time__lt=end_date)
+    latest = sessions.aggregate(n=models.Count('pk'), last=models.Max('auto_datetime'))
+    digest = hashlib.md5(repr(
+        (start_date, end_date, subject_ids, latest['n'], latest['last'])).encode()).hexdigest()
+    key = 'training-days:%s' % digest
+    dates = cache.get(key)
+    if dates is None:
+        dates = defaultdict(list)
+        for subject_id, date in sessions.values_list('subject_id', 'start_time__date'). \
+                distinct().order_by('subject_id', 'start_time__date'):
+            dates[subject_id].append(date)
+        dates = dict(dates)
+        cache.set(key, dates, TRAINING_DAYS_CACHE_TIMEOUT)
+    return [(wr, dates.get(wr.subject_id, [])) for wr in wrs]
+
+
+# Water status
+# ---------------------------------------------------------------------------------
+
+class WaterStatus(models.Model):
+    """
+    The water and weight status of a subject on a given day, as computed by its water control.
+
+    This is updated whenever a weighing, water administration, water restriction or surgery of
+    the subject is saved, and recomputed when read on a later day (see `for_subjects`) or with
+    the `update_water_status` command.  It is discarded when the sex, birth date or lab of the
+    subject change, or when the weight settings or timezone of its lab change.
+
+    Bulk writes (`QuerySet.update`, `bulk_create`) of these models don't send any signal: the
+    statuses of the subjects concerned must then be discarded with `invalidate`.
+    """
+    subject = models.OneToOneField('subjects.Subject', primary_key=True,
+                                   on_delete=models.CASCADE, related_name='water_status')
+    date = models.DateField(help_text="Day of the status, in the timezone of the subject")
+    is_water_restricted = models.BooleanField(default=False)
+    water_restriction_start = models.DateTimeField(
+        null=True, blank=True, help_text="Start of the current water restriction")
+    weight = models.FloatField(help_text="Last weight in grams, 0 if never weighed")
+    last_weighing = models.DateTimeField(null=True, blank=True)
+    implant_weight = models.FloatField(default=0)
+    reference_weight = models.FloatField(default=0)
+    expected_weight = models.FloatField(default=0)
+    percentage_weight = models.FloatField(
+        default=0, help_text="Weight relative to the expected weight, 0 if not available")
+    min_percentage = models.FloatField(default=0)
+    weight_status = models.SmallIntegerField(
+        default=0, help_text="0: OK, 1: close to the weight threshold, 2: under it")
+    expected_water = models.FloatField(default=0, help_text="Water required in milliliters")
+    given_water_total = models.FloatField(default=0, help_text="Water given in milliliters")
+    remaining_water = models.FloatField(default=0)
+    last_water_administration = models.DateTimeField(null=True, blank=True)
+    last_water_administered = models.FloatField(null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = "water statuses"
+
+    def __str__(self):
+        return 'Water status of %s on %s' % (self.subject, self.date)
+
+    @staticmethod
+    def fields_from_water_control(wc, date=None):
+        """Return the field values of the status of a WaterControl instance at a given date,
+        by default today."""
+        date = date or wc.today()
+        last_weighing = wc.last_weighing_before(date=date)
+        last_wa = wc.last_water_administration_at(date=date)
+        return {
+            'date': date.date(),
+            'is_water_restricted': wc.is_water_restricted(date=date),
+            'water_restriction_start': wc.water_restriction_at(date=date),
+            'weight': wc.weight(date=date),
+            'last_weighing': last_weighing[0] if last_weighing else None,
+            'implant_weight': wc.implant_weight(date=date) or 0.,
+            'reference_weight': wc.reference_weight(date=date),
+            'expected_weight': wc.expected_weight(date=date),
+            'percentage_weight': wc.percentage_weight(date=date),
+            'min_percentage': wc.min_percentage(date=date),
+            'weight_status': wc.weight_status(date=date),
+            'expected_water': wc.expected_water(date=date),
+            'given_water_total': wc.given_water_total(date=date),
+            'remaining_water': wc.remaining_water(date=date),
+            'last_water_administration': last_wa[0] if last_wa else None,
+            'last_water_administered': last_wa[1] if last_wa else None,
+        }
+
+    @staticmethod
+    def _today(subject):
+        from actions.water_control import today, tzone_convert
+        return tzone_convert(today(), subject.timezone()).date()
+
+    @classmethod
+    def update(cls, subject):
+        """Recompute and save the status of a subject."""
+        fields = cls.fields_from_water_control(subject.reinit_water_control())
+        subject.water_status, _ = cls.objects.update_or_create(subject=subject, defaults=fields)
+        return subject.water_status
+
+    @classmethod
+    def update_many(cls, subjects):
+        """Recompute and save the status of several subjects, returned keyed by subject id."""
+        from actions.water_control import water_control_bulk
+        subjects = list(subjects)
+        wcs = water_control_bulk(subjects)
+        for s in subjects:
+            s.water_status = cls(subject=s, **cls.fields_from_water_control(wcs[s.id]))
+        fields = [f.name for f in cls._meta.concrete_fields if not f.primary_key]
+        cls.objects.bulk_create([s.water_status for s in subjects], update_conflicts=True,
+                                unique_fields=['subject'], update_fields=fields)
+        return {s.id: s.water_status for s in subjects}
+
+    @classmethod
+    def invalidate(cls, subjects):
+        """Discard the status of several subjects, it is recomputed when next read."""
+        cls.objects.filter(subject__in=subjects).delete()
+
+    @classmethod
+    def for_subjects(cls, subjects):
+        """Return the current status of several subjects, keyed by subject id.
+
+        Statuses that are missing or were computed on a previous day are recomputed.  The
+        statuses selected along with the subjects are used rather than queried again.
+        """
+        subjects = list(subjects)
+        rel = cls._meta.get_field('subject').remote_field
+        selected = {s.id: rel.get_cached_value(s) for s in subjects if rel.is_cached(s)}
+        statuses = {k: st for k, st in selected.items() if st is not None}
+        if to_query := [s for s in subjects if s.id not in selected]:
+            statuses.update(
+                {st.subject_id: st for st in cls.objects.filter(subject__in=to_query)})
+        stale = [s for s in subjects
+                 if s.id not in statuses or statuses[s.id].date != cls._today(s)]
+        if stale:
+            statuses.update(cls.update_many(stale))
+        return statuses
+
+    @classmethod
+    def for_subject(cls, subject):
+        """Return the current status of a subject.
+
+        The status selected along with the subject is used if it is current.
+        """
+        try:
+            status = subject.water_status
+        except cls.DoesNotExist:
+            status = None
+        if status is None or status.date != cls._today(subject):
+            status = cls.update(subject)
+        return status
+
+    def percentage_weight_html(self):
+        from actions.water_control import percentage_weight_html
+        return percentage_weight_html(
+            self.subject_id, self.percentage_weight, self.weight_status,
+            self.is_water_restricted)
+
+
+@receiver(post_save, sender=Weighing)
+@receiver(post_save, sender=WaterAdministration)
+@receiver(post_save, sender=WaterRestriction)
+@receiver(post_save, sender=Surgery)
+def update_water_status(sender, instance=None, raw=False, **kwargs):
+    """Update the water status of the subject of a weighing, water administration, etc."""
+    if raw or not instance or not instance.subject_id:
+        return
+    WaterStatus.update(instance.subject)
+
+
+@receiver(post_delete, sender=Weighing)
+@receiver(post_delete, sender=WaterAdministration)
+@receiver(post_delete, sender=WaterRestriction)
+@receiver(post_delete, sender=Surgery)
+def invalidate_water_status(sender, instance=None, **kwargs):
+    """Discard the water status of the subject, it is recomputed when next read.
+
+    It is not recomputed here as the subject may be being deleted."""
+    if instance and instance.subject_id:
+        WaterStatus.objects.filter(subject_id=instance.subject_id).delete()
+
+
+# Fields of the subject and of its lab the water status depends on
+WATER_STATUS_SUBJECT_FIELDS = ('sex', 'birth_date', 'lab')
+WATER_STATUS_LAB_FIELDS = ('timezone', 'reference_weight_pct', 'zscore_weight_pct')
+
+
+@receiver(post_save, sender='subjects.Subject')
+def invalidate_subject_water_status(sender, instance=None, created=False, raw=False, **kwargs):
+    """Discard the water status of a subject whose sex, birth date or lab changed."""
+    from subjects.models import _has_field_changed, init_old_fields
+    if raw or created:
+        return
+    if any(_has_field_changed(instance, field) for field in WATER_STATUS_SUBJECT_FIELDS):
+        WaterStatus.objects.filter(subject=instance).delete()
+        init_old_fields(instance, WATER_STATUS_SUBJECT_FIELDS)
+
+
+@receiver(post_save, sender=Lab)
+def invalidate_lab_water_status(sender, instance=None, created=False, raw=False,
+                                update_fields=None, **kwargs):
+    """Discard the water statuses of the subjects of a lab, e.g. if its weight settings changed.
+
+    The subjects without a lab are included as they use the lab when it is the only one."""
+    if raw or created:
+        return
+    if update_fields and not set(update_fields) & set(WATER_STATUS_LAB_FIELDS):
+        return
+    WaterStatus.objects.filter(
+        models.Q(subject__lab=instance) | models.Q(subject__lab__isnull=True)).delete()
+
+
 # Notifications
 # ---------------------------------------------------------------------------------
 
@@ -409,8 +650,11 @@ def check_scope(user, subject, scope):
         return False
 
 
-def get_recipients(notification_type, subject=None, users=None):
-    """Return the list of users that will receive a notification."""
+def get_recipients(notification_type, subject=None, users=None, members=None, rules=None):
+    """Return the list of users that will receive a notification.
+
+    The lab members and the notification rules of that type are queried unless passed.
+    """
     # Default: initial list of recipients is the subject's responsible user.
     if users is None and subject and subject.responsible_user:
         users = [subject.responsible_user]
@@ -418,8 +662,10 @@ def get_recipients(notification_type, subject=None, users=None):
         users = []
     if not subject:
         return users
-    members = LabMember.objects.all()
-    rules = NotificationRule.objects.filter(notification_type=notification_type)
+    if members is None:
+        members = LabMember.objects.all()
+    if rules is None:
+        rules = NotificationRule.objects.filter(notification_type=notification_type)
     # Dictionary giving the scope of every user in the database.
     user_rules = {user: None for user in members}
     user_rules.update({rule.user: rule.subjects_scope for rule in rules})
@@ -455,6 +701,73 @@ def create_notification(
     return notif
 
 
+def create_notifications(notifications):
+    """Create several notifications at once.
+
+    This is equivalent to calling `create_notification` for each of them, but the previous
+    notifications, lab members and notification rules are queried once and the notifications
+    are inserted in bulk.
+
+    Parameters
+    ----------
+    notifications : list of dict
+        The keyword arguments of `create_notification` for each notification.
+
+    Returns
+    -------
+    list of Notification
+        The notifications created, i.e. excluding those sent too recently.
+    """
+    if not notifications:
+        return []
+    types = {n['notification_type'] for n in notifications}
+    # Date of the last notification with the same type, title and subject.
+    last_sent = {}
+    previous = Notification.objects.filter(
+        notification_type__in=types,
+        title__in={n['message'] for n in notifications},
+        subject__in={n['subject'] for n in notifications if n.get('subject')},
+    ).exclude(status='no-send').order_by('send_at')
+    for t, title, subject_id, sent_at, send_at in previous.values_list(
+            'notification_type', 'title', 'subject', 'sent_at', 'send_at'):
+        last_sent[t, title, subject_id] = sent_at or send_at
+    members = list(LabMember.objects.all())
+    rules = {t: [] for t in types}
+    for rule in NotificationRule.objects.filter(
+            notification_type__in=types).select_related('user'):
+        rules[rule.notification_type].append(rule)
+
+    now = timezone.now()
+    created, recipients = [], []
+    for n in notifications:
+        notification_type, message = n['notification_type'], n['message']
+        subject = n.get('subject')
+        date = last_sent.get((notification_type, message, subject.pk if subject else None))
+        delay = (now - date).total_seconds() if date else inf
+        max_delay = NOTIFICATION_MIN_DELAYS.get(notification_type, 0)
+        if not n.get('force') and delay < max_delay:
+            logger.warning(
+                "This notification was sent %d s ago (< %d s), skipping.", delay, max_delay)
+            continue
+        created.append(Notification(
+            notification_type=notification_type,
+            title=message,
+            message=message + '\n\n' + n.get('details', ''),
+            subject=subject))
+        recipients.append(get_recipients(
+            notification_type, subject=subject, users=n.get('users'),
+            members=members, rules=rules[notification_type]))
+    Notification.objects.bulk_create(created)
+    Notification.users.through.objects.bulk_create([
+        Notification.users.through(notification_id=notif.pk, labmember_id=user.pk)
+        for notif, users in zip(created, recipients) for user in users])
+    notifs = Notification.objects.filter(
+        pk__in=[notif.pk for notif in created]).prefetch_related('users')
+    for notif in notifs:
+        notif.send_if_needed()
+    return list(notifs)
+
+
 def send_pending_emails():
     """Send all pending notifications."""
     notifications = Notification.objects.filter(status='to-send', send_at__lte=timezone.now())
@@ -3,7 +3,7 @@ from textwrap import dedent
 
 from django.utils import timezone
 
-from actions.models import create_notification
+from actions.models import create_notification, WaterStatus
 
 
 logger = structlog.get_logger(__name__)
@@ -16,73 +16,69 @@ def responsible_user_changed(subject, old_user, new_user):
     create_notification('responsible_user_change', msg, subject, users=[old_user, new_user])
 
 
-def check_underweight(subject, date=None):
-    """Called when a weighing is added."""
+def _water_status(subject, date=None):
+    """Return the water status of a subject at a given date, by default its current status."""
+    if date is None:
+        return WaterStatus.for_subject(subject)
     # Reinit the water_control instance to make sure the just-added
-    # weighing is taken into account
+    # events are taken into account
     wc = subject.reinit_water_control()
-    perc = wc.percentage_weight(date=date)
-    min_perc = wc.min_percentage(date=date)
-    lwb = wc.last_weighing_before(date=date)
-    datetime = lwb[0] if lwb else None
+    return WaterStatus(subject=subject, **WaterStatus.fields_from_water_control(wc, date=date))
+
+
+def check_underweight(subject, date=None):
+    """Called when a weighing is added."""
+    # The current water status is updated when a weighing is saved
+    status = _water_status(subject, date=date)
+    perc = status.percentage_weight
+    min_perc = status.min_percentage
+    datetime = status.last_weighing
     if 0 < perc <= min_perc + 2:
         header = 'WARNING' if perc <= min_perc else 'ATTENTION'
         msg = "%s: %s weight was %.1f%% on %s" % (header, subject, perc, datetime)
         create_notification('mouse_underweight', msg, subject)
 
 
-def check_weighed(subject, date=None):
-    """Check the a subject was weighed in the last 24 hours."""
-    date = date or timezone.now()
-    # Reinit the water_control instance to make sure the just-added
-    # weighing is taken into account
-    wc = subject.reinit_water_control()
-    if not wc or not wc.is_water_restricted(date):
+def weighed_notification(subject, status, date):
+    """Return the arguments of the notification to create if a subject under water restriction
+    was not weighed on the day of the status, or None."""
+    if not status.is_water_restricted:
         return
-
-    assert hasattr(date, 'date')
-    ref_weight = wc.reference_weight(date)
-    is_restriction_day = wc.water_restriction_at(date).date() == date.date()
+    is_restriction_day = status.water_restriction_start.date() == date.date()
     # Don't notifiy if a reference weight was entered and subject
     # was put on water restriction on the same day
-    if is_restriction_day and ref_weight:
+    if is_restriction_day and status.reference_weight:
         return
 
-    lwb = wc.last_weighing_before(date=date)
     date = date.date()
-
-    datetime = lwb[0] if lwb else None
+    datetime = status.last_weighing
     if not datetime or datetime.date() != date:
         header = 'ATTENTION'
-        msg = '%s: subject "%s" weighing missing for %s' % (header, wc.nickname, date)
-        create_notification('mouse_not_weighed', msg, subject)
+        msg = '%s: subject "%s" weighing missing for %s' % (header, subject.nickname, date)
+        return {'notification_type': 'mouse_not_weighed', 'message': msg, 'subject': subject}
 
 
-def check_water_administration(subject, date=None):
-    """
-    Check the subject was administered water in the last 24 hours.
+def check_weighed(subject, date=None):
+    """Check the a subject was weighed in the last 24 hours."""
+    status = _water_status(subject, date=date)
+    notification = weighed_notification(subject, status, date or timezone.now())
+    if notification:
+        create_notification(**notification)
 
-    Creates a notification if the subject was not given required water
-    today.
 
-    Parameters
-    ----------
-    subject : subject.models.Subject
-        A subject instance.
-    date : datetime.datetime
-        The datetime to check, deafults to now.
-    """
-    date = date or timezone.now()
-    wc = subject.reinit_water_control()
-    if not wc or not wc.is_water_restricted(date):
+def water_administration_notification(subject, status, date):
+    """Return the arguments of the notification to create if a subject under water restriction
+    was not given the required water at the date of the status, or None."""
+    if not status.is_water_restricted:
         return
-    remaining = wc.remaining_water(date=date)
-    wa = wc.last_water_administration_at(date=date)
+    remaining = status.remaining_water
+    wa = ((status.last_water_administration, status.last_water_administered)
+          if status.last_water_administration else None)
     # If the subject is not on water restriction, or the restriction
     # was created on the same day, water administration is not required
-    if wc.water_restriction_at(date).date() == date.date():
+    if status.water_restriction_start.date() == date.date():
         return
-    delay = date - (wa[0] if wa else wc.current_water_restriction())
+    delay = date - (wa[0] if wa else status.water_restriction_start)
     # Notification if water needs to be given more than 23h after the last
     # water administration.
     if remaining > 0 and delay.total_seconds() >= 23 * 3600 - 10:
@@ -91,13 +87,34 @@ def check_water_administration(subject, date=None):
         Mouse: %s
         User: %s
         Date: %s
-        Last water administration: %s, %.2f mL
+        Last water administration: %s
         Remaining water: %.1f mL
         Delay: %.1f hours
         ''' % (
             subject.nickname,
             subject.responsible_user.username,
             date.strftime('%Y-%m-%d %H:%M:%S'),
-            wa[0].strftime('%Y-%m-%d %H:%M:%S'), wa[1],
+            '%s, %.2f mL' % (wa[0].strftime('%Y-%m-%d %H:%M:%S'), wa[1] or 0) if wa else 'none',
             remaining, (delay.total_seconds() / 3600)))
-        create_notification('mouse_water', msg, subject, details=details)
+        return {'notification_type': 'mouse_water', 'message': msg, 'subject': subject,
+                'details': details}
+
+
+def check_water_administration(subject, date=None):
+    """
+    Check the subject was administered water in the last 24 hours.
+
+    Creates a notification if the subject was not given required water
+    today.
+
+    Parameters
+    ----------
+    subject : subject.models.Subject
+        A subject instance.
+    date : datetime.datetime
+        The datetime to check, deafults to now.
+    """
+    status = _water_status(subject, date=date)
+    notification = water_administration_notification(subject, status, date or timezone.now())
+    if notification:
+        create_notification(**notification)
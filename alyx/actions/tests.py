@@ -1,13 +1,18 @@
 import datetime
+import io
 import numpy as np
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import TestCase
 from django.utils import timezone
 
 from alyx import base
-from actions.water_control import to_date
+from actions.water_control import (
+    to_date, to_weeks, expected_weighing_mean_std, expected_weighing_mean_std_at)
 from actions.models import (
     WaterAdministration, WaterRestriction, WaterType, Weighing,
-    Notification, NotificationRule, create_notification, Surgery, ProcedureType)
+    Notification, NotificationRule, create_notification, Surgery, ProcedureType, WaterStatus,
+    Session, training_session_dates)
 from actions.notifications import check_water_administration, check_weighed
 from misc.models import LabMember, LabMembership, Lab
 from subjects.models import Subject
@@ -113,6 +118,128 @@ class WaterControlTests(TestCase):
         wc = self.sub.reinit_water_control()
         self.assertAlmostEqual(expected + 1, wc.reference_weight())
 
+    def test_to_jsonable(self):
+        """The vectorized columns should match the scalar methods day by day."""
+        self.wr.end_time = self.start_date + datetime.timedelta(days=30)
+        self.wr.save()
+        WaterRestriction.objects.create(
+            subject=self.sub, start_time=self.start_date + datetime.timedelta(days=40))
+        WaterAdministration.objects.create(
+            water_administered=0.5, subject=self.sub, session=None,
+            date_time=self.start_date + datetime.timedelta(days=3, hours=2))
+        for lab in ('rweigh', 'zscore', 'mixed'):
+            self.sub.lab = Lab.objects.get(name=lab)
+            self.sub.save()
+            wc = self.sub.reinit_water_control()
+            end_date = self.start_date + datetime.timedelta(days=60)
+            records = wc.to_jsonable(end_date=end_date.strftime('%Y-%m-%d'))
+            self.assertEqual(61, len(records))
+            self.assertEqual(self.start_date.date(), records[0]['date'])
+            for record in records:
+                date = to_date(record['date'].strftime('%Y-%m-%d'))
+                date = date.replace(hour=self.start_date.hour)  # to_jsonable keeps the start time
+                for col in wc._columns[1:]:
+                    expected = getattr(wc, col)(date=date)
+                    self.assertEqual(expected, record[col], f'{lab} {col} {date}')
+                    self.assertIs(type(expected), type(record[col]))
+            self.assertFalse(records[35]['is_water_restricted'])
+            self.assertIsNone(records[55]['weighing_at'])
+            self.assertEqual(0.98 + 0.5, records[3]['given_water_total'])
+
+    def test_water_status(self):
+        """The water status is materialized when the water events of a subject are saved."""
+        status = WaterStatus.objects.get(subject=self.sub)
+        wc = self.sub.reinit_water_control()
+        self.assertEqual(status.date, wc.today().date())
+        self.assertTrue(status.is_water_restricted)
+        self.assertEqual(status.water_restriction_start, self.wr.start_time)
+        self.assertEqual(status.weight, wc.weight())
+        self.assertAlmostEqual(status.remaining_water, wc.remaining_water())
+        self.assertEqual(status.last_water_administered, 1.02)
+        # Saving a weighing updates the status
+        Weighing.objects.create(weight=30., subject=self.sub, date_time=datetime.datetime.now())
+        status.refresh_from_db()
+        self.assertEqual(status.weight, 30.)
+        self.assertEqual(status.percentage_weight,
+                         self.sub.reinit_water_control().percentage_weight())
+        # Changing the implant weight of a surgery updates the status
+        self.surgeries[-1].implant_weight = 5.
+        self.surgeries[-1].save()
+        self.assertEqual(WaterStatus.objects.get(subject=self.sub).implant_weight, 5.)
+        # Deleting an event discards the status, which is recomputed when read
+        self.surgeries[-1].delete()
+        self.assertFalse(WaterStatus.objects.filter(subject=self.sub).exists())
+        subject = Subject.objects.get(pk=self.sub.pk)
+        self.assertEqual(WaterStatus.for_subject(subject).implant_weight, 4.56)
+        # Statuses of previous days are recomputed when read
+        WaterStatus.objects.filter(subject=self.sub).update(
+            date=datetime.date(2020, 1, 1), weight=0.)
+        statuses = WaterStatus.for_subjects(Subject.objects.filter(pk=self.sub.pk))
+        self.assertEqual(statuses[self.sub.pk].weight, 30.)
+        self.assertEqual(WaterStatus.objects.get(subject=self.sub).date, wc.today().date())
+        # The current statuses selected along with the subjects are not queried again
+        subjects = Subject.objects.filter(pk=self.sub.pk).select_related('water_status', 'lab')
+        with self.assertNumQueries(1):
+            statuses = WaterStatus.for_subjects(subjects)
+        self.assertEqual(statuses[self.sub.pk].weight, 30.)
+        # The management command recomputes all the statuses
+        WaterStatus.objects.all().delete()
+        call_command('update_water_status', 'bigboy', stdout=io.StringIO())
+        self.assertEqual(WaterStatus.objects.get(subject=self.sub).weight, 30.)
+
+    def test_water_status_invalidation(self):
+        """The water status is discarded when the subject or its lab settings change."""
+        def exists():
+            return WaterStatus.objects.filter(subject=self.sub).exists()
+        subject = Subject.objects.get(pk=self.sub.pk)
+        subject.description = 'foo'
+        subject.save()
+        self.assertTrue(exists())
+        subject.birth_date = subject.birth_date - datetime.timedelta(days=7)
+        subject.save()
+        self.assertFalse(exists())
+        WaterStatus.for_subject(subject)
+        subject.save()  # The changes are only detected once
+        self.assertTrue(exists())
+        # Lab settings
+        self.lab.save(update_fields=['address'])
+        self.assertTrue(exists())
+        self.lab.reference_weight_pct = .8
+        self.lab.save()
+        self.assertFalse(exists())
+        # Bulk writes must discard the statuses explicitly
+        WaterStatus.for_subject(subject)
+        WaterStatus.invalidate([subject])
+        self.assertFalse(exists())
+
+    def test_training_session_dates(self):
+        cache.clear()
+        monday = datetime.datetime(2018, 10, 8)
+        for day in (0, 0, 2, 4, 7):  # two sessions on monday and one the next week
+            Session.objects.create(subject=self.sub, start_time=monday + datetime.timedelta(
+                days=day, hours=10))
+        with self.assertNumQueries(3):
+            (wr, dates), = training_session_dates(monday, monday + datetime.timedelta(days=7))
+        self.assertEqual(wr, self.wr)
+        self.assertEqual(dates, [datetime.date(2018, 10, d) for d in (8, 10, 12)])
+        # The grouped sessions are cached until a session of the week changes
+        with self.assertNumQueries(2):
+            training_session_dates(monday, monday + datetime.timedelta(days=7))
+        Session.objects.create(subject=self.sub, start_time=monday + datetime.timedelta(days=5))
+        (wr, dates), = training_session_dates(monday, monday + datetime.timedelta(days=7))
+        self.assertEqual(dates, [datetime.date(2018, 10, d) for d in (8, 10, 12, 13)])
+
+    def test_expected_weighing_mean_std_at(self):
+        birth_date = datetime.datetime(2018, 1, 1)
+        dates = [birth_date + datetime.timedelta(days=d, hours=h)
+                 for d, h in zip(range(-10, 1200, 3), range(0, 24 * 500, 5))]
+        for sex in ('M', 'F', 'U'):
+            means, stds = expected_weighing_mean_std_at(sex, birth_date, dates)
+            expected = np.array([expected_weighing_mean_std(sex, to_weeks(birth_date, d))
+                                 for d in dates])
+            np.testing.assert_array_equal(means, expected[:, 0])
+            np.testing.assert_array_equal(stds, expected[:, 1])
+
 
 class NotificationTests(TestCase):
     def setUp(self):
@@ -203,6 +330,32 @@ class NotificationTests(TestCase):
             notif = Notification.objects.last()
             self.assertTrue((notif is not None) is r)
 
+    def test_notif_water_status(self):
+        # Without a date, the current water status is checked
+        check_weighed(self.subject)
+        self.assertIn('weighing missing', Notification.objects.last().title)
+        check_water_administration(self.subject)
+        notif = Notification.objects.get(notification_type='mouse_water')
+        self.assertIn('mL remaining for test', notif.title)
+        self.assertIn('Last water administration: 2018-06-03 12:00:00, 10.00 mL', notif.message)
+
+    def test_check_water_admin(self):
+        NotificationRule.objects.create(
+            user=self.user2, notification_type='mouse_water', subjects_scope='all')
+        call_command('check_water_admin')
+        notifs = Notification.objects.filter(subject=self.subject)
+        self.assertEqual(
+            {'mouse_water', 'mouse_not_weighed'}, set(n.notification_type for n in notifs))
+        water = notifs.get(notification_type='mouse_water')
+        self.assertIn('mL remaining for test', water.title)
+        self.assertEqual({self.user1, self.user2}, set(water.users.all()))
+        weighed = notifs.get(notification_type='mouse_not_weighed')
+        self.assertEqual([self.user1], list(weighed.users.all()))
+        # Water notifications are not sent again within the hour
+        call_command('check_water_admin')
+        self.assertEqual(1, notifs.filter(notification_type='mouse_water').count())
+        self.assertEqual(2, notifs.filter(notification_type='mouse_not_weighed').count())
+
     def test_notif_water_3(self):
         # If the subject was place on water restriction on the same day
         # there should be no notification
@@ -1,4 +1,8 @@
+import json
+from unittest import mock
+
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.urls import reverse
 from django.utils.timezone import now
 from datetime import timedelta
@@ -7,7 +11,10 @@ from alyx import base
 from alyx.base import BaseTests
 from subjects.models import Subject, Project
 from misc.models import Lab, Note, ContentType
-from actions.models import Session, WaterType, WaterAdministration, Surgery, ProcedureType
+from actions.models import (
+    Session, WaterType, WaterAdministration, Surgery, ProcedureType, Weighing)
+from actions.views import SubjectHistoryListView
+from actions.water_control import water_control
 from data.models import Dataset, DatasetType
 
 
@@ -122,6 +129,97 @@ class APIActionsTests(BaseTests):
         for i in range(2, 5):
             assert d['records'][i]['weight'] > 0
 
+    def test_water_requirement_list(self):
+        self.post(reverse('weighing-create'),
+                  {'subject': self.subject.nickname, 'weight': 12.3})
+        subjects = list(Subject.objects.order_by('nickname')[:3])
+        nicknames = [s.nickname for s in subjects]
+        url = reverse('water-requirement-list')
+        self.assertEqual(self.client.get(url).status_code, 400)
+        date = now().date()
+        query = '?start_date=%s&end_date=%s' % (date - timedelta(days=2), date)
+        with self.assertNumQueries(7):
+            response = self.client.get(url + query + '&nicknames=' + ','.join(nicknames))
+            lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        records = [json.loads(line) for line in lines]
+        self.assertEqual([r['subject'] for r in records], nicknames)
+        # Each line matches the single subject endpoint
+        for record in records:
+            response = self.client.get(
+                reverse('water-requirement', kwargs={'nickname': record['subject']}) + query)
+            self.assertEqual(record, json.loads(response.content))
+        # Subjects may also be selected by lab
+        response = self.client.get(url + '?lab=' + self.subject.lab.name)
+        records = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual({r['subject'] for r in records},
+                         set(Subject.objects.filter(lab=self.subject.lab)
+                             .values_list('nickname', flat=True)))
+        # Invalid dates are rejected before streaming
+        for query in ('&start_date=2020-13-01', '&end_date=yesterday'):
+            response = self.client.get(url + '?nicknames=' + nicknames[0] + query)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('expected YYYY-MM-DD', response.json()['detail'])
+
+    def test_subject_history(self):
+        Weighing.objects.create(subject=self.subject, weight=20., date_time=now())
+        Session.objects.create(subject=self.subject, start_time=now() - timedelta(days=1),
+                               number=2, type='Base')
+        n_actions = sum(model.objects.filter(subject=self.subject).count()
+                        for model in SubjectHistoryListView.HISTORY_MODELS)
+        url = reverse('subject-history', kwargs={'subject_id': self.subject.id})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        items = response.context['object_list']
+        self.assertEqual(len(items), n_actions)
+        dates = [item['date_time'] for item in items if item['date_time']]
+        self.assertEqual(dates, sorted(dates, reverse=True))
+        self.assertEqual((items[0]['name'], items[0]['arg0']), ('Weighing', 'weight: 20.0'))
+        session = next(item for item in items if item['name'] == 'Session')
+        self.assertEqual((session['type'], session['arg0']), ('Base', 'number: 2'))
+        # The history is paginated in the database
+        with mock.patch.object(SubjectHistoryListView, 'paginate_by', 2):
+            response = self.client.get(url + '?page=2')
+        self.assertEqual(response.context['paginator'].count, n_actions)
+        self.assertEqual([item['name'] for item in response.context['object_list']],
+                         [item['name'] for item in items[2:4]])
+
+    def test_weighing_plot(self):
+        url = reverse('weighing-plot', kwargs={'subject_id': self.subject.id})
+        Weighing.objects.create(subject=self.subject, weight=20., date_time=now())
+        cache.clear()
+        with mock.patch('actions.views.water_control', wraps=water_control) as wc:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'image/png')
+            etag = response['ETag']
+            # The plot is rendered once and then served from the cache
+            self.assertEqual(self.client.get(url).content, response.content)
+            wc.assert_called_once()
+        # Conditional requests
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # The plot changes with the weighings
+        Weighing.objects.create(subject=self.subject, weight=21., date_time=now())
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        # Data for drawing the plot client-side
+        response = self.client.get(url, data={'format': 'json'})
+        self.assertEqual(response['Content-Type'], 'application/json')
+        d = response.json()
+        self.assertEqual(d['weights'][-2:], [20., 21.])
+        self.assertEqual(len(d['dates']), len(d['expected_weight']))
+        self.assertTrue(d['thresholds'])
+        # The plot changes with the nickname of the subject
+        etag = response['ETag']
+        self.subject.nickname = 'renamed'
+        self.subject.save()
+        response = self.client.get(url, data={'format': 'json'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['nickname'], 'renamed')
+
     def test_extended_qc_filters(self):
         extended_qc = [
             {'tutu_bool': True, 'tata_pct': 0.3},
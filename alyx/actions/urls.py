@@ -49,6 +49,9 @@ urlpatterns = [
     path('water-administrations/<uuid:pk>', av.WaterAdministrationAPIDetail.as_view(),
          name="water-administration-detail"),
 
+    path('water-requirement', av.WaterRequirementList.as_view(),
+         name='water-requirement-list'),
+
     path('water-requirement/<str:nickname>', av.WaterRequirement.as_view(),
          name='water-requirement'),
 
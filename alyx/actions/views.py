@@ -1,13 +1,20 @@
+from collections import defaultdict
 from datetime import timedelta, date, datetime
-from operator import itemgetter
+import hashlib
+import json
 
 from one.alf.spec import QC
+from django.conf import settings
 from django.contrib.postgres.fields import JSONField
-from django.db.models import Count, Q, F, ExpressionWrapper, FloatField
-from django.db.models.deletion import Collector
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import (
+    CharField, Count, Q, F, ExpressionWrapper, FloatField, Value)
 from django_filters.rest_framework.filters import CharFilter
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from django.utils.safestring import mark_safe
 from django.views.generic.list import ListView
 
@@ -19,10 +26,10 @@ from rest_framework.views import APIView
 from alyx.base import base_json_filter, BaseFilterSet, rest_permission_classes
 from subjects.models import Subject
 from experiments.views import _filter_qs_with_brain_regions
-from .water_control import water_control, to_date
+from .water_control import water_control, water_control_bulk, to_date
 from .models import (
-    BaseAction, Session, WaterAdministration, WaterRestriction,
-    Weighing, WaterType, LabLocation, Surgery, ProcedureType)
+    Session, WaterAdministration, WaterRestriction, Weighing, WaterType, LabLocation, Surgery,
+    ProcedureType, VirusInjection, ChronicRecording, OtherAction, training_session_dates)
 from .serializers import (LabLocationSerializer,
                           ProcedureTypeSerializer,
                           SessionListSerializer,
@@ -34,6 +41,9 @@ from .serializers import (LabLocationSerializer,
                           WaterRestrictionListSerializer,
                           )
 
+# Rendered weighing plots are keyed by their content so they never need invalidating
+WEIGHING_PLOT_CACHE_TIMEOUT = 7 * 24 * 3600
+
 
 class BaseActionFilter(BaseFilterSet):
     subject = django_filters.CharFilter(field_name='subject__nickname', lookup_expr=('iexact'))
@@ -74,6 +84,10 @@ class BaseActionFilter(BaseFilterSet):
 
 class SubjectHistoryListView(ListView):
     template_name = 'subject_history.html'
+    paginate_by = 500
+
+    HISTORY_MODELS = (Session, Weighing, WaterRestriction, Surgery, VirusInjection,
+                      ChronicRecording, OtherAction)
 
     CLASS_FIELDS = {
         'Session': ('number', 'n_correct_trials', 'n_trials'),
@@ -98,24 +112,49 @@ class SubjectHistoryListView(ListView):
         return context
 
     def get_queryset(self):
-        subject = Subject.objects.get(pk=self.kwargs['subject_id'])
-        collector = Collector(using="default")
-        collector.collect([subject])
+        """The id, time and class name of all the actions of the subject, newest first.
+
+        The action tables are combined in a single UNION query, so that only the rows of the
+        current page are loaded.
+        """
+        querysets = [
+            model.objects.filter(subject=self.kwargs['subject_id']).annotate(
+                action_time=F('date_time' if model is Weighing else 'start_time'),
+                action_class=Value(model.__name__, output_field=CharField()),
+            ).values_list('pk', 'action_time', 'action_class')
+            for model in self.HISTORY_MODELS]
+        return querysets[0].union(*querysets[1:], all=True).order_by('-action_time')
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator, page, object_list, is_paginated = super(
+            SubjectHistoryListView, self).paginate_queryset(queryset, page_size)
+        return paginator, page, self._history_items(object_list), is_paginated
+
+    def _history_items(self, rows):
+        """Load the fields shown for the actions of a page, with one query per class."""
+        rows = list(rows)
+        models = {model.__name__: model for model in self.HISTORY_MODELS}
+        pks = defaultdict(list)
+        for pk, _, clsname in rows:
+            pks[clsname].append(pk)
+        instances = {}
+        for clsname, model_pks in pks.items():
+            model = models[clsname]
+            qs = model.objects.filter(pk__in=model_pks)
+            type_field = self.CLASS_TYPE_FIELD.get(clsname)
+            if type_field and model._meta.get_field(type_field).is_relation:
+                qs = qs.select_related(type_field)
+            qs = qs.only(*self.CLASS_FIELDS.get(clsname, ()), *filter(None, [type_field]))
+            instances.update((obj.pk, obj) for obj in qs)
         out = []
-        for model, instance in collector.instances_with_model():
-            if model._meta.app_label == 'data':
-                continue
-            if not isinstance(instance, BaseAction):
-                continue
-            url = reverse('admin:%s_%s_change' % (instance._meta.app_label,
-                                                  instance._meta.model_name), args=[instance.id])
+        for pk, date_time, clsname in rows:
+            instance = instances[pk]
             item = {}
-            clsname = instance.__class__.__name__
-            item['url'] = url
-            item['name'] = model.__name__
-            item['type'] = getattr(
-                instance, self.CLASS_TYPE_FIELD.get(clsname, ''), None)
-            item['date_time'] = instance.start_time
+            item['url'] = reverse('admin:%s_%s_change' % (
+                instance._meta.app_label, instance._meta.model_name), args=[pk])
+            item['name'] = clsname
+            item['type'] = getattr(instance, self.CLASS_TYPE_FIELD.get(clsname, ''), None)
+            item['date_time'] = date_time
             i = 0
             for n in self.CLASS_FIELDS.get(clsname, ()):
                 v = getattr(instance, n, None)
@@ -124,7 +163,6 @@ class SubjectHistoryListView(ListView):
                 item['arg%d' % i] = '%s: %s' % (n, v)
                 i += 1
             out.append(item)
-        out = sorted(out, key=itemgetter('date_time'), reverse=True)
         return out
 
 
@@ -163,16 +201,9 @@ def last_monday(reqdate=None):
 
 def training_days(reqdate=None):
     monday = last_monday(reqdate=reqdate)
-    wr = WaterRestriction.objects.filter(
-        start_time__isnull=False, end_time__isnull=True,
-    ).order_by('subject__responsible_user__username', 'subject__nickname')
     next_monday = monday + timedelta(days=7)
-    for w in wr:
-        sessions = Session.objects.filter(
-            subject=w.subject, start_time__gte=monday, start_time__lt=next_monday)
-        dates = sorted(set([_[0] for _ in sessions.order_by('start_time').
-                            values_list('start_time')]))
-        wds = set(date.weekday() for date in dates)
+    for w, dates in training_session_dates(monday, next_monday):
+        wds = set(d.weekday() for d in dates)
         yield {
             'nickname': w.subject.nickname,
             'username': w.subject.responsible_user.username,
@@ -207,13 +238,53 @@ class TrainingListView(ListView):
         yield from training_days(reqdate=self.monday)
 
 
+def _weighing_plot_digest(subject):
+    """Hash of the subject's data that the weighing plot depends on."""
+    lab = subject.lab
+    values = (
+        subject.nickname, subject.birth_date, subject.sex, str(subject.timezone()),
+        settings.WEIGHT_THRESHOLD,
+        lab.reference_weight_pct if lab else None, lab.zscore_weight_pct if lab else None,
+        list(subject.weighings.order_by('date_time', 'pk').values_list('date_time', 'weight')),
+        list(subject.actions_waterrestrictions.order_by('start_time', 'pk').values_list(
+            'start_time', 'end_time', 'reference_weight')),
+        list(subject.actions_surgerys.order_by('start_time', 'pk').values_list(
+            'start_time', 'implant_weight')),
+    )
+    return hashlib.md5(repr(values).encode()).hexdigest()
+
+
 def weighing_plot(request, subject_id=None):
+    """The weighing plot of a subject as a PNG image, or its data with `?format=json`.
+
+    Rendered plots are cached, keyed by a hash of the nickname, weighings, water restrictions
+    and implant weights of the subject, which is also the ETag of the response.
+    """
     if not request.user.is_authenticated:
         return HttpResponse('')
     if subject_id in (None, 'None'):
         return HttpResponse('')
-    wc = water_control(Subject.objects.get(pk=subject_id))
-    return wc.plot()
+    subject = Subject.objects.select_related('lab').get(pk=subject_id)
+    fmt = 'json' if request.GET.get('format') == 'json' else 'png'
+    digest = _weighing_plot_digest(subject)
+    etag = quote_etag(f'{digest}-{fmt}')
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        key = f'weighing-plot:{subject.pk}:{fmt}:{digest}'
+        content = cache.get(key)
+        if content is None:
+            wc = water_control(subject)
+            if fmt == 'json':
+                content = json.dumps(wc.plot_data(), cls=DjangoJSONEncoder)
+            else:
+                content = wc.plot().content
+            cache.set(key, content, WEIGHING_PLOT_CACHE_TIMEOUT)
+        content_type = 'application/json' if fmt == 'json' else 'image/png'
+        response = HttpResponse(content, content_type=content_type)
+    response['ETag'] = etag
+    # Let browsers keep the plot but revalidate it on each page load
+    response['Cache-Control'] = 'private, no-cache'
+    return response
 
 
 class ProcedureTypeList(generics.ListCreateAPIView):
@@ -448,6 +519,16 @@ class WaterAdministrationAPIDetail(generics.RetrieveUpdateDestroyAPIView):
     queryset = WaterAdministration.objects.all()
 
 
+def _water_requirement(subject, wc, start_date=None, end_date=None):
+    records = wc.to_jsonable(start_date=start_date, end_date=end_date)
+    date_str = datetime.strptime(start_date, '%Y-%m-%d') if start_date else None
+    ref_iw = wc.reference_implant_weight_at(date_str)
+    return {'subject': subject.nickname, 'implant_weight': ref_iw,
+            'reference_weight_pct': wc.reference_weight_pct,
+            'zscore_weight_pct': wc.zscore_weight_pct,
+            'records': records}
+
+
 class WaterRequirement(APIView):
     permission_classes = rest_permission_classes()
 
@@ -456,14 +537,49 @@ class WaterRequirement(APIView):
         start_date = request.query_params.get('start_date', None)
         end_date = request.query_params.get('end_date', None)
         subject = Subject.objects.get(nickname=nickname)
-        records = subject.water_control.to_jsonable(start_date=start_date, end_date=end_date)
-        date_str = datetime.strptime(start_date, '%Y-%m-%d') if start_date else None
-        ref_iw = subject.water_control.reference_implant_weight_at(date_str)
-        data = {'subject': nickname, 'implant_weight': ref_iw,
-                'reference_weight_pct': subject.water_control.reference_weight_pct,
-                'zscore_weight_pct': subject.water_control.zscore_weight_pct,
-                'records': records}
-        return Response(data)
+        return Response(_water_requirement(subject, subject.water_control, start_date, end_date))
+
+
+class WaterRequirementList(APIView):
+    """
+    Streams the water requirements of many subjects as JSON lines, one subject per line in the
+    format of `/water-requirement/<nickname>`.
+    The subjects are selected with `nicknames` (comma-separated), `lab` and/or
+    `responsible_user`, and the records are restricted with `start_date` and `end_date`.
+    """
+    permission_classes = rest_permission_classes()
+
+    def get(self, request, format=None):
+        params = request.query_params
+        subjects = Subject.objects.select_related('lab').order_by('nickname')
+        if not any(params.get(k) for k in ('nicknames', 'lab', 'responsible_user')):
+            return Response(
+                {'detail': 'Specify the subjects with nicknames, lab or responsible_user.'},
+                status=400)
+        if params.get('nicknames'):
+            subjects = subjects.filter(nickname__in=params['nicknames'].split(','))
+        if params.get('lab'):
+            subjects = subjects.filter(lab__name=params['lab'])
+        if params.get('responsible_user'):
+            subjects = subjects.filter(responsible_user__username=params['responsible_user'])
+        start_date = params.get('start_date', None)
+        end_date = params.get('end_date', None)
+        # The errors raised once the response is streaming would truncate it
+        for name, value in (('start_date', start_date), ('end_date', end_date)):
+            try:
+                to_date(value or None)
+            except ValueError:
+                return Response(
+                    {'detail': f'Invalid {name} "{value}", expected YYYY-MM-DD.'}, status=400)
+        subjects = list(subjects)
+        wcs = water_control_bulk(subjects)
+
+        def _iter_lines():
+            for subject in subjects:
+                data = _water_requirement(subject, wcs[subject.id], start_date, end_date)
+                yield json.dumps(data, cls=DjangoJSONEncoder) + '\n'
+
+        return StreamingHttpResponse(_iter_lines(), content_type='application/x-ndjson')
 
 
 class WaterRestrictionFilter(BaseActionFilter):
@@ -1,5 +1,6 @@
 # TODO: only work with datetimes
 import csv
+from collections import defaultdict
 from datetime import datetime, date, timedelta
 from dateutil.rrule import HOURLY
 import functools
@@ -76,6 +77,31 @@ def expected_weighing_mean_std(sex, age_w):
         return d[age_w]
 
 
+def _reference_curves(sex):
+    """Expected weight mean and std for each day of age, from the weekly reference table."""
+    d = _get_table(sex)
+    age_w = np.clip(np.arange((max(d) + 1) * 7) // 7, min(d), max(d))
+    means, stds = np.array([d[age] for age in age_w.tolist()], dtype=np.float64).T
+    return means, stds
+
+
+# Daily reference curves, indexed by the age in days.
+REFERENCE_CURVES = {'M': _reference_curves('M'), 'F': _reference_curves('F')}
+
+
+def expected_weighing_mean_std_at(sex, birth_date, dates):
+    """Vectorized version of `expected_weighing_mean_std` for an array of dates.
+
+    Returns the arrays of the expected weight mean and std at the age of the subject at each
+    date, as `expected_weighing_mean_std(sex, to_weeks(birth_date, date))`.
+    """
+    means, stds = REFERENCE_CURVES['M' if sex == 'M' else 'F']
+    dates = np.asarray(dates, dtype='datetime64[us]')
+    age_d = (dates - np.datetime64(birth_date, 'us')) // np.timedelta64(1, 'D')
+    i = np.clip(age_d, 0, len(means) - 1)
+    return means[i], stds[i]
+
+
 def to_weeks(birth_date, dt):
     if not birth_date:
         logger.warning("No birth date specified!")
@@ -115,6 +141,64 @@ def tzone_convert(date_t, tz):
     return django.utils.timezone.make_naive(date_t, tz)
 
 
+def _day(date):
+    return np.datetime64(date.date(), 'D')
+
+
+def _take(values, idx, fill):
+    """Return `values[idx]` where `idx >= 0` and `fill` elsewhere."""
+    if not len(values):
+        return np.full(np.shape(idx), fill, dtype=values.dtype)
+    return np.where(idx >= 0, values[np.maximum(idx, 0)], fill)
+
+
+def percentage_weight_html(subject_id, pct_wei, status, is_water_restricted):
+    """Link to the water history of a subject showing its weight percentage, colored according
+    to its weight status."""
+    # Determine the color.
+    colour_code = '008000'
+    if not is_water_restricted:
+        colour_code = '333333'
+    elif status == 1:  # orange colour code for reminders
+        colour_code = 'FFA500'
+    elif status == 2:  # red colour code for errors
+        colour_code = 'FF0000'
+
+    if pct_wei == 0:
+        return '-'
+    else:
+        url = reverse('water-history', kwargs={'subject_id': subject_id})
+        return format_html(
+            '<b><a href="{url}" style="color: #{};">{}%</a></b>',
+            colour_code, '{:2.1f}'.format(pct_wei), url=url)
+
+
+class _Events:
+    """Dated events, with their dates, days and values as NumPy arrays.
+
+    The events must be sorted by date so that the lookups can use `searchsorted`.
+    """
+
+    def __init__(self, events, value=itemgetter(1)):
+        self.events = events
+        self.dates = np.array([e[0] for e in events], dtype='datetime64[us]')
+        self.days = self.dates.astype('datetime64[D]')
+        # None values become NaN.
+        self.values = np.array([value(e) for e in events], dtype=np.float64)
+
+    def __len__(self):
+        return len(self.events)
+
+    def last_before(self, days):
+        """Index of the last event on or before each day, -1 if there is none."""
+        return np.searchsorted(self.days, days, side='right') - 1
+
+    def on(self, day):
+        """Slice of the events on the specified day."""
+        return slice(np.searchsorted(self.days, day, side='left'),
+                     np.searchsorted(self.days, day, side='right'))
+
+
 class WaterControl:
     def __init__(self, nickname=None, birth_date=None, sex=None,
                  subject_id=None, reference_weight_pct=0.,
@@ -138,26 +222,37 @@ class WaterControl:
         self.zscore_weight_pct = zscore_weight_pct
         self.thresholds = []
         self.timezone = timezone
+        self._events = None
 
     def today(self):
         """The date at the timezone if the current subject."""
         return tzone_convert(today(), self.timezone)
 
+    def _index(self):
+        """Return the events as sorted arrays, rebuilt whenever an event is added."""
+        if self._events is None:
+            # NB: the lists are sorted in place, the scalar methods used to do it on each call.
+            self.weighings.sort(key=itemgetter(0))
+            self.implant_weights.sort(key=itemgetter(0))
+            self.water_administrations.sort(key=itemgetter(0))
+            was = _Events(self.water_administrations)
+            was.has_session = np.array([bool(ses) for _, _, ses in was.events], dtype=bool)
+            # The water restrictions are kept in insertion order, which must be chronological.
+            wrs = _Events(self.water_restrictions, value=itemgetter(2))
+            wrs.ends = np.array([e for _, e, _ in wrs.events], dtype='datetime64[us]')
+            self._events = {
+                'weighings': _Events(self.weighings),
+                'implant_weights': _Events(self.implant_weights),
+                'water_administrations': was,
+                'water_restrictions': wrs,
+            }
+        return self._events
+
     def first_date(self):
-        dwa = dwe = None
-        if self.water_administrations:
-            dwa = min(d for d, _, _ in self.water_administrations)
-        if self.weighings:
-            dwe = min(d for d, _ in self.weighings)
-        if not dwa and not dwe:
-            return self.birth_date
-        elif dwa and dwe:
-            return min(dwa, dwe)
-        elif dwa:
-            return dwa
-        elif dwe:
-            return dwe
-        assert 0
+        index = self._index()
+        dates = [index[name].events[0][0] for name in ('water_administrations', 'weighings')
+                 if index[name]]
+        return min(dates) if dates else self.birth_date
 
     def _check_water_restrictions(self):
         """Make sure all past water restrictions (except the current one) are finished."""
@@ -178,6 +273,7 @@ class WaterControl:
         assert end_date is None or isinstance(end_date, datetime)
         self._check_water_restrictions()
         self.water_restrictions.append((start_date, end_date, reference_weight))
+        self._events = None
 
     def end_current_water_restriction(self):
         """If the mouse is under water restriction, end it."""
@@ -189,6 +285,7 @@ class WaterControl:
             logger.warning("The mouse %s is not currently under water restriction.", self.nickname)
             return
         self.water_restrictions[-1] = (s, self.today(), wr)
+        self._events = None
 
     def current_water_restriction(self):
         """Return the date of the current water restriction if there is one, or None."""
@@ -209,11 +306,10 @@ class WaterControl:
         """If the subject was under water restriction at the specified date, return
         the start of that water restriction."""
         date = date or self.today()
-        water_restrictions_before = [
-            (s, e, rw) for (s, e, rw) in self.water_restrictions if s.date() <= date.date()]
-        if not water_restrictions_before:
+        i = self._index()['water_restrictions'].last_before(_day(date))
+        if i < 0:
             return
-        s, e, rw = water_restrictions_before[-1]
+        s, e, rw = self.water_restrictions[i]
         # Return None if the mouse was not under water restriction at the specified date.
         if e is not None and date > e:
             return None
@@ -224,10 +320,12 @@ class WaterControl:
     def add_implant_weight(self, date, weight):
         """Add an implant weight."""
         self.implant_weights.append((tzone_convert(date, self.timezone), weight))
+        self._events = None
 
     def add_weighing(self, date, weighing):
         """Add a weighing."""
         self.weighings.append((tzone_convert(date, self.timezone), weighing))
+        self._events = None
 
     def set_reference_weight(self, date, weight):
         """Set a non-default reference weight."""
@@ -235,6 +333,7 @@ class WaterControl:
 
     def add_water_administration(self, date, volume, session=None):
         self.water_administrations.append((tzone_convert(date, self.timezone), volume, session))
+        self._events = None
 
     def add_threshold(self, percentage=None, bgcolor=None, fgcolor=None, line_style=None):
         """Add a threshold for the plot."""
@@ -264,6 +363,11 @@ class WaterControl:
         wr = self.water_restriction_at(date)
         if not wr:
             return
+        return self._restriction_reference_weighing(wr)
+
+    def _restriction_reference_weighing(self, wr):
+        """Return a tuple (date, weight) the reference weighing of the water restriction
+        started at the specified date."""
         # get the reference weight of the valid water restriction at the time
         ref_weight = [
             (d, w) for d, e, w in self.water_restrictions
@@ -289,32 +393,23 @@ class WaterControl:
         """Return the last known implant weight of the subject before the specified date."""
         date = date or self.today()
         assert isinstance(date, datetime)
-        # Sort the weighings.
-        self.implant_weights[:] = sorted(self.implant_weights, key=itemgetter(0))
-        weights_before = (
-            (d, w) for (d, w) in reversed(self.implant_weights) if d.date() <= date.date()
-        )
-        w = next(weights_before, None)
+        i = self._index()['implant_weights'].last_before(_day(date))
+        w = self.implant_weights[i] if i >= 0 else None
         return w[1] if (w and not return_date) else w
 
     def last_weighing_before(self, date=None):
         """Return the last known weight of the subject before the specified date."""
         date = date or self.today()
         assert isinstance(date, datetime)
-        # Sort the weighings.
-        self.weighings[:] = sorted(self.weighings, key=itemgetter(0))
-        weighings_before = (
-            (d, w) for (d, w) in reversed(self.weighings) if d.date() <= date.date()
-        )
-        return next(weighings_before, None)
+        i = self._index()['weighings'].last_before(_day(date))
+        return self.weighings[i] if i >= 0 else None
 
     def weighing_at(self, date=None):
         """Return the weight of the subject at the specified date."""
         date = date or self.today()
         assert isinstance(date, datetime)
-        weighings_at = ((d, w) for (d, w) in reversed(self.weighings) if d.date() == date.date())
-        weighing = next(weighings_at, None)
-        return weighing[1] if weighing else None
+        weighings_at = self.weighings[self._index()['weighings'].on(_day(date))]
+        return weighings_at[-1][1] if weighings_at else None
 
     def current_weighing(self):
         """Return the last known weight."""
@@ -377,25 +472,9 @@ class WaterControl:
         return 100 * (w - iw) / (e - iw) if (e - iw) > 0 else 0.
 
     def percentage_weight_html(self, date=None):
-        status = self.weight_status(date=date)
-        pct_wei = self.percentage_weight(date=date)
-
-        # Determine the color.
-        colour_code = '008000'
-        if not self.is_water_restricted(date=date):
-            colour_code = '333333'
-        elif status == 1:  # orange colour code for reminders
-            colour_code = 'FFA500'
-        elif status == 2:  # red colour code for errors
-            colour_code = 'FF0000'
-
-        if pct_wei == 0:
-            return '-'
-        else:
-            url = reverse('water-history', kwargs={'subject_id': self.subject_id})
-            return format_html(
-                '<b><a href="{url}" style="color: #{};">{}%</a></b>',
-                colour_code, '{:2.1f}'.format(pct_wei), url=url)
+        return percentage_weight_html(
+            self.subject_id, self.percentage_weight(date=date), self.weight_status(date=date),
+            self.is_water_restricted(date=date))
 
     def min_weight(self, date=None):
         """Minimum weight for the mouse."""
@@ -410,10 +489,9 @@ class WaterControl:
     def last_water_administration_at(self, date=None):
         """Return the last known water administration of the subject before the specified date."""
         date = date or self.today()
-        # Sort the water administrations.
-        self.water_administrations[:] = sorted(self.water_administrations, key=itemgetter(0))
-        wa_before = ((d, w, h) for (d, w, h) in reversed(self.water_administrations) if d <= date)
-        return next(wa_before, None)
+        was = self._index()['water_administrations']
+        i = np.searchsorted(was.dates, np.datetime64(date, 'us'), side='right') - 1
+        return self.water_administrations[i] if i >= 0 else None
 
     def expected_water(self, date=None):
         """Return the expected water for the specified date."""
@@ -433,8 +511,9 @@ class WaterControl:
         date = date or self.today()
         assert isinstance(date, datetime)
         totw = 0
-        for (d, w, ses) in self.water_administrations:
-            if d.date() != date.date() or w is None:
+        was = self.water_administrations[self._index()['water_administrations'].on(_day(date))]
+        for (d, w, ses) in was:
+            if w is None:
                 continue
             if has_session is None:
                 totw += w
@@ -492,20 +571,139 @@ class WaterControl:
         else:
             return 0
 
+    def _series(self, dates):
+        """Evaluate the columns at each of the specified dates.
+
+        This is the vectorized counterpart of the scalar methods: the events are looked up
+        with `searchsorted` on their sorted dates and the water given is summed per day.
+        Returns a dict of arrays, one per column, and a dict of boolean arrays that are False
+        where the scalar method returns a placeholder (0 or None) instead of a value.
+        """
+        index = self._index()
+        dates = np.asarray(dates, dtype='datetime64[us]')
+        days = dates.astype('datetime64[D]')
+        nat = np.datetime64('NaT')
+        out, found = {}, {}
+
+        # Last weighing and implant weight on or before each day.
+        weighings = index['weighings']
+        i = weighings.last_before(days)
+        found['weight'] = i >= 0
+        weight = out['weight'] = _take(weighings.values, i, 0.)
+        found['weighing_at'] = _take(weighings.days, i, nat) == days
+        out['weighing_at'] = weight
+        implant_weights = index['implant_weights']
+        i = implant_weights.last_before(days)
+        found['implant_weight'] = i >= 0
+        iw = out['implant_weight'] = _take(implant_weights.values, i, 0.)
+
+        # Water restriction at each date, and the reference weighing and implant weight.
+        wrs = index['water_restrictions']
+        k = wrs.last_before(days)
+        restricted = out['is_water_restricted'] = (k >= 0) & ~(dates > _take(wrs.ends, k, nat))
+        ref_days = np.where(restricted, _take(wrs.days, k, nat), days)
+        ref_iw = _take(implant_weights.values, implant_weights.last_before(ref_days), 0.)
+        refs = [self._restriction_reference_weighing(s) for s, _, _ in wrs.events]
+        ref_date = _take(np.array([r[0] if r else None for r in refs], dtype='datetime64[us]'),
+                         np.where(restricted, k, -1), nat)
+        ref_weight = _take(np.array([r[1] if r else None for r in refs], dtype=np.float64),
+                           k, np.nan)
+        if self.reference_weighing:
+            custom = dates >= np.datetime64(self.reference_weighing[0], 'us')
+            ref_date[custom] = np.datetime64(self.reference_weighing[0], 'us')
+            ref_weight[custom] = self.reference_weighing[1]
+        has_ref = ~np.isnat(ref_date)
+        reference_weight = out['reference_weight'] = np.where(has_ref, ref_weight - ref_iw, 0.)
+
+        # Expected weight from the reference weighing z-scored against the reference tables.
+        zscore_weight = out['zscore_weight'] = np.zeros(len(dates))
+        if self.birth_date and has_ref.any():
+            mrw_ref, srw_ref = expected_weighing_mean_std_at(
+                self.sex, self.birth_date, np.where(has_ref, ref_date, dates))
+            zscore = (ref_weight - ref_iw - mrw_ref) / srw_ref
+            mrw_date, srw_date = expected_weighing_mean_std_at(self.sex, self.birth_date, dates)
+            zscore_weight[has_ref] = ((srw_date * zscore) + mrw_date)[has_ref]
+        elif has_ref.any():
+            logger.warning("The birth date of %s has not been specified.", self.nickname)
+
+        pct_sum = (self.reference_weight_pct + self.zscore_weight_pct)
+        if pct_sum == 0:
+            expected_weight = np.zeros(len(dates))
+            found['expected_weight'] = np.zeros(len(dates), dtype=bool)
+        else:
+            pz = self.zscore_weight_pct / pct_sum
+            pr = self.reference_weight_pct / pct_sum
+            expected_weight = pz * zscore_weight + pr * reference_weight + iw
+        out['expected_weight'] = expected_weight
+        out['min_weight'] = (zscore_weight * self.zscore_weight_pct +
+                             reference_weight * self.reference_weight_pct) + iw
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out['percentage_weight'] = np.where(
+                (expected_weight - iw) > 0, 100 * (weight - iw) / (expected_weight - iw), 0.)
+
+        # Water given per day, summed in chronological order as `given_water` does.
+        was = index['water_administrations']
+        unique_days, inverse = np.unique(days, return_inverse=True)
+        pos = np.minimum(np.searchsorted(unique_days, was.days), len(unique_days) - 1)
+        valid = (unique_days[pos] == was.days) & ~np.isnan(was.values)
+        for col, mask in (('given_water_reward', was.has_session),
+                          ('given_water_supplement', ~was.has_session),
+                          ('given_water_total', True)):
+            mask = valid & mask
+            volumes = np.bincount(pos[mask], weights=was.values[mask],
+                                  minlength=len(unique_days))
+            counts = np.bincount(pos[mask], minlength=len(unique_days))
+            out[col] = volumes[inverse]
+            found[col] = counts[inverse] > 0
+
+        pct_weight = pct_sum * (expected_weight - iw) + iw
+        out['expected_water'] = np.where(
+            weight < pct_weight, 0.05 * (weight - iw), 0.04 * (weight - iw))
+        out['excess_water'] = -(out['expected_water'] - out['given_water_total'])
+        return out, found
+
     def to_jsonable(self, start_date=None, end_date=None):
         start_date = to_date(start_date) if start_date else self.first_date()
+        if start_date is None:
+            return []
+        elif not isinstance(start_date, datetime):  # the birth date of a subject without events
+            start_date = date_to_datetime(start_date)
         end_date = to_date(end_date) if end_date else self.today()
-        out = []
-        for d in date_range(start_date, end_date):
-            obj = {}
-            for col in self._columns:
-                if col == 'date':
-                    obj['date'] = d.date()
-                else:
-                    obj[col] = getattr(self, col)(date=d)
-            out.append(obj)
+        dates = list(date_range(start_date, end_date))
+        if not dates:
+            return []
+        series, found = self._series(dates)
+        columns = [[d.date() for d in dates]]
+        for col in self._columns[1:]:
+            values = series[col].tolist()
+            if col in found:
+                # Keep the placeholders returned by the scalar methods.
+                placeholder = None if col in ('weighing_at', 'implant_weight') else 0
+                values = [v if f else placeholder for v, f in zip(values, found[col].tolist())]
+            columns.append(values)
         # return json.dumps(out, cls=DjangoJSONEncoder)
-        return out
+        return [dict(zip(self._columns, row)) for row in zip(*columns)]
+
+    def plot_data(self):
+        """Return the series of the weighing plot, so that it can be drawn client-side."""
+        self._index()  # sorts the weighings
+        dates = [d for d, _ in self.weighings]
+        series, _ = self._series(dates) if dates else ({}, {})
+        return {
+            'nickname': self.nickname,
+            'reference_weight_pct': self.reference_weight_pct,
+            'zscore_weight_pct': self.zscore_weight_pct,
+            'dates': dates,
+            'weights': [w for _, w in self.weighings],
+            **{col: series[col].tolist() if dates else []
+               for col in ('expected_weight', 'zscore_weight', 'reference_weight')},
+            'thresholds': [
+                {'percentage': p, 'bgcolor': bgc, 'fgcolor': fgc, 'line_style': ls}
+                for p, bgc, fgc, ls in self.thresholds],
+            'water_restrictions': [
+                {'start_time': s, 'end_time': e, 'reference_weight': rw}
+                for s, e, rw in self.water_restrictions],
+        }
 
     def plot(self, start=None, end=None):
         import matplotlib
@@ -528,15 +726,10 @@ class WaterControl:
             weights = np.array(weights, dtype=np.float64)
             start = start or weighing_dates.min()
             end = end or weighing_dates.max()
-            expected_weights = np.array(
-                [self.expected_weight(date) for date in weighing_dates],
-                dtype=np.float64)
-            zscore_weights = np.array(
-                [self.zscore_weight(date) for date in weighing_dates],
-                dtype=np.float64)
-            reference_weights = np.array(
-                [self.reference_weight(date) for date in weighing_dates],
-                dtype=np.float64)
+            series, _ = self._series(weighing_dates)
+            expected_weights = series['expected_weight']
+            zscore_weights = series['zscore_weight']
+            reference_weights = series['reference_weight']
 
         label = None
         # spans is a list of pairs (date, color) where there are changes of background colors.
@@ -585,6 +778,54 @@ class WaterControl:
 
 def water_control(subject):
     assert subject is not None
+    return _water_control(
+        subject,
+        water_restrictions=subject.actions_waterrestrictions.all(),
+        surgeries=subject.actions_surgerys.all(),
+        water_administrations=subject.water_administrations.all(),
+        weighings=subject.weighings.all(),
+    )
+
+
+def water_control_bulk(subjects):
+    """Create the WaterControl instances of many subjects at once.
+
+    The water restrictions, surgeries, water administrations and weighings of all the subjects
+    are fetched in four queries. The instances are attached to the subjects so that
+    `subject.water_control` does not query the database again.
+
+    Parameters
+    ----------
+    subjects : iterable of subjects.models.Subject
+        The subjects, e.g. a queryset or a page of results. Use `select_related('lab')` to
+        avoid a query per subject for the lab.
+
+    Returns
+    -------
+    dict
+        The WaterControl instances keyed by subject id.
+    """
+    from actions.models import WaterRestriction, Surgery, WaterAdministration, Weighing
+    subjects = list(subjects)
+    ids = [subject.id for subject in subjects]
+    events = {}
+    for name, model in (('water_restrictions', WaterRestriction),
+                        ('surgeries', Surgery),
+                        ('water_administrations', WaterAdministration),
+                        ('weighings', Weighing)):
+        events[name] = defaultdict(list)
+        for obj in model.objects.filter(subject__in=ids):
+            events[name][obj.subject_id].append(obj)
+    out = {}
+    for subject in subjects:
+        wc = _water_control(subject, **{name: by_subject[subject.id]
+                                        for name, by_subject in events.items()})
+        subject._water_control = out[subject.id] = wc
+    return out
+
+
+def _water_control(subject, water_restrictions=(), surgeries=(), water_administrations=(),
+                   weighings=()):
     lab = subject.lab
 
     # By default, if there is only one lab, use it for the subject.
@@ -611,9 +852,9 @@ def water_control(subject):
         wc.add_threshold(
             percentage=absolute_min, bgcolor=PALETTE['red'], fgcolor='#F08699', line_style='--')
     # Water restrictions.
-    wrs = sorted(list(subject.actions_waterrestrictions.all()), key=attrgetter('start_time'))
+    wrs = sorted(water_restrictions, key=attrgetter('start_time'))
     # Surgeries.
-    srgs = sorted(list(subject.actions_surgerys.all()), key=attrgetter('start_time'))
+    srgs = sorted(surgeries, key=attrgetter('start_time'))
     for srg in srgs:
         iw = srg.implant_weight
         if iw:
@@ -627,12 +868,12 @@ def water_control(subject):
         wc.add_water_restriction(wr.start_time, wr.end_time, wr.reference_weight)
 
     # Water administrations.
-    was = sorted(list(subject.water_administrations.all()), key=attrgetter('date_time'))
+    was = sorted(water_administrations, key=attrgetter('date_time'))
     for wa in was:
         wc.add_water_administration(wa.date_time, wa.water_administered, session=wa.session_id)
 
     # Weighings
-    ws = sorted(list(subject.weighings.all()), key=attrgetter('date_time'))
+    ws = sorted(weighings, key=attrgetter('date_time'))
     for w in ws:
         wc.add_weighing(w.date_time, w.weight)
 
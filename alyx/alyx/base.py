@@ -430,9 +430,9 @@ class BaseInlineAdmin(admin.TabularInline):
 class BaseQuerySet(models.QuerySet):
     def update(self, **kwargs):
         if "auto_datetime" in kwargs:
-            super(BaseQuerySet, self).update(**kwargs)
+            return super(BaseQuerySet, self).update(**kwargs)
         else:
-            super(BaseQuerySet, self).update(**kwargs, auto_datetime=timezone.now())
+            return super(BaseQuerySet, self).update(**kwargs, auto_datetime=timezone.now())
 
 
 BaseManager = models.Manager.from_queryset(BaseQuerySet)
@@ -0,0 +1,17 @@
+from alyx.settings_ci import *  # noqa
+DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': '/tmp/sqlset/db.sqlite3'}}
+LOGGING['handlers']['file']['filename'] = '/tmp/sqlset/alyx.log'  # noqa
+
+# local sqlite harness: tolerate aware datetimes in fixtures
+from django.db.backends.sqlite3 import operations as _ops  # noqa
+from django.utils import timezone as _tz  # noqa
+_orig = _ops.DatabaseOperations.adapt_datetimefield_value
+
+
+def _adapt(self, value):
+    if value is not None and not hasattr(value, 'resolve_expression') and _tz.is_aware(value):
+        value = _tz.make_naive(value, _tz.get_default_timezone())
+    return _orig(self, value)
+
+
+_ops.DatabaseOperations.adapt_datetimefield_value = _adapt
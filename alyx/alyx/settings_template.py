@@ -246,6 +246,20 @@ MEDIA_URL = '/uploaded/'
 # The location for saving and/or serving the cache tables.
 # May be a local path, http address or s3 uri (i.e. s3://)
 TABLES_ROOT = os.path.realpath(os.path.join(BASE_DIR, '../tables/'))
+# Optionally have the web server send local cache tables: 'X-Accel-Redirect' for nginx or
+# 'X-Sendfile' for Apache.  For nginx, the prefix is an internal location aliasing TABLES_ROOT.
+# CACHE_SENDFILE_HEADER = 'X-Accel-Redirect'
+# CACHE_SENDFILE_PREFIX = '/tables/'
+
+# The Globus directory listings are shared by the data management commands through the 'globus'
+# cache (see data.transfers.globus_ls), or kept in the memory of each process without it.
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'globus': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.realpath(os.path.join(BASE_DIR, '../cache/globus/')),
+    },
+}
 
 UPLOADED_IMAGE_WIDTH = 800
 
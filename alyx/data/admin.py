@@ -5,7 +5,7 @@ from django_admin_listfilter_dropdown.filters import RelatedDropdownFilter, Choi
 from rangefilter.filters import DateRangeFilter
 
 from .models import (DataRepositoryType, DataRepository, DataFormat, DatasetType,
-                     Dataset, FileRecord, Download, Revision, Tag)
+                     Dataset, FileRecord, Download, Revision, Tag, GlobusTransferTask)
 from alyx.base import BaseAdmin, BaseInlineAdmin, DefaultListFilter, get_admin_url
 
 
@@ -211,6 +211,24 @@ class RevisionAdmin(BaseAdmin):
     ordering = ('-created_datetime',)
 
 
+class GlobusTransferTaskAdmin(BaseAdmin):
+    fields = ('task_id', 'name', 'source_repository', 'destination_repository', 'status',
+              'submitted_datetime', 'completed_datetime', 'file_record_count')
+    readonly_fields = fields
+    list_display = ('task_id', 'name', 'status', 'submitted_datetime', 'completed_datetime',
+                    'file_record_count')
+    list_filter = ('status', ('submitted_datetime', DateRangeFilter))
+    search_fields = ('task_id', 'name')
+    ordering = ('-submitted_datetime',)
+
+    def file_record_count(self, task):
+        return task.file_record_count
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        return queryset.annotate(file_record_count=Count('file_records'))
+
+
 class TagAdmin(BaseAdmin):
     fields = ['name', 'description', 'protected', 'public', 'dataset_count', 'session_count']
     list_display = ['name', 'description', 'dataset_count', 'session_count', 'protected', 'public']
@@ -240,3 +258,4 @@ admin.site.register(FileRecord, FileRecordAdmin)
 admin.site.register(Download, DownloadAdmin)
 admin.site.register(Revision, RevisionAdmin)
 admin.site.register(Tag, TagAdmin)
+admin.site.register(GlobusTransferTask, GlobusTransferTaskAdmin)
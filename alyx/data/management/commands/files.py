@@ -5,7 +5,7 @@ from django.db.models import Count, Q
 
 from actions.models import Session
 from data import transfers
-from data.models import Dataset, DatasetType, DataRepository, FileRecord
+from data.models import Dataset, DatasetType, DatasetTypeMatcher, DataRepository, FileRecord
 from misc.models import Lab
 logging.getLogger(__name__).setLevel(logging.WARNING)
 
@@ -73,7 +73,8 @@ def _create_missing_file_records(dry_run=False):
 class Command(BaseCommand):
     """
         ./manage.py files bulksync --lab=cortexlab --dry
-        ./manage.py files bulktransfer --lab=cortexlab --dry
+        ./manage.py files bulktransfer --lab=cortexlab --dry --max-tasks=4
+        ./manage.py files polltasks
         ./manage.py files removelocal --lab=churchlandlab --dry --before=2019-05-15 --limit=5
     """
     help = "Manage files"
@@ -89,6 +90,8 @@ class Command(BaseCommand):
         parser.add_argument('--limit', help='limit to a maximum number of datasets')
         parser.add_argument('--user', help='select datasets created by a given user')
         parser.add_argument('--before', help='select datasets before a given date')
+        parser.add_argument('--max-tasks', type=int,
+                            help='maximum number of Globus tasks per pair of repositories')
 
     def handle(self, *args, **options):
         action = options.get('action')
@@ -155,7 +158,10 @@ class Command(BaseCommand):
             transfers.bulk_sync(dry_run=dry, lab=lab)
 
         if action == 'bulktransfer':
-            transfers.bulk_transfer(dry_run=dry, lab=lab)
+            transfers.bulk_transfer(dry_run=dry, lab=lab, max_tasks=options.get('max_tasks'))
+
+        if action == 'polltasks':
+            transfers.poll_globus_tasks()
 
         if action == 'login':
             transfers.create_globus_token()
@@ -199,11 +205,12 @@ class Command(BaseCommand):
             dr.data_url = 'http://ibl.flatironinstitute.org/cortexlab/Subjects/'
             dr.save()
 
-            qs = DatasetType.objects.filter(filename_pattern__isnull=False)
+            matcher = DatasetTypeMatcher(
+                DatasetType.objects.filter(filename_pattern__isnull=False))
             dt = None
             for d in FileRecord.objects.all().select_related('dataset'):
                 try:
-                    dt = transfers.get_dataset_type(d.relative_path, qs)
+                    dt = matcher.match(d.relative_path)
                 except ValueError:
                     dt = None
                     continue
@@ -247,8 +247,9 @@ class TestTransfers(object):
                               iteration=1)
 
         # Test bulk transfer, first in dry mode
-        _, tm = _bulk_transfer(dry_run=True, lab=self.lab_name, gc=self.gtc)
-        self.assert_bulk_transfer_dry(tm, exp_files, exp_files_uuid, lab_name=self.lab_name)
+        _, plan = _bulk_transfer(dry_run=True, lab=self.lab_name, gc=self.gtc)
+        self.assert_bulk_transfer_dry(plan.matrix, exp_files, exp_files_uuid,
+                                      lab_name=self.lab_name)
 #
         # Then in non dry mode
         _, tm = _bulk_transfer(dry_run=False, lab=self.lab_name, gc=self.gtc)
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.18 on 2026-10-17 09:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0021_alter_dataset_collection_alter_dataset_hash_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GlobusTransferTask',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('name', models.CharField(blank=True, help_text='Long name', max_length=255)),
+                ('json', models.JSONField(blank=True, help_text='Structured data, formatted in a user-defined way', null=True)),
+                ('task_id', models.UUIDField(help_text='Globus task id', unique=True)),
+                ('status', models.CharField(choices=[('ACTIVE', 'active'), ('INACTIVE', 'inactive'), ('SUCCEEDED', 'succeeded'), ('FAILED', 'failed')], db_index=True, default='ACTIVE', max_length=16)),
+                ('submitted_datetime', models.DateTimeField(default=django.utils.timezone.now)),
+                ('completed_datetime', models.DateTimeField(blank=True, null=True)),
+                ('destination_repository', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='data.datarepository')),
+                ('file_records', models.ManyToManyField(blank=True, help_text='Destination file records of the transfer', related_name='globus_transfer_tasks', to='data.filerecord')),
+                ('source_repository', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='data.datarepository')),
+            ],
+            options={
+                'ordering': ('-submitted_datetime',),
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.18 on 2026-10-17 10:09
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0022_globustransfertask'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(choices=[('session', 'session'), ('dataset', 'dataset')], max_length=16)),
+                ('object_id', models.UUIDField()),
+                ('session_id', models.UUIDField(blank=True, help_text='Session of a dataset', null=True)),
+                ('deleted_datetime', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
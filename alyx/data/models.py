@@ -1,8 +1,16 @@
+import re
+import time
+from fnmatch import translate
+from pathlib import PurePosixPath
+
 import structlog
-from one.alf.spec import QC
+from one.alf.spec import QC, is_valid
+from one.alf.path import filename_parts
 
 from django.core.validators import RegexValidator
-from django.db import models
+from django.db import models, connection
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
 from django.utils import timezone
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
@@ -180,6 +188,110 @@ class DatasetType(BaseModel):
         return super().save(*args, **kwargs)
 
 
+class DatasetTypeMatcher:
+    """
+    An index of dataset types for resolving the dataset type of filenames.
+
+    This gives the same result as `one.registration.get_dataset_type` but the dataset types are
+    indexed once: the types without a filename pattern are stored by name, and the patterns are
+    compiled and grouped by their literal prefix so that only the patterns whose prefix matches
+    the start of a filename are tested.
+    """
+
+    def __init__(self, dtypes):
+        """
+        :param dtypes: an iterable of DatasetType objects, e.g. a queryset
+        """
+        self.created = time.monotonic()
+        self.names = {}  # dataset type name -> dataset type without filename pattern
+        self.patterns = {}  # literal prefix -> list of (compiled pattern, dataset type)
+        for dt in dtypes:
+            pattern = dt.filename_pattern.lower()
+            if not pattern.strip():
+                self.names[dt.name] = dt
+                continue
+            prefix = re.split(r'[*?\[]', pattern, maxsplit=1)[0]
+            self.patterns.setdefault(prefix, []).append((re.compile(translate(pattern)), dt))
+
+    def match(self, filename):
+        """
+        Return the dataset type matching a filename.
+
+        :param filename: str, pathlib.Path: the filename or file path
+        :return: the matching DatasetType object
+        :raises ValueError: the filename matches none or several of the dataset types
+        """
+        filename = PurePosixPath(filename)
+        name = filename.name
+        # If the filename pattern is null, the filename object.attribute must match the name,
+        # otherwise the name is matched against the filename sans extension
+        obj_attr = '.'.join(filename_parts(name)[1:3]) if is_valid(name) else filename.stem
+        matches = [self.names[obj_attr]] if obj_attr in self.names else []
+        lower = name.lower()
+        for i in range(len(lower) + 1):
+            for pattern, dt in self.patterns.get(lower[:i], ()):
+                if pattern.match(lower):
+                    matches.append(dt)
+        if len(matches) == 0:
+            raise ValueError(f'No dataset type found for filename "{name}"')
+        elif len(matches) >= 2:
+            matches = sorted(matches, key=lambda dt: dt.name)
+            raise ValueError('Multiple matching dataset types found for filename '
+                             f'"{name}": \n{", ".join(map(str, matches))}')
+        return matches[0]
+
+
+_dataset_type_matcher = None
+DATASET_TYPE_MATCHER_TTL = 60  # seconds before the matcher is rebuilt to pick up other processes
+
+
+def get_dataset_type_matcher(rebuild=False):
+    """
+    Return a cached index of all dataset types.
+
+    The index is rebuilt when a dataset type is saved or deleted and when it's older than
+    `DATASET_TYPE_MATCHER_TTL`, as dataset types may have been changed by another process.  An
+    index built within a transaction isn't cached as the dataset types may yet be rolled back.
+
+    :param rebuild: if True, the index is rebuilt regardless of its age
+    :return: a DatasetTypeMatcher object
+    """
+    global _dataset_type_matcher
+    matcher = _dataset_type_matcher
+    if rebuild or matcher is None or time.monotonic() - matcher.created > DATASET_TYPE_MATCHER_TTL:
+        matcher = DatasetTypeMatcher(DatasetType.objects.all())
+        if not connection.in_atomic_block:
+            _dataset_type_matcher = matcher
+    return matcher
+
+
+def match_dataset_type(filename, matcher=None):
+    """
+    Return the dataset type of a filename using the cached index of dataset types.
+
+    If no dataset type matches, the index is rebuilt in case the dataset type was created by
+    another process.
+
+    :param filename: str, pathlib.Path: the filename or file path
+    :param matcher: the DatasetTypeMatcher to use, defaults to the cached index
+    :return: the matching DatasetType object
+    :raises ValueError: the filename matches none or several of the dataset types
+    """
+    matcher = get_dataset_type_matcher() if matcher is None else matcher
+    try:
+        return matcher.match(filename)
+    except ValueError:
+        return get_dataset_type_matcher(rebuild=True).match(filename)
+
+
+@receiver(post_save, sender=DatasetType)
+@receiver(post_delete, sender=DatasetType)
+def clear_dataset_type_matcher(sender, **kwargs):
+    """Invalidate the cached dataset type index when a dataset type changes."""
+    global _dataset_type_matcher
+    _dataset_type_matcher = None
+
+
 class BaseExperimentalData(BaseModel):
     """
     Abstract base class for all data acquisition models. Never used directly.
@@ -466,6 +578,90 @@ class FileRecord(BaseModel):
         return "<FileRecord '%s' by %s>" % (self.relative_path, self.dataset.created_by)
 
 
+class GlobusTransferTask(BaseModel):
+    """
+    A Globus transfer task submitted to copy file records to a server repository. The status
+    of the active tasks is polled from the Globus task API by `data.transfers.poll_globus_tasks`,
+    which marks the transferred file records as existing.
+    """
+    STATUS_TYPES = (
+        ('ACTIVE', 'active'),
+        ('INACTIVE', 'inactive'),
+        ('SUCCEEDED', 'succeeded'),
+        ('FAILED', 'failed'),
+    )
+    UNFINISHED = ('ACTIVE', 'INACTIVE')
+
+    task_id = models.UUIDField(unique=True, help_text="Globus task id")
+    source_repository = models.ForeignKey(
+        DataRepository, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    destination_repository = models.ForeignKey(
+        DataRepository, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    file_records = models.ManyToManyField(
+        FileRecord, blank=True, related_name='globus_transfer_tasks',
+        help_text="Destination file records of the transfer")
+    status = models.CharField(max_length=16, default='ACTIVE', choices=STATUS_TYPES,
+                              db_index=True)
+    submitted_datetime = models.DateTimeField(default=timezone.now)
+    completed_datetime = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('-submitted_datetime',)
+
+    def __str__(self):
+        return "<GlobusTransferTask %s '%s' %s>" % (self.task_id, self.name, self.status)
+
+
+# Deleted sessions and datasets
+# ------------------------------------------------------------------------------------------------
+
+class Tombstone(models.Model):
+    """
+    The id of a deleted session or dataset, recorded so that the incremental updates of the ONE
+    cache tables remove it without comparing every id (see misc/management/commands/one_cache.py).
+    Rows deleted without sending the post_delete signal, e.g. with raw SQL, are not recorded.
+    """
+    MODEL_TYPES = (
+        ('session', 'session'),
+        ('dataset', 'dataset'),
+    )
+
+    model = models.CharField(max_length=16, choices=MODEL_TYPES)
+    object_id = models.UUIDField()
+    session_id = models.UUIDField(null=True, blank=True, help_text="Session of a dataset")
+    deleted_datetime = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return "<Tombstone %s %s>" % (self.model, self.object_id)
+
+
+@receiver(post_delete, sender=Session)
+@receiver(post_delete, sender=Dataset)
+def create_tombstone(sender, instance, **kwargs):
+    """Record the id of a deleted session or dataset."""
+    Tombstone.objects.create(
+        model=sender._meta.model_name, object_id=instance.pk,
+        session_id=getattr(instance, 'session_id', None))
+
+
+@receiver(m2m_changed, sender=Dataset.tags.through)
+def update_tagged_datasets(sender, instance, action, reverse, pk_set, **kwargs):
+    """Update the modification time of the datasets whose tags are changed."""
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:  # The tags of a dataset are changed
+        pk_set = [instance.pk]
+    elif action == 'pre_clear':  # The datasets of a tag are cleared
+        pk_set = list(instance.datasets.values_list('pk', flat=True))
+    Dataset.objects.filter(pk__in=pk_set).update(auto_datetime=timezone.now())
+
+
+@receiver(pre_delete, sender=Tag)
+def update_untagged_datasets(sender, instance, **kwargs):
+    """Update the modification time of the datasets of a deleted tag."""
+    instance.datasets.update(auto_datetime=timezone.now())
+
+
 # Download table
 # ------------------------------------------------------------------------------------------------
 
@@ -1,23 +1,29 @@
+import threading
 from unittest import mock
 from pathlib import PurePosixPath
-from uuid import uuid4
+from uuid import uuid4, UUID
 from datetime import datetime, timedelta
 
+import globus_sdk
+import requests
 from django.test import TestCase
 from django.core.exceptions import ValidationError
 from django.db import transaction
 from django.db.utils import IntegrityError
-from django.db.models import ProtectedError
+from django.db.models import Count, ProtectedError
 from rest_framework.response import Response
 from one.alf.path import add_uuid_string
+from one.registration import get_dataset_type
 
 from data.management.commands import files
-from data.models import Dataset, DatasetType, Tag, Revision, DataRepository, FileRecord
+from data import models
+from data.models import (Dataset, DatasetType, Tag, Revision, DataRepository, FileRecord,
+                         DatasetTypeMatcher, match_dataset_type, clear_dataset_type_matcher,
+                         GlobusTransferTask, Tombstone)
 from subjects.models import Subject
 from actions.models import Session
 from misc.models import Lab
 from data import transfers
-from data.transfers import get_dataset_type
 
 
 class TestModel(TestCase):
@@ -58,6 +64,36 @@ class TestModel(TestCase):
         with self.assertLogs('data.models', 'WARNING'):
             qs.delete(force=True)
 
+    def test_tombstone(self):
+        """Test that deleted sessions and datasets are recorded"""
+        lab = Lab.objects.create(name='test_lab')
+        subj = Subject.objects.create(nickname='foo', birth_date='2018-09-01', lab=lab)
+        session = Session.objects.create(subject=subj, number=1)
+        dset = Dataset.objects.create(name='foo.npy', session=session)
+        eid = session.pk
+        session.delete()  # Cascades to the dataset
+        tombstones = Tombstone.objects.values_list('model', 'object_id', 'session_id')
+        self.assertCountEqual(tombstones, [('session', eid, None), ('dataset', dset.pk, eid)])
+
+    def test_tags_modification_time(self):
+        """Test that tagging or untagging datasets updates their modification time"""
+        dsets = [Dataset.objects.create(name=f'foo{i}.npy') for i in range(3)]
+        tag = Tag.objects.create(name='tag')
+
+        def modified(action):
+            times = dict(Dataset.objects.values_list('pk', 'auto_datetime'))
+            action()
+            return {d for d, t in Dataset.objects.values_list('pk', 'auto_datetime')
+                    if t > times[d]}
+
+        self.assertEqual(modified(lambda: tag.datasets.add(*dsets[:2])),
+                         {dsets[0].pk, dsets[1].pk})
+        self.assertEqual(modified(lambda: dsets[2].tags.add(tag)), {dsets[2].pk})
+        self.assertEqual(modified(lambda: dsets[0].tags.remove(tag)), {dsets[0].pk})
+        self.assertEqual(modified(tag.datasets.clear), {dsets[1].pk, dsets[2].pk})
+        tag.datasets.set(dsets[:1])
+        self.assertEqual(modified(tag.delete), {dsets[0].pk})
+
 
 class TestDatasetTypeModel(TestCase):
     def test_model_methods(self):
@@ -82,9 +118,46 @@ class TestDatasetTypeModel(TestCase):
         )
 
         dtypes = DatasetType.objects.all()
+        matcher = DatasetTypeMatcher(dtypes)
         for filename, dataname in filename_typename:
             with self.subTest(filename=filename):
                 self.assertEqual(get_dataset_type(filename, dtypes).name, dataname)
+                self.assertEqual(matcher.match(filename).name, dataname)
+                self.assertEqual(match_dataset_type(filename).name, dataname)
+        # the matcher should raise the same errors
+        DatasetType.objects.create(name='foo.baz', filename_pattern='foo.*')
+        matcher = DatasetTypeMatcher(dtypes.all())
+        for filename in ('foo.bar.npy', 'baz.qux.npy'):
+            with self.subTest(filename=filename):
+                with self.assertRaises(ValueError) as expected:
+                    get_dataset_type(filename, dtypes.all())
+                with self.assertRaises(ValueError) as ex:
+                    matcher.match(filename)
+                self.assertEqual(str(expected.exception), str(ex.exception))
+
+    def test_matcher_cache(self):
+        DatasetType.objects.create(name='obj.attr', filename_pattern='')
+        with mock.patch('data.models.connection') as connection:
+            connection.in_atomic_block = False
+            self.assertEqual(match_dataset_type('obj.attr.npy').name, 'obj.attr')
+            matcher = models._dataset_type_matcher
+            self.assertIsNotNone(matcher)
+            self.assertEqual(match_dataset_type('_ns_obj.attr.npy').name, 'obj.attr')
+            self.assertIs(matcher, models._dataset_type_matcher)
+            # saving a dataset type should invalidate the cache
+            DatasetType.objects.create(name='foo.bar', filename_pattern='foo.b?r*')
+            self.assertIsNone(models._dataset_type_matcher)
+            self.assertEqual(match_dataset_type('foo.bar.npy').name, 'foo.bar')
+            # a dataset type created by another process should be found by rebuilding the cache
+            matcher = models._dataset_type_matcher
+            DatasetType.objects.bulk_create([DatasetType(name='baz.qux')])  # no signals sent
+            self.assertIs(matcher, models._dataset_type_matcher)
+            self.assertEqual(match_dataset_type('baz.qux.npy').name, 'baz.qux')
+            self.assertIsNot(matcher, models._dataset_type_matcher)
+        # within a transaction the matcher should not be cached
+        clear_dataset_type_matcher(DatasetType)
+        self.assertEqual(match_dataset_type('baz.qux.npy').name, 'baz.qux')
+        self.assertIsNone(models._dataset_type_matcher)
 
 
 class TestRevisionModel(TestCase):
@@ -207,6 +280,73 @@ class TestManagementFiles(TestCase):
         return add_uuid_string(dataset.name, dataset.pk).as_posix()
 
 
+class FakeTransferClient:
+    """A Globus transfer client listing the directories of an in-memory file system."""
+
+    def __init__(self, files, offline=(), failures=None, tasks=None, page_size=100):
+        """
+        :param files: dict {(endpoint id, directory path): {file name: file size}}
+        :param offline: the ids of the endpoints that are not connected
+        :param failures: dict {(endpoint id, directory path): number of network errors raised
+         before the directory is listed}
+        :param tasks: dict {task id: {'status': task status, 'transferred': list of destination
+         paths}}
+        :param page_size: number of successful transfers per page of the task API
+        """
+        self.files = files
+        self.offline = offline
+        self.failures = dict(failures or {})
+        self.tasks = dict(tasks or {})
+        self.page_size = page_size
+        self.calls = []
+        self.task_calls = []
+        self.submitted = []
+        self._lock = threading.Lock()
+
+    def get_endpoint(self, endpoint_id):
+        return {'display_name': str(endpoint_id),
+                'gcp_connected': False if endpoint_id in self.offline else None}
+
+    def operation_ls(self, endpoint_id, path=None):
+        with self._lock:
+            self.calls.append((endpoint_id, path))
+            if self.failures.get((endpoint_id, path)):
+                self.failures[(endpoint_id, path)] -= 1
+                raise globus_sdk.NetworkError('Connection reset', ConnectionError())
+        if (endpoint_id, path) not in self.files:
+            response = requests.Response()
+            response.status_code = 404
+            response.headers['Content-Type'] = 'application/json'
+            response._content = b'{"code": "ClientError.NotFound", "message": "Not found"}'
+            response.request = requests.Request('GET', 'https://example.org/ls').prepare()
+            raise globus_sdk.TransferAPIError(response)
+        return {'DATA': [{'name': name, 'size': size, 'type': 'file'}
+                         for name, size in self.files[(endpoint_id, path)].items()]}
+
+    def submit_transfer(self, data):
+        self.submitted.append(data)
+        task_id = str(uuid4())
+        self.tasks[task_id] = {'status': 'ACTIVE', 'transferred': []}
+        return {'task_id': task_id}
+
+    def task_list(self, filter=None, limit=None):
+        task_ids = filter.split(':')[1].split(',')
+        with self._lock:
+            self.task_calls.append(('task_list', len(task_ids)))
+        return {'DATA': [{'task_id': task_id, 'status': self.tasks[task_id]['status']}
+                         for task_id in task_ids[:limit] if task_id in self.tasks]}
+
+    def task_successful_transfers(self, task_id, marker=None):
+        with self._lock:
+            self.task_calls.append(('task_successful_transfers', task_id))
+        start = marker or 0
+        paths = self.tasks[task_id]['transferred']
+        end = start + self.page_size
+        return {'DATA': [{'source_path': '', 'destination_path': path}
+                         for path in paths[start:end]],
+                'next_marker': end if end < len(paths) else None}
+
+
 class TestTransfers(TestCase):
     """Tests for the data.transfers module."""
 
@@ -266,6 +406,220 @@ class TestTransfers(TestCase):
                         relative_path=rel_path, exists=True, dataset=d, data_repository=repo)
                 )
 
+    def test_bulk_sync(self):
+        """Test for bulk_sync function with a fake Globus client."""
+        ds0, ds1 = self.dsets[:2]
+        local0, offline0, main0, local1, offline1, main1 = self.records[:6]
+        FileRecord.objects.filter(pk__in=(main0.pk, main1.pk)).update(exists=False)
+        FileRecord.objects.filter(pk=main0.pk).update(json={'transfer_pending': True})
+        local_ep = local0.data_repository.globus_endpoint_id
+        main_ep = main0.data_repository.globus_endpoint_id
+        local_dir = '/mnt/foo/Data2/subject/2020-01-01/001'
+        main_dir = '/mnt/foo/subject/2020-01-01/001'
+        gc = FakeTransferClient(
+            {(local_ep, local_dir): {ds0.name: 1234},
+             (main_ep, main_dir): {add_uuid_string(ds0.name, ds0.pk).as_posix(): 1234}},
+            offline=[offline0.data_repository.globus_endpoint_id],
+            failures={(main_ep, main_dir): 2})
+        transfers._globus_ls_cache().clear()
+        # The directories of pending transfers are listed live, not from a stale listing
+        transfers._globus_ls_cache().set(transfers._globus_ls_key(main_ep, main_dir), [])
+        with mock.patch('data.transfers.time.sleep') as sleep, mock.patch('builtins.print'):
+            transfers.bulk_sync(gc=gc)
+        # Each directory is listed once, and twice more after the transient errors
+        self.assertCountEqual(gc.calls, [(local_ep, local_dir)] + [(main_ep, main_dir)] * 3)
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [1., 2.])
+        exists = dict(FileRecord.objects.values_list('pk', 'exists'))
+        self.assertTrue(exists[local0.pk])
+        self.assertFalse(exists[local1.pk])
+        # The records of unreachable endpoints and without pending transfer are unchanged
+        self.assertTrue(exists[offline0.pk] and exists[offline1.pk])
+        self.assertFalse(exists[main1.pk])
+        # The transfer pending flag is cleared when the file exists on the server
+        self.assertTrue(exists[main0.pk])
+        self.assertFalse(ds0.file_records.filter(json__isnull=False).exists())
+        ds0.refresh_from_db()
+        self.assertEqual(ds0.file_size, 1234)
+        self.assertGreater(ds0.auto_datetime, ds1.auto_datetime)
+
+        # Directories that cannot be listed are empty
+        FileRecord.objects.filter(pk=local1.pk).update(exists=True)
+        transfers._globus_ls_cache().clear()
+        with mock.patch('builtins.print'):
+            transfers.bulk_sync(gc=FakeTransferClient({}, offline=gc.offline))
+        self.assertFalse(FileRecord.objects.get(pk=local1.pk).exists)
+
+        # The records of directories failing beyond the retries are unchanged
+        FileRecord.objects.filter(pk=local1.pk).update(exists=True)
+        transfers._globus_ls_cache().clear()
+        failures = {(local_ep, local_dir): transfers.GLOBUS_LS_RETRIES + 1}
+        gc = FakeTransferClient(gc.files, offline=gc.offline, failures=failures)
+        with mock.patch('data.transfers.time.sleep'), mock.patch('builtins.print'):
+            transfers.bulk_sync(gc=gc)
+        self.assertEqual(gc.calls.count((local_ep, local_dir)), transfers.GLOBUS_LS_RETRIES + 1)
+        self.assertTrue(FileRecord.objects.get(pk=local0.pk).exists)
+        self.assertTrue(FileRecord.objects.get(pk=local1.pk).exists)
+
+    def test_globus_ls(self):
+        """Test for globus_ls function and the invalidation of the cached listings."""
+        ep, path = uuid4(), '/mnt/foo/subject/2020-01-01/001'
+        gc = FakeTransferClient({(ep, path): {'foo.bar.npy': 12}})
+        transfers._globus_ls_cache().clear()
+        stats = transfers.globus_ls_stats.copy()
+        expected = [{'name': 'foo.bar.npy', 'type': 'file', 'size': 12, 'last_modified': None}]
+        self.assertEqual(transfers.globus_ls(gc, ep, path), expected)
+        # The listing is reused, also with an equivalent path
+        self.assertEqual(transfers.globus_ls(gc, ep, path + '/'), expected)
+        self.assertEqual(gc.calls, [(ep, path)])
+        self.assertEqual(transfers.globus_ls_stats - stats, {'hits': 1, 'misses': 1})
+        # Listing errors are not cached
+        with self.assertRaises(globus_sdk.TransferAPIError):
+            transfers.globus_ls(gc, ep, '/mnt/foo')
+        with self.assertRaises(globus_sdk.TransferAPIError):
+            transfers.globus_ls(gc, ep, '/mnt/foo')
+        # The listing is discarded when a file of the directory is transferred or deleted
+        gc.files[(ep, path)]['foo.baz.npy'] = 13
+        transfers.invalidate_globus_ls(ep, [path + '/foo.baz.npy'])
+        self.assertEqual(len(transfers.globus_ls(gc, ep, path)), 2)
+        self.assertEqual(len(gc.calls), 4)
+        # Live listings bypass the cache and replace the cached listing
+        gc.files[(ep, path)]['foo.qux.npy'] = 14
+        self.assertEqual(len(transfers.globus_ls(gc, ep, path, use_cache=False)), 3)
+        self.assertEqual(len(transfers.globus_ls(gc, ep, path)), 3)
+        self.assertEqual(len(gc.calls), 5)
+
+    @mock.patch('data.transfers.globus_sdk.TransferData')
+    def test_plan_transfers(self, transfer_data_mock):
+        """Test for plan_transfers function and the submission of the plan."""
+        ds0, ds1 = self.dsets[:2]
+        main0, main1 = self.records[2], self.records[5]
+        FileRecord.objects.filter(pk__in=(main0.pk, main1.pk)).update(exists=False)
+        FileRecord.objects.filter(dataset=ds1).exclude(pk=main1.pk).update(exists=False)
+        dfs = FileRecord.objects.filter(pk__in=(main0.pk, main1.pk))
+        with self.assertNumQueries(4), mock.patch('data.transfers.logger'):
+            plan = transfers.plan_transfers(dfs)
+        # The source is the first existing file record of the dataset
+        source = min(self.records[:2], key=lambda fr: fr.pk)
+        self.assertEqual(plan.file_records, [main0])
+        self.assertEqual(plan.missing, [main1])
+        self.assertEqual(len(plan), 1)
+        self.assertIn('1 files to transfer, 1 missing, 0 skipped', str(plan))
+        (repos, items), = plan.transfers.items()
+        self.assertEqual(repos, (source.data_repository, main0.data_repository))
+        self.assertEqual(items, [(transfers._filename_from_file_record(source),
+                                  transfers._filename_from_file_record(main0, add_uuid=True))])
+        tm = plan.matrix
+        self.assertEqual(tm.shape, (1, 3))
+        transfer, = tm[tm != 0]
+        self.assertEqual(transfer['label'], f'{source.data_repository.name} to flatiron')
+        self.assertEqual(transfer['DATA'], [
+            {'source_path': items[0][0], 'destination_path': items[0][1]}])
+        # Nothing is written before the plan is submitted
+        self.assertFalse(FileRecord.objects.filter(json__isnull=False).exists())
+
+        gc = FakeTransferClient({})
+        plan.submit(gc)
+        self.assertEqual(gc.submitted, [transfer_data_mock.return_value])
+        transfer_data_mock.return_value.add_item.assert_called_once_with(
+            source_path=items[0][0], destination_path=items[0][1])
+        main0.refresh_from_db()
+        main1.refresh_from_db()
+        self.assertEqual(main0.json, {'transfer_pending': True})
+        self.assertEqual(main1.json, {'local_missing': True})
+        # The Globus task of the transfer is registered with its file records
+        task = GlobusTransferTask.objects.get()
+        self.assertEqual(str(task.task_id), next(iter(gc.tasks)))
+        self.assertEqual(task.status, 'ACTIVE')
+        self.assertEqual(task.name, transfer['label'])
+        self.assertEqual(list(task.file_records.all()), [main0])
+
+    def test_poll_globus_tasks(self):
+        """Test for poll_globus_tasks function with a fake Globus client."""
+        main0, main1, main2 = self.records[2], self.records[5], self.records[8]
+        pending = (main0.pk, main1.pk, main2.pk)
+        FileRecord.objects.filter(pk__in=pending).update(
+            exists=False, json={'transfer_pending': True})
+        paths = [transfers._filename_from_file_record(fr, add_uuid=True)
+                 for fr in (main0, main1, main2)]
+        gc = FakeTransferClient({}, page_size=1, tasks={
+            str(uuid4()): {'status': 'SUCCEEDED', 'transferred': paths[:2]},
+            str(uuid4()): {'status': 'FAILED', 'transferred': []},
+            str(uuid4()): {'status': 'ACTIVE', 'transferred': []}})
+        records = ([main0, main1], [main2], [])
+        for task_id, file_records in zip(gc.tasks, records):
+            task = GlobusTransferTask.objects.create(task_id=task_id)
+            task.file_records.set(file_records)
+        ds0 = Dataset.objects.get(pk=main0.dataset_id)
+
+        with mock.patch('data.transfers.GLOBUS_TASK_BATCH_SIZE', 2), \
+                mock.patch('builtins.print'), mock.patch('data.transfers.logger'):
+            statuses = transfers.poll_globus_tasks(gc=gc)
+        self.assertEqual(statuses, {'SUCCEEDED': 1, 'FAILED': 1, 'ACTIVE': 1})
+        # The statuses are fetched in batches, the successful transfers page by page
+        task_ids = list(gc.tasks)
+        self.assertCountEqual(gc.task_calls, [
+            ('task_list', 2), ('task_list', 1),
+            ('task_successful_transfers', task_ids[0]),
+            ('task_successful_transfers', task_ids[0]),
+            ('task_successful_transfers', task_ids[1])])
+        files = {fr.pk: fr for fr in FileRecord.objects.filter(pk__in=pending)}
+        self.assertTrue(files[main0.pk].exists and files[main1.pk].exists)
+        self.assertFalse(files[main2.pk].exists)
+        # The transfer pending flags are cleared so that failed transfers are submitted again
+        self.assertTrue(all(fr.json is None for fr in files.values()))
+        self.assertGreater(Dataset.objects.get(pk=ds0.pk).auto_datetime, ds0.auto_datetime)
+        tasks = GlobusTransferTask.objects.in_bulk(field_name='task_id')
+        self.assertEqual([tasks[UUID(t)].status for t in task_ids],
+                         ['SUCCEEDED', 'FAILED', 'ACTIVE'])
+        self.assertIsNotNone(tasks[UUID(task_ids[0])].completed_datetime)
+        self.assertIsNone(tasks[UUID(task_ids[2])].completed_datetime)
+
+        # Only the unfinished tasks are polled again
+        gc.task_calls.clear()
+        with mock.patch('builtins.print'):
+            transfers.poll_globus_tasks(gc=gc)
+        self.assertEqual(gc.task_calls, [('task_list', 1)])
+
+    @mock.patch('data.transfers.globus_sdk.TransferData')
+    def test_plan_transfers_tasks(self, transfer_data_mock):
+        """Test the split of the transfers into Globus tasks of balanced size."""
+        mains = self.records[2:9:3]
+        FileRecord.objects.filter(pk__in=[fr.pk for fr in mains]).update(exists=False)
+        FileRecord.objects.filter(data_repository__name='lab0_local1').update(exists=False)
+        for ds, size in zip(self.dsets[:3], (50 * 1024 ** 3, 1024 ** 3, 2 * 1024 ** 3)):
+            Dataset.objects.filter(pk=ds.pk).update(file_size=size)
+        dfs = FileRecord.objects.filter(pk__in=[fr.pk for fr in mains])
+        with self.assertNumQueries(4):
+            plan = transfers.plan_transfers(dfs, max_tasks=2)
+        self.assertEqual(len(plan.transfers), 1)
+        # The largest file is transferred on its own
+        tasks = plan.tasks()
+        self.assertEqual([len(t['DATA']) for t in tasks], [1, 2])
+        self.assertEqual([t['file_size'] for t in tasks], [50 * 1024 ** 3, 3 * 1024 ** 3])
+        self.assertEqual(tasks[0]['file_records'], [mains[0]])
+        self.assertIn('flatiron part 1 of 2: 1 files, 50.000 GB', str(plan))
+        self.assertIn('flatiron part 2 of 2: 2 files, 3.000 GB', str(plan))
+        # The number of files per task is limited
+        plan.max_items = 1
+        self.assertEqual([len(t['DATA']) for t in plan.tasks()], [1, 1, 1])
+
+        gc = FakeTransferClient({})
+        with mock.patch('builtins.print'):
+            transfers._globus_transfer_filerecords(dfs, dry=False, gc=gc, max_tasks=2)
+        self.assertEqual(len(gc.submitted), 2)
+        self.assertEqual(transfer_data_mock.return_value.add_item.call_count, 3)
+        registered = GlobusTransferTask.objects.annotate(n=Count('file_records'))
+        self.assertCountEqual(registered.values_list('n', flat=True), [1, 2])
+
+    def test_pack_by_size(self):
+        """Test for _pack_by_size function."""
+        self.assertEqual(transfers._pack_by_size([5, 1, 3, 2, 4], 2, 10), [[0, 1, 3], [2, 4]])
+        # The number of bins is increased to hold all the items
+        self.assertEqual(transfers._pack_by_size([5, 1, 3, 2, 4], 1, 2), [[0], [1, 4], [2, 3]])
+        # Items of unknown (zero) size are spread evenly
+        self.assertEqual(transfers._pack_by_size([0] * 4, 2, 10), [[0, 2], [1, 3]])
+        self.assertEqual(transfers._pack_by_size([1], 4, 10), [[0]])
+
     def test_get_absolute_path(self):
         expected = '/mnt/foo/subject/2020-01-01/001/ephysData.raw.ap.bin'
         self.assertEqual(expected, transfers._get_absolute_path(self.records[0]))
@@ -3,10 +3,13 @@ from pathlib import PurePosixPath
 import uuid
 
 from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 from alyx.base import BaseTests
 from data.models import Dataset, FileRecord, Download, Tag
+from experiments.models import ProbeInsertion
 
 
 class APIDataTests(BaseTests):
@@ -387,6 +390,42 @@ class APIDataTests(BaseTests):
         self.ar(r, 201)
         self._assert_registration(r, data)
 
+    def test_register_files_bulk(self):
+        # the number of queries should not depend on the number of files registered
+        filenames = [f'a.{let}.e{ext}' for let in 'abcd' for ext in (1, 2)]
+        data = {'path': '%s/2018-01-01/2/dir' % self.subject,
+                'filenames': ','.join(filenames[:2]),
+                'name': 'dr',
+                'hashes': 'a,b',
+                }
+        with CaptureQueriesContext(connection) as queries:
+            self.ar(self.post(reverse('register-file'), data), 201)
+        n_queries = len(queries)
+        data['path'] = '%s/2018-01-01/2/alf/probe00' % self.subject
+        data['hashes'] = ','.join(map(str, range(len(filenames))))
+        data['filenames'] = ','.join(filenames)
+        session = Dataset.objects.get(name='a.a.e1').session
+        probe = ProbeInsertion.objects.create(name='probe00', session_id=session.pk)
+        with CaptureQueriesContext(connection) as queries:
+            r = self.ar(self.post(reverse('register-file'), data), 201)
+        self.assertEqual(len(queries), n_queries + 4)  # + 4 for linking probe insertions
+        self.assertEqual(filenames, [d['name'] for d in r])
+        self.assertTrue(all(d['collection'] == 'alf/probe00' for d in r))
+        self.assertEqual(len(filenames), probe.datasets.count())
+        # re-registering with different hashes patches the file records
+        FileRecord.objects.filter(dataset__collection='alf/probe00').update(exists=False)
+        data['hashes'] = ','.join(map(str, range(1, len(filenames) + 1)))
+        with CaptureQueriesContext(connection) as queries:
+            r = self.ar(self.post(reverse('register-file'), data), 201)
+        self.assertLess(len(queries), 2 * n_queries)
+        self.assertEqual(len(filenames), Dataset.objects.filter(collection='alf/probe00').count())
+        self.assertTrue(all(d['file_records'][0]['exists'] for d in r))
+        # registering the same dataset twice in one request falls back to one by one registration
+        data['filenames'] = 'a.a.e1,#v1#/a.a.e1'
+        r = self.ar(self.post(reverse('register-file'), data), 201)
+        self.assertEqual([True, True], [d['default'] for d in r])
+        self.assertFalse(Dataset.objects.get(pk=r[0]['id']).default_dataset)
+
     def _assert_registration(self, r, data):
         d0, d1 = r.data
         self.assertEqual(d0['name'], 'a.b.e1')
@@ -750,6 +789,15 @@ class APIDataTests(BaseTests):
         r = self.ar(r, 403)
         self.assertEqual(r['error'], 'One or more datasets is protected')
 
+        # The protected status of all files should be fetched in a single query
+        data.pop('check_protected')
+        data.pop('name')
+        with CaptureQueriesContext(connection) as ctx:
+            self.ar(self.client.get(reverse('check-protected'), data=data,
+                                    content_type='application/json'), 200)
+        dataset_queries = [q for q in ctx.captured_queries if 'data_dataset' in q['sql']]
+        self.assertEqual(len(dataset_queries), 1)
+
         r = r['details']
         (name, prot_info), = r[0].items()
         self.assertEqual(name, 'test_prot/a.d.e2')
@@ -761,6 +809,16 @@ class APIDataTests(BaseTests):
         self.assertEqual(name, 'test_prot/a.b.e1')
         self.assertEqual(prot_info, [])
 
+        # Check revisions are ordered by the latest revision with the original one last
+        for rev in ('v1', 'v2'):
+            data['filenames'] = f'test_prot/#{rev}#/a.d.e2'
+            data.pop('check_protected', None)
+            self.ar(self.client.post(reverse('register-file'), data), 201)
+        data.update(filenames='test_prot/a.d.e2,test_prot/a.d.e1', check_protected=True)
+        r = self.ar(self.client.post(reverse('register-file'), data), 403)['details']
+        self.assertEqual(r[0]['test_prot/a.d.e2'], [{'v2': False}, {'v1': False}, {'': True}])
+        self.assertEqual(r[1]['test_prot/a.d.e1'], [{'': False}])
+
     def test_check_protected(self):
         self.post(reverse('datarepository-list'), {'name': 'drb1', 'hostname': 'hostb1'})
         self.post(reverse('lab-list'), {'name': 'labb', 'repositories': ['drb1']})
@@ -1,25 +1,54 @@
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import heapq
 import json
 import structlog
 import os
 import os.path as op
 import re
+import threading
 import time
 from pathlib import Path, PurePosixPath
 
-from django.db.models import Case, When, Count, Q, F
+from django.core.cache import caches, InvalidCacheBackendError
+from django.db import transaction
+from django.db.models import Case, When, Count, Q, F, Exists, OuterRef
+from django.utils import timezone
 import globus_sdk
 import numpy as np
 from one.alf.path import add_uuid_string, folder_parts
-from one.registration import get_dataset_type
 from one.alf.spec import QC
 
 from alyx import settings
-from data.models import FileRecord, Dataset, DatasetType, DataFormat, DataRepository
+from data.models import (FileRecord, Dataset, DataFormat, DataRepository, Revision,
+                         GlobusTransferTask, get_dataset_type_matcher, match_dataset_type)
 from rest_framework.response import Response
 from actions.models import Session
 
 logger = structlog.get_logger(__name__)
 
+# Number of concurrent Globus ls calls made by bulk_sync
+GLOBUS_LS_WORKERS = 8
+# Retries of the Globus ls calls failing with network or server errors, and the initial delay
+# in seconds between them, doubled at each retry
+GLOBUS_LS_RETRIES = 3
+GLOBUS_LS_BACKOFF = 1.
+# Number of rows read or written per query by bulk_sync and the transfer planner
+BULK_BATCH_SIZE = 1000
+# Seconds during which a Globus directory listing is reused, unless a transfer or deletion to
+# the directory is submitted in the meantime
+GLOBUS_LS_CACHE_TTL = 3600
+# Maximum number of Globus tasks, and of files per task, submitted by the bulk transfers for a
+# pair of source / destination repositories
+GLOBUS_TRANSFER_TASKS = 4
+GLOBUS_TRANSFER_MAX_ITEMS = 10000
+# Number of tasks whose status is fetched per Globus task_list call by poll_globus_tasks
+GLOBUS_TASK_BATCH_SIZE = 50
+# Hits and misses of the Globus listing cache in this process
+globus_ls_stats = Counter()
+_globus_ls_stats_lock = threading.Lock()
+
 # Login
 # ------------------------------------------------------------------------------------------------
 
@@ -144,6 +173,7 @@ def start_globus_transfer(source_file_id, destination_file_id, dry_run=False):
         return
 
     response = tc.submit_transfer(tdata)
+    invalidate_globus_ls(destination_id, [destination_path])
 
     task_id = response.get('task_id', None)
     message = response.get('message', None)
@@ -153,6 +183,49 @@ def start_globus_transfer(source_file_id, destination_file_id, dry_run=False):
     return response
 
 
+def _globus_ls_cache():
+    try:
+        return caches['globus']
+    except InvalidCacheBackendError:
+        return caches['default']
+
+
+def _globus_ls_key(endpoint_id, path):
+    path = op.normpath(str(path))
+    return 'globus-ls:' + hashlib.md5(f'{endpoint_id}:{path}'.encode()).hexdigest()
+
+
+def globus_ls(gc, endpoint_id, path, use_cache=True):
+    """
+    Lists a directory of a Globus endpoint. The listings are cached for GLOBUS_LS_CACHE_TTL
+    seconds and shared between processes when a 'globus' cache is configured.
+    The cache must not be used by the checks that need the live state of the endpoint, such as
+    the checks made before deleting files.
+    :param gc: globus transfer client
+    :param endpoint_id: globus endpoint id
+    :param path: absolute path of the directory on the endpoint
+    :param use_cache: if False, the directory is listed and the cached listing replaced
+    :return: list of dicts with the name, type, size and last_modified of the directory entries
+    :raises globus_sdk.TransferAPIError: if the directory cannot be listed, which isn't cached
+    """
+    cache = _globus_ls_cache()
+    key = _globus_ls_key(endpoint_id, path)
+    entries = cache.get(key) if use_cache else None
+    with _globus_ls_stats_lock:
+        globus_ls_stats['hits' if entries is not None else 'misses'] += 1
+    if entries is None:
+        entries = [{k: f.get(k) for k in ('name', 'type', 'size', 'last_modified')}
+                   for f in gc.operation_ls(endpoint_id, path=path)['DATA']]
+        cache.set(key, entries, GLOBUS_LS_CACHE_TTL)
+    return entries
+
+
+def invalidate_globus_ls(endpoint_id, file_paths):
+    """Discards the cached listings of the directories containing the given file paths."""
+    keys = {_globus_ls_key(endpoint_id, op.dirname(str(path))) for path in file_paths}
+    _globus_ls_cache().delete_many(list(keys))
+
+
 def globus_file_exists(file_record):
     tc = globus_transfer_client()
     path = _get_absolute_path(file_record)
@@ -160,7 +233,8 @@ def globus_file_exists(file_record):
     name = op.basename(path)
     name_uuid = add_uuid_string(name, file_record.dataset.pk).as_posix()
     try:
-        existing = tc.operation_ls(file_record.data_repository.globus_endpoint_id, path=dir_path)
+        existing = globus_ls(tc, file_record.data_repository.globus_endpoint_id, dir_path,
+                             use_cache=False)
     except globus_sdk.TransferAPIError as e:
         logger.warning(e)
         return False
@@ -230,17 +304,58 @@ def _change_default_dataset(session, collection, filename):
 
 
 def _check_dataset_protected(session, collection, filename):
-    # Order datasets by the latest revision with the original one last
-    dataset = Dataset.objects.filter(
-        session=session, collection=collection or '', name=filename).order_by(
-        F('revision__created_datetime').desc(nulls_last=True))
-    if dataset.count() == 0:
-        return False, []
-    else:
-        protected = any(d.is_protected for d in dataset)
-        protected_info = [{d.revision.name if d.revision else '': d.is_protected}
-                          for d in dataset]
-        return protected, protected_info
+    return _check_datasets_protected(session, [(collection, filename)])[0]
+
+
+def _check_datasets_protected(session, files):
+    """
+    Check whether the datasets of several files are protected, in a single query.
+
+    :param session: The session of the files
+    :param files: A list of (collection, filename) tuples
+    :return: A list of (protected, protected_info) tuples, one per file, where protected is True
+     if any revision of the dataset is protected and protected_info is a list of
+     {revision name: protected} dicts ordered by the latest revision with the original one last
+    """
+    protected_tags = Dataset.tags.through.objects.filter(
+        dataset=OuterRef('pk'), tag__protected=True)
+    datasets = (Dataset.objects
+                .filter(session=session,
+                        collection__in={collection or '' for collection, _ in files},
+                        name__in={filename for _, filename in files})
+                .annotate(protected=Exists(protected_tags))
+                .order_by(F('revision__created_datetime').desc(nulls_last=True))
+                .values_list('collection', 'name', 'revision__name', 'protected'))
+    protected_info = defaultdict(list)
+    for collection, name, revision, protected in datasets:
+        protected_info[(collection, name)].append({revision or '': protected})
+    results = []
+    for collection, filename in files:
+        info = protected_info.get((collection or '', filename), [])
+        results.append((any(v for d in info for v in d.values()), info))
+    return results
+
+
+def _check_files_protected(session, filenames, rel_dir_path):
+    """
+    Check whether the datasets of several files are protected.
+
+    :param session: The session of the files
+    :param filenames: A list of file paths relative to the session path
+    :param rel_dir_path: The relative session path (subject/date/number)
+    :return: True if any dataset is protected; a list of {filename: protected_info} dicts (see
+     `_check_datasets_protected`); a REST Response object if any ALF path is invalid, otherwise
+     None
+    """
+    files = []
+    for file in filenames:
+        info, resp = _get_name_collection_revision(file, rel_dir_path)
+        if resp:
+            return None, None, resp
+        files.append((info['collection'], info['filename']))
+    results = _check_datasets_protected(session, files)
+    details = [{file: info} for file, (_, info) in zip(filenames, results)]
+    return any(protected for protected, _ in results), details, None
 
 
 def _create_dataset_file_records(
@@ -252,7 +367,7 @@ def _create_dataset_file_records(
     collection = collection or ''
     revision_name = f'#{revision.name}#' if revision else ''
     relative_path = PurePosixPath(rel_dir_path, collection, revision_name, filename)
-    dataset_type = get_dataset_type(filename, DatasetType.objects.all())
+    dataset_type = match_dataset_type(filename)
     data_format = get_data_format(filename)
     assert dataset_type
     assert data_format
@@ -324,6 +439,206 @@ def _create_dataset_file_records(
     return dataset, None
 
 
+def _relation_fields(model):
+    """Return the names of the relation fields of a model, whose validation requires queries."""
+    return [field.name for field in model._meta.concrete_fields if field.is_relation]
+
+
+def _link_dataset_collections(datasets, session):
+    """
+    Set the probe insertion and field of view relationships of many datasets at once.
+
+    This is the set-based equivalent of the m2m update done in `Dataset.save`: datasets whose
+    collection has a second part matching the name of a probe insertion or field of view of the
+    session are linked to those objects, replacing any previous links.
+
+    :param datasets: list of Dataset objects, all belonging to `session`
+    :param session: the Session the datasets belong to
+    """
+    from experiments.models import ProbeInsertion, FOV
+    names = {}
+    for dataset in datasets:
+        parts = dataset.collection.rsplit('/')
+        if len(parts) > 1:
+            names[dataset.pk] = parts[1]
+    if not names:
+        return
+    for model, field in ((ProbeInsertion, 'probeinsertion_id'), (FOV, 'fov_id')):
+        related = {}
+        query = model.objects.filter(session=session, name__in=set(names.values()))
+        for name, pk in query.values_list('name', 'pk'):
+            related.setdefault(name, set()).add(pk)
+        wanted = {(ds, pk) for ds, name in names.items() for pk in related.get(name, ())}
+        if not wanted:
+            continue
+        through = model.datasets.through
+        linked = through.objects.filter(dataset_id__in={ds for ds, _ in wanted})
+        current = {(ds, pk): id for id, ds, pk in linked.values_list('id', 'dataset_id', field)}
+        stale = [id for key, id in current.items() if key not in wanted]
+        if stale:
+            through.objects.filter(id__in=stale).delete()
+        through.objects.bulk_create(
+            [through(dataset_id=ds, **{field: pk}) for ds, pk in wanted - current.keys()])
+
+
+def _bulk_create_dataset_file_records(
+        files, session=None, user=None, repositories=None, exists_in=None, default=None):
+    """
+    Register many datasets and their file records using set-based queries.
+
+    This is the bulk equivalent of calling `_create_dataset_file_records` for each file: dataset
+    types, data formats, revisions, existing datasets and file records are resolved for the whole
+    batch in a handful of queries, then written with `bulk_create` / `bulk_update` in a single
+    transaction.  The batch must not contain the same collection and filename twice.
+
+    As with the sequential registration, files preceding an invalid one are registered and the
+    error response of the first invalid file is returned.
+
+    :param files: list of dicts with keys (filename, collection, revision, rel_dir_path, hash,
+     file_size, version, qc), as returned by `_get_name_collection_revision` plus file info
+    :param session: the Session the datasets belong to
+    :param user: the LabMember registering the datasets
+    :param repositories: list of DataRepository objects in which to create file records
+    :param exists_in: iterable of repositories in which the files exist
+    :param default: if True, the datasets are set as default and any other dataset revisions
+     with the same session, collection and name are no longer default
+    :return: list of registered Dataset objects
+    :return: a REST Response object if a dataset can't be registered, otherwise None
+    """
+    assert session is not None
+    exists_in = exists_in or ()
+    repositories = repositories or []
+    # Resolve the lookup tables for the whole batch
+    matcher = get_dataset_type_matcher()
+    extensions = {op.splitext(f['filename'])[-1] for f in files}
+    data_formats = {}
+    for data_format in DataFormat.objects.filter(file_extension__in=extensions):
+        data_formats.setdefault(data_format.file_extension, []).append(data_format)
+    revisions = {r.name: r for r in Revision.objects.filter(
+        name__in={f['revision'] for f in files if f['revision']})}
+    for name in {f['revision'] for f in files if f['revision']} - revisions.keys():
+        revisions[name], _ = Revision.objects.get_or_create(name=name)
+    # Fetch all candidate datasets of the session with their file records and protection status
+    existing = {}
+    candidates = Dataset.objects.filter(session=session, name__in={f['filename'] for f in files})
+    for dataset in candidates:
+        key = (dataset.collection, dataset.name, dataset.dataset_type_id,
+               dataset.data_format_id, dataset.revision_id)
+        existing.setdefault(key, []).append(dataset)
+    protected = set(Dataset.tags.through.objects.filter(
+        dataset__in=candidates, tag__protected=True).values_list('dataset_id', flat=True))
+    previous_defaults = [(ds.pk, ds.collection, ds.name) for ds in candidates
+                         if ds.default_dataset]
+    file_records = {}
+    for fr in FileRecord.objects.filter(dataset__in=candidates):
+        file_records[(fr.dataset_id, fr.data_repository_id, fr.relative_path)] = fr
+
+    datasets, new_datasets, updated_datasets, new_records, patched_records = [], [], [], [], []
+    resp = error = None
+    for f in files:
+        revision = revisions.get(f['revision'])
+        revision_name = f'#{revision.name}#' if revision else ''
+        relative_path = PurePosixPath(
+            f['rel_dir_path'], f['collection'], revision_name, f['filename'])
+        try:
+            dataset_type = match_dataset_type(f['filename'], matcher=matcher)
+            matches = data_formats.get(op.splitext(f['filename'])[-1], [])
+            if len(matches) != 1:
+                # Same errors as `get_data_format` for 0 or 2+ matching data formats
+                exc = DataFormat.MultipleObjectsReturned if matches else DataFormat.DoesNotExist
+                raise exc(f'{len(matches)} data formats found for filename "{f["filename"]}"')
+            data_format, = matches
+            assert dataset_type
+            assert data_format
+            key = (f['collection'], f['filename'], dataset_type.pk, data_format.pk,
+                   getattr(revision, 'pk', None))
+            matches = existing.get(key, [])
+            if len(matches) > 1:
+                raise Dataset.MultipleObjectsReturned(
+                    f'{len(matches)} datasets found for "{relative_path}"')
+        except Exception as ex:
+            # Raised once the preceding files are registered
+            error = ex
+            break
+        is_new = not matches
+        if is_new:
+            dataset = Dataset(collection=f['collection'], name=f['filename'], session=session,
+                              dataset_type=dataset_type, data_format=data_format,
+                              revision=revision)
+        else:
+            dataset, = matches
+            dataset.session, dataset.revision = session, revision
+        dataset.default_dataset = default is True
+        try:
+            dataset.qc = int(QC.validate(f['qc'] or 'NOT_SET'))
+        except ValueError:
+            data = {'status_code': 400,
+                    'detail': f'Invalid QC value "{f["qc"]}" for dataset "{relative_path}"'}
+            resp = Response(data=data, status=403)
+            break
+        # If the dataset already existed see if it is protected (i.e can't be overwritten)
+        if not is_new and dataset.pk in protected:
+            data = {'status_code': 403,
+                    'detail': 'Dataset ' + str(dataset.pk) + ' is protected, cannot patch'}
+            resp = Response(data=data, status=403)
+            break
+        dataset.created_by = user
+        if f['version']:
+            dataset.version = f['version']
+        # See `_create_dataset_file_records` regarding the hash and patching logic
+        is_patched = True
+        if f['hash']:
+            if dataset.hash:
+                is_patched = not dataset.hash == f['hash']
+            dataset.hash = f['hash']
+        if f['file_size'] is not None:
+            dataset.file_size = f['file_size']
+        # Validate the fields; related objects and uniqueness are enforced by the database
+        dataset.full_clean(exclude=_relation_fields(Dataset), validate_unique=False)
+        datasets.append(dataset)
+        if is_new:
+            new_datasets.append(dataset)
+        else:
+            updated_datasets.append(dataset)
+
+        # One file record per repository
+        for repo in repositories:
+            fr = file_records.get((dataset.pk, repo.pk, relative_path.as_posix()))
+            if fr is None:
+                fr = FileRecord(dataset=dataset, data_repository=repo,
+                                relative_path=relative_path.as_posix())
+                new_records.append(fr)
+            elif is_patched:
+                patched_records.append(fr)
+            else:
+                continue
+            fr.exists = repo in exists_in
+            fr.json = None  # this is important if a dataset is patched during an ongoing transfer
+            fr.clean_fields(exclude=_relation_fields(FileRecord))
+
+    with transaction.atomic():
+        # Only the datasets preceding an invalid file are registered
+        if default and datasets:
+            keys = {(ds.collection, ds.name) for ds in datasets}
+            previous = [pk for pk, *key in previous_defaults if tuple(key) in keys]
+            if previous:
+                Dataset.objects.filter(pk__in=previous).update(default_dataset=False)
+        Dataset.objects.bulk_create(new_datasets)
+        # NB: bulk_update doesn't trigger the auto_now field update
+        now = timezone.now()
+        for dataset in updated_datasets:
+            dataset.auto_datetime = now
+        Dataset.objects.bulk_update(updated_datasets, fields=(
+            'default_dataset', 'qc', 'created_by', 'version', 'hash', 'file_size',
+            'auto_datetime'))
+        _link_dataset_collections(datasets, session)
+        FileRecord.objects.bulk_create(new_records)
+        FileRecord.objects.bulk_update(patched_records, fields=('exists', 'json'))
+    if error is not None:
+        raise error
+    return datasets, resp
+
+
 def iter_registered_directories(data_repository=None, tc=None, path=None):
     """Iterater over pairs (globus dir path, [list of files]) in any directory that
     contains session.metadat.json."""
@@ -409,7 +724,36 @@ def transfers_required(dataset):
         }
 
 
-def bulk_sync(dry_run=False, lab=None, gc=None, check_mismatch=False):
+def _globus_ls(gc, endpoint_id, path, retries=None, use_cache=True):
+    """
+    Lists the files of a Globus directory, retrying transient errors with an exponential backoff.
+    :param gc: globus transfer client
+    :param endpoint_id: globus endpoint of the directory
+    :param path: absolute path of the directory on the endpoint
+    :param retries: number of retries of network and server errors, defaults to
+     GLOBUS_LS_RETRIES
+    :param use_cache: if False, the cached listing of the directory is not used
+    :return: dict {file name: file size}, empty if the directory could not be listed, None if
+     the retries of a transient error were exhausted
+    """
+    retries = GLOBUS_LS_RETRIES if retries is None else retries
+    for attempt in range(retries + 1):
+        try:
+            return {f['name']: f['size'] for f in globus_ls(gc, endpoint_id, path, use_cache)}
+        except (globus_sdk.TransferAPIError, globus_sdk.NetworkError) as e:
+            transient = (isinstance(e, globus_sdk.NetworkError) or
+                         e.http_status == 429 or e.http_status >= 500)
+            if not transient:
+                logger.warning('ls %s on %s failed: %s', path, endpoint_id, e)
+                return {}
+            if attempt == retries:
+                logger.warning('ls %s on %s failed after %i retries: %s',
+                               path, endpoint_id, retries, e)
+                return None
+        time.sleep(GLOBUS_LS_BACKOFF * 2 ** attempt)
+
+
+def bulk_sync(dry_run=False, lab=None, gc=None, check_mismatch=False, workers=None):
     """
     updates the Alyx database file records field 'exists' by looking at each Globus repository.
     This is meant to be launched before the transfer() function
@@ -418,7 +762,11 @@ def bulk_sync(dry_run=False, lab=None, gc=None, check_mismatch=False):
     The algorithm looks at datasets for which the server data file does not exist. For each
         -   the locals filerecords are checked and their exist flag updated
         -   the server filerecords that have a json__transfer_pending=True flag are checked and
-    their exist flags updated
+    their exist flags updated, after the Globus transfer tasks are polled: the file records of
+    the unfinished tasks are not checked
+    The file records are grouped by directory, the directories are listed concurrently and the
+    changes are written with a few bulk updates. The file records of the directories that can't
+    be listed because of network or server errors are left unchanged.
     :param dry_run (False) just prints the files if True
     :param lab (optional) specific lab name only
     :param gc (optional) globus transfer client. If not given will instantiated within fucntion
@@ -426,6 +774,7 @@ def bulk_sync(dry_run=False, lab=None, gc=None, check_mismatch=False):
     :param check_mismatch: (False) if set to True, will add to the queries filerecords existing
      on SDSC but labeled as mismatched hash
     for patching files
+    :param workers (optional) number of concurrent Globus ls calls, defaults to GLOBUS_LS_WORKERS
     """
     if check_mismatch:
         dfs = FileRecord.objects.filter(
@@ -443,9 +792,12 @@ def bulk_sync(dry_run=False, lab=None, gc=None, check_mismatch=False):
     all_files = FileRecord.objects.filter(
         dataset__in=dsets).order_by('-dataset__created_datetime')
     # checks all local files by default, and only transfer pending files for the server
+    # the pending files of unfinished Globus tasks are left to poll_globus_tasks
+    tracked = GlobusTransferTask.file_records.through.objects.filter(
+        filerecord=OuterRef('pk'), globustransfertask__status__in=GlobusTransferTask.UNFINISHED)
     all_files = all_files.filter(
         Q(data_repository__globus_is_personal=True) |
-        Q(json__has_key="transfer_pending"))
+        (Q(json__has_key="transfer_pending") & ~Exists(tracked)))
     if dry_run:
         fvals = all_files.values_list('relative_path', flat=True).distinct()
         for fval in list(fvals):
@@ -453,85 +805,118 @@ def bulk_sync(dry_run=False, lab=None, gc=None, check_mismatch=False):
         return fvals
 
     gc = gc or globus_transfer_client()
-    # loop over all files concerned by a transfer and update the exists and filesize fields
-    files_to_ls = all_files.order_by('data_repository__globus_endpoint_id', 'relative_path')
-    _last_ep = None
-    _last_path = None
-    nfiles = files_to_ls.count()
-    c = 0
+    poll_globus_tasks(gc, workers=workers)
+    # group the files concerned by a transfer by endpoint and directory
+    files_to_ls = all_files.select_related('dataset').order_by(
+        'data_repository__globus_endpoint_id', 'relative_path')
+    directories = defaultdict(list)
+    datasets = {}  # the records of a dataset share its instance
     for qf in files_to_ls:
-        c += 1
-        # if the last endpoint has already been queried, do not repeat the query
-        if _last_ep != qf.data_repository.globus_endpoint_id:
-            _last_ep = qf.data_repository.globus_endpoint_id
-            ep_info = gc.get_endpoint(_last_ep)
-        # if the endpoint is not connected skip
-        # NB: the non-personal endpoints have a None so need to explicitly test for False
-        if ep_info['gcp_connected'] is False:
+        qf.dataset = datasets.setdefault(qf.dataset_id, qf.dataset)
+        cpath = qf.data_repository.globus_path + os.path.split(qf.relative_path)[0]
+        directories[(qf.data_repository.globus_endpoint_id, cpath)].append(qf)
+    # if the endpoint is not connected skip
+    # NB: the non-personal endpoints have a None so need to explicitly test for False
+    connected = {}
+    for ep in sorted({ep for ep, _ in directories}, key=str):
+        ep_info = gc.get_endpoint(ep)
+        connected[ep] = ep_info['gcp_connected'] is not False
+        if not connected[ep]:
             logger.warning('UNREACHABLE Endpoint "' + ep_info['display_name'] +
-                           '" (' + str(_last_ep) + ') ' + qf.relative_path)
+                           '" (' + str(ep) + ')')
+    to_ls = [d for d in directories if connected[d[0]]]
+    print('ls ' + str(len(to_ls)) + ' directories on ' + str(sum(connected.values())) +
+          ' endpoints')
+    workers = workers or GLOBUS_LS_WORKERS
+    # the directories of the pending transfers are listed live so that their completion isn't
+    # missed for the lifetime of a cached listing
+    live = {d for d, qfs in directories.items()
+            if any(qf.data_repository.globus_is_personal is False for qf in qfs)}
+    stats = globus_ls_stats.copy()
+    with ThreadPoolExecutor(max(1, min(workers, len(to_ls)))) as executor:
+        listings = dict(zip(to_ls, executor.map(
+            lambda d: _globus_ls(gc, *d, use_cache=d not in live), to_ls)))
+    # the directories that failed transiently are unknown rather than empty
+    listings = {d: ls for d, ls in listings.items() if ls is not None}
+    stats = globus_ls_stats - stats
+    print('ls cache: ' + str(stats['hits']) + ' hits, ' + str(stats['misses']) + ' misses')
+
+    # compare the files against the ls lists, update the exists and file_size fields
+    changed_files, changed_datasets, cleared_datasets = [], {}, set()
+    for (ep, cpath), qfs in directories.items():
+        if (ep, cpath) not in listings:
             continue
-        # if we already listed the current path of the endpoint, do not repeat the rest ls command
-        cpath, fil = os.path.split(qf.relative_path)
-        fil_uuid = add_uuid_string(fil, qf.dataset_id).as_posix()
-        cpath = qf.data_repository.globus_path + cpath
-        if _last_path != cpath:
-            _last_path = cpath
-            try:
-                print(str(c) + '/' + str(nfiles) + ' ls ' + cpath + ' on ' + str(_last_ep))
-                ls_result = gc.operation_ls(_last_ep, path=_last_path)
-            except globus_sdk.TransferAPIError:
-                ls_result = []
-        # compare the current file against the ls list, update the file_size if necessary
-        exists = False
-        for ind, gfil in enumerate(ls_result):
-            if gfil['name'] in (fil_uuid, fil):
-                exists = True
-                if qf.dataset.file_size != gfil['size']:
-                    qf.dataset.file_size = gfil['size']
-                    qf.dataset.save()
-                break
-        # update the filerecord exists field if needed
-        if qf.exists != exists:
-            qf.exists = exists
-            qf.save()
-            # sets the json field to None so that the transfer pending flag is nulled
-            if exists:
-                qf.dataset.file_records.update(json=None)
-            print(str(c) + '/' + str(nfiles) + ' ' + str(qf.data_repository.name) + ':' +
-                  qf.relative_path + ' exist set to ' + str(exists) + ' in Alyx')
+        ls_result = listings[(ep, cpath)]
+        for qf in qfs:
+            fil = os.path.split(qf.relative_path)[1]
+            fil_uuid = add_uuid_string(fil, qf.dataset_id).as_posix()
+            name = next((n for n in (fil_uuid, fil) if n in ls_result), None)
+            exists = name is not None
+            if exists and qf.dataset.file_size != ls_result[name]:
+                qf.dataset.file_size = ls_result[name]
+                changed_datasets[qf.dataset_id] = qf.dataset
+            if qf.exists != exists:
+                qf.exists = exists
+                changed_files.append(qf)
+                # saving a file record updates the dataset modification time
+                changed_datasets[qf.dataset_id] = qf.dataset
+                # the json field is set to None so that the transfer pending flag is nulled
+                if exists:
+                    cleared_datasets.add(qf.dataset_id)
+                print(str(qf.data_repository.name) + ':' + qf.relative_path +
+                      ' exist set to ' + str(exists) + ' in Alyx')
+
+    # NB: bulk_update doesn't trigger the auto_now field update
+    now = timezone.now()
+    for dataset in changed_datasets.values():
+        dataset.auto_datetime = now
+    cleared_datasets = list(cleared_datasets)
+    with transaction.atomic():
+        FileRecord.objects.bulk_update(changed_files, fields=('exists',),
+                                       batch_size=BULK_BATCH_SIZE)
+        for i in range(0, len(cleared_datasets), BULK_BATCH_SIZE):
+            FileRecord.objects.filter(
+                dataset__in=cleared_datasets[i:i + BULK_BATCH_SIZE]).update(json=None)
+        Dataset.objects.bulk_update(changed_datasets.values(),
+                                    fields=('file_size', 'auto_datetime'),
+                                    batch_size=BULK_BATCH_SIZE)
 
 
 def _filename_from_file_record(fr, add_uuid=False):
     fn = fr.data_repository.globus_path + fr.relative_path
     if add_uuid:
-        fn = add_uuid_string(fn, fr.dataset.pk).as_posix()
+        fn = add_uuid_string(fn, fr.dataset_id).as_posix()
     return fn
 
 
-def bulk_transfer(dry_run=False, lab=None, gc=None):
+def bulk_transfer(dry_run=False, lab=None, gc=None, max_tasks=None, max_items=None):
     """
     uploads files from a local Globus repository to a main repository if the file on the main
     repository does not exist.
     should be launched after bulk_sync() functions
+    The files of each pair of repositories are split into several tasks of balanced size so that
+    big raw ephys files don't hold the transfer of small behaviour/training files
+    :param max_tasks (optional) maximum number of tasks per pair of repositories
+    :param max_items (optional) maximum number of files per task
     """
-    # splits the jobs in one for small files and another for big files so that big raw
-    # ephys files don't hold the transfer of small behaviour/training files
-    _bulk_transfer(dry_run=dry_run, lab=lab, maxsize=1024 ** 3, gc=gc)
-    _bulk_transfer(dry_run=dry_run, lab=lab, minsize=1024 ** 3, gc=gc)
+    _bulk_transfer(dry_run=dry_run, lab=lab, gc=gc, max_tasks=max_tasks, max_items=max_items)
 
 
-def _bulk_transfer(dry_run=False, lab=None, maxsize=None, minsize=None, gc=None):
+def _bulk_transfer(dry_run=False, lab=None, maxsize=None, minsize=None, gc=None,
+                   max_tasks=None, max_items=None):
     """
-    Transfer in bulk data to Flat Iron. 2 transfers are created according to file-size so that
-    smaller files get in earlier. The query of data/.FileRecord records to transfer is based
+    Transfer in bulk data to Flat Iron. The query of data/.FileRecord records to transfer is based
     on the exists flag (True) and the globus personal (False).
     :param dry_run: (bool)
     :param lab: (str) lab name: only transfer files from this lab
     :param maxsize: (int) maximum file size for transfer (allows to split small and big transfers)
     :param minsize: (int) minimum file size for transfer (see above)
     :param gc (optional) globus transfer client.
-    :return: globus_client, transfer_matrix (an array of transfer objects)
+    :param max_tasks (optional) maximum number of tasks per pair of repositories, defaults to
+     GLOBUS_TRANSFER_TASKS
+    :param max_items (optional) maximum number of files per task, defaults to
+     GLOBUS_TRANSFER_MAX_ITEMS
+    :return: globus_client, TransferPlan
     """
     dfs = FileRecord.objects.filter(
         (Q(exists=False, data_repository__globus_is_personal=False,
@@ -543,85 +928,334 @@ def _bulk_transfer(dry_run=False, lab=None, maxsize=None, minsize=None, gc=None)
         dfs = dfs.filter(dataset__file_size__gt=minsize)
     if maxsize:
         dfs = dfs.exclude(dataset__file_size__gt=maxsize)
-    if not dfs:
+    if not dfs.exists():
         return
     if lab:
         dfs = dfs.filter(data_repository__lab__name=lab)
-    gc, tm = _globus_transfer_filerecords(dfs, dry=dry_run, gc=gc)
-    return gc, tm
+    gc, plan = _globus_transfer_filerecords(dfs, dry=dry_run, gc=gc,
+                                            max_tasks=max_tasks, max_items=max_items)
+    return gc, plan
 
 
-def _globus_transfer_filerecords(dfs, dry=True, gc=None):
+def _pack_by_size(sizes, max_bins, max_items):
     """
-    Transfers the file records. The query set has to contain only is_globus_personal=False flag
-    (ie. they are server side file records). The algorithm creates a transfer object for each
-    unique pair of globus source / globus destination ids and launches the transfers at the end.
-    :param dfs: file records queryset
-    :param dry:
-    :param gc (optional) globus transfer client. If not given will instantiated within function
-    :return: globus_client, transfer_matrix (an array of transfer objects)
-    """
-    gc = None if dry else gc or globus_transfer_client()
-    dfs = dfs.order_by('data_repository__globus_endpoint_id', 'relative_path')
-    pri_repos = DataRepository.objects.filter(globus_is_personal=False, name__icontains='flatiron')
-    sec_repos = DataRepository.objects.filter(globus_is_personal=True)
-    tm = np.zeros([pri_repos.count(), sec_repos.count()], dtype=object)
-    nfiles = dfs.count()
-    c = 0
-    # create the tasks
+    Splits items into bins of balanced total size: from the largest item down, each item goes to
+    the bin with the smallest total that isn't full, or with the fewest items for equal totals.
+    :param sizes: list of item sizes
+    :param max_bins: maximum number of bins, exceeded only if needed to hold all the items
+    :param max_items: maximum number of items per bin
+    :return: list of the lists of item indices of the bins
+    """
+    nbins = min(max(max_bins, -(-len(sizes) // max_items)), len(sizes))
+    bins = [[] for _ in range(nbins)]
+    heap = [(0, 0, i) for i in range(nbins)]
+    for j in sorted(range(len(sizes)), key=lambda j: -sizes[j]):
+        total, count, i = heapq.heappop(heap)
+        bins[i].append(j)
+        if count + 1 < max_items:
+            heapq.heappush(heap, (total + sizes[j], count + 1, i))
+    return [sorted(b) for b in bins]
+
+
+class TransferPlan:
+    """
+    The Globus transfers of server file records from the personal repositories holding their
+    dataset, with one transfer per pair of source / destination repositories. The files of a
+    transfer are submitted as several Globus tasks of balanced size.
+    The plan is built by `plan_transfers` and can be inspected before being submitted.
+    """
+
+    def __init__(self, destination_repositories, source_repositories, max_tasks=None,
+                 max_items=None):
+        """
+        :param destination_repositories: list of server data repositories
+        :param source_repositories: list of personal data repositories
+        :param max_tasks: maximum number of tasks per transfer, defaults to GLOBUS_TRANSFER_TASKS
+        :param max_items: maximum number of files per task, defaults to GLOBUS_TRANSFER_MAX_ITEMS
+        """
+        self.destination_repositories = list(destination_repositories)
+        self.source_repositories = list(source_repositories)
+        self.max_tasks = max_tasks or GLOBUS_TRANSFER_TASKS
+        self.max_items = max_items or GLOBUS_TRANSFER_MAX_ITEMS
+        # (source repository, destination repository) -> list of (source path, destination path)
+        self.transfers = defaultdict(list)
+        # (source repository, destination repository) -> list of destination file records
+        self.transfer_file_records = defaultdict(list)
+        self.file_records = []  # the destination file records of the transfers
+        self.missing = []  # the file records whose dataset has no existing file to transfer
+        self.skipped = []  # the file records whose source or destination is not in the plan
+
+    def __len__(self):
+        return len(self.file_records)
+
+    def __str__(self):
+        lines = ['%s: %d files, %.3f GB' % (
+            task['label'], len(task['DATA']), task['file_size'] / 1024 ** 3)
+            for task in self.tasks()]
+        lines.append('%d files to transfer, %d missing, %d skipped' % (
+            len(self), len(self.missing), len(self.skipped)))
+        return '\n'.join(lines)
+
+    @staticmethod
+    def label(source, destination):
+        return source.name + ' to ' + destination.name
+
+    def add(self, file_record, source_file_record):
+        """
+        Add the transfer of a file record from an existing file record of its dataset. The size
+        of the file is read from the `file_size` attribute of the file record, if any.
+        """
+        key = (source_file_record.data_repository, file_record.data_repository)
+        self.transfers[key].append((_filename_from_file_record(source_file_record),
+                                    _filename_from_file_record(file_record, add_uuid=True)))
+        self.transfer_file_records[key].append(file_record)
+        self.file_records.append(file_record)
+
+    @property
+    def matrix(self):
+        """
+        The transfers as an array (destination repositories x source repositories) of dicts
+        with the source and destination endpoints, the label and the DATA items of the transfer,
+        and 0 for the pairs of repositories without any file to transfer.
+        """
+        idst = {r.pk: i for i, r in enumerate(self.destination_repositories)}
+        isrc = {r.pk: i for i, r in enumerate(self.source_repositories)}
+        tm = np.zeros([len(idst), len(isrc)], dtype=object)
+        for (src, dst), items in self.transfers.items():
+            tm[idst[dst.pk]][isrc[src.pk]] = {
+                'source_endpoint': src.globus_endpoint_id,
+                'destination_endpoint': dst.globus_endpoint_id,
+                'label': self.label(src, dst),
+                'DATA': [{'source_path': s, 'destination_path': d} for s, d in items]}
+        return tm
+
+    def tasks(self):
+        """
+        Splits each transfer into up to max_tasks tasks of at most max_items files, balancing
+        the number of bytes to transfer per task.
+        :return: list of dicts with the source and destination repositories, the label, the
+         DATA items, the destination file records and the file size in bytes of the tasks
+        """
+        tasks = []
+        for (src, dst), items in self.transfers.items():
+            file_records = self.transfer_file_records[(src, dst)]
+            sizes = [getattr(fr, 'file_size', None) or 0 for fr in file_records]
+            bins = _pack_by_size(sizes, self.max_tasks, self.max_items)
+            for n, indices in enumerate(bins):
+                label = self.label(src, dst)
+                if len(bins) > 1:
+                    label += ' part %d of %d' % (n + 1, len(bins))
+                tasks.append({
+                    'source_repository': src,
+                    'destination_repository': dst,
+                    'label': label,
+                    'DATA': [{'source_path': items[i][0], 'destination_path': items[i][1]}
+                             for i in indices],
+                    'file_records': [file_records[i] for i in indices],
+                    'file_size': sum(sizes[i] for i in indices)})
+        return tasks
+
+    def transfer_data(self, gc, tasks=None):
+        """Iterate over the globus TransferData objects of the tasks."""
+        for task in tasks or self.tasks():
+            tdata = globus_sdk.TransferData(
+                gc,
+                source_endpoint=task['source_repository'].globus_endpoint_id,
+                destination_endpoint=task['destination_repository'].globus_endpoint_id,
+                verify_checksum=True,
+                sync_level='checksum',
+                label=task['label'])
+            for item in task['DATA']:
+                tdata.add_item(**item)
+            yield tdata
+
+    def submit(self, gc):
+        """
+        Submits the transfers and registers their Globus tasks, then flags the transferred file
+        records as pending and the ones without any existing file as missing.
+        :param gc: globus transfer client
+        :return: list of the globus responses of the submitted transfers
+        """
+        tasks = self.tasks()
+        responses = [gc.submit_transfer(tdata) for tdata in self.transfer_data(gc, tasks)]
+        registered = [GlobusTransferTask(
+            task_id=response['task_id'], name=task['label'],
+            source_repository=task['source_repository'],
+            destination_repository=task['destination_repository'])
+            for task, response in zip(tasks, responses)]
+        GlobusTransferTask.objects.bulk_create(registered)
+        membership = GlobusTransferTask.file_records.through
+        membership.objects.bulk_create(
+            [membership(globustransfertask_id=gtask.pk, filerecord_id=fr.pk)
+             for gtask, task in zip(registered, tasks)
+             for fr in task['file_records']], batch_size=BULK_BATCH_SIZE)
+        for (_, dst), items in self.transfers.items():
+            invalidate_globus_ls(dst.globus_endpoint_id, [d for _, d in items])
+        _update_by_pk(FileRecord, [fr.pk for fr in self.missing], json={'local_missing': True})
+        # Saving a file record used to update the modification time of its dataset
+        _update_by_pk(Dataset, {fr.dataset_id for fr in self.missing},
+                      auto_datetime=timezone.now())
+        _update_by_pk(FileRecord, [fr.pk for fr in self.file_records],
+                      json={'transfer_pending': True})
+        return responses
+
+
+def _update_by_pk(model, pks, **kwargs):
+    """Update the objects with the given primary keys, in batches of BULK_BATCH_SIZE."""
+    pks = list(pks)
+    for i in range(0, len(pks), BULK_BATCH_SIZE):
+        model.objects.filter(pk__in=pks[i:i + BULK_BATCH_SIZE]).update(**kwargs)
+
+
+def plan_transfers(dfs, max_tasks=None, max_items=None):
+    """
+    Plans the transfers of server file records from the personal repositories. The source of a
+    file record is the first existing file record of its dataset outside of AWS.
+    :param dfs: file records queryset, on the server (flatiron) data repositories
+    :param max_tasks: maximum number of tasks per pair of repositories
+    :param max_items: maximum number of files per task
+    :return: TransferPlan
+    """
+    dfs = list(dfs.annotate(file_size=F('dataset__file_size')).order_by(
+        'data_repository__globus_endpoint_id', 'relative_path'))
+    pri_repos = {r.pk: r for r in DataRepository.objects.filter(
+        globus_is_personal=False, name__icontains='flatiron')}
+    sec_repos = {r.pk: r for r in DataRepository.objects.filter(globus_is_personal=True)}
+    # the existing file records of all the datasets, the first one by pk is the source
+    dataset_ids = list({fr.dataset_id for fr in dfs})
+    sources = {}
+    for i in range(0, len(dataset_ids), BULK_BATCH_SIZE):
+        existing = FileRecord.objects.filter(
+            ~Q(data_repository__name__icontains='aws'), exists=True,
+            dataset__in=dataset_ids[i:i + BULK_BATCH_SIZE]).order_by('pk')
+        for fr in existing:
+            sources.setdefault(fr.dataset_id, fr)
+    plan = TransferPlan(pri_repos.values(), sec_repos.values(), max_tasks=max_tasks,
+                        max_items=max_items)
     for ds in dfs:
-        c += 1
-        ipri = [ind for ind, cr in enumerate(pri_repos) if cr == ds.data_repository][0]
-        src_file = ds.dataset.file_records.filter(~Q(data_repository__name__icontains='aws'),
-                                                  exists=True).first()
+        src_file = sources.get(ds.dataset_id)
         if not src_file:
             logger.warning(str(ds.data_repository.name) + ':' + ds.relative_path +
                            ' is nowhere to ' + 'be found in local AND remote repositories')
-            ds.json = {'local_missing': True}
-            ds.save()
-            continue
-        isec = next((ind for ind, cr in enumerate(sec_repos) if cr == src_file.data_repository),
-                    None)
-        if isec is None:
-            print("no _isec")
-            continue
-        # if the transfer doesn't exist, create it:
-        if tm[ipri][isec] == 0:
-            label = sec_repos[isec].name + ' to ' + pri_repos[ipri].name
-            if not dry:
-                tm[ipri][isec] = globus_sdk.TransferData(
-                    gc,
-                    source_endpoint=sec_repos[isec].globus_endpoint_id,
-                    destination_endpoint=pri_repos[ipri].globus_endpoint_id,
-                    verify_checksum=True,
-                    sync_level='checksum',
-                    label=label)
-            # If dry make a fake transfer client dict
-            else:
-                tm[ipri][isec] = {'source_endpoint': sec_repos[isec].globus_endpoint_id,
-                                  'destination_endpoint': pri_repos[ipri].globus_endpoint_id,
-                                  'label': label,
-                                  'DATA': []}
-
-        # add the transfer to the current task
-        destination_file = _filename_from_file_record(ds, add_uuid=True)
-        source_file = _filename_from_file_record(src_file)
-        if not dry:
-            tm[ipri][isec].add_item(source_path=source_file, destination_path=destination_file)
+            plan.missing.append(ds)
+        elif (ds.data_repository_id not in pri_repos or
+                src_file.data_repository_id not in sec_repos):
+            plan.skipped.append(ds)
         else:
-            tm[ipri][isec]['DATA'].append({'source_path': source_file,
-                                           'destination_path': destination_file})
+            plan.add(ds, src_file)
+    return plan
+
 
-        print(str(c) + '/' + str(nfiles) + ' ' + source_file + ' to ' + destination_file)
-    # launch the transfer tasks
+def _globus_transfer_filerecords(dfs, dry=True, gc=None, max_tasks=None, max_items=None):
+    """
+    Transfers the file records. The query set has to contain only is_globus_personal=False flag
+    (ie. they are server side file records). The algorithm creates transfer objects for each
+    unique pair of globus source / globus destination ids and launches the transfers at the end.
+    :param dfs: file records queryset
+    :param dry: if True, only plan the transfers
+    :param gc (optional) globus transfer client. If not given will instantiated within function
+    :param max_tasks (optional) maximum number of tasks per pair of globus ids
+    :param max_items (optional) maximum number of files per task
+    :return: globus_client (None if dry), TransferPlan
+    """
+    plan = plan_transfers(dfs, max_tasks=max_tasks, max_items=max_items)
+    print(plan)
     if dry:
-        return None, tm
-    for t in tm.flatten():
-        if t == 0:
-            continue
-        gc.submit_transfer(t)
-    dfs.exclude(json__has_key="local_missing").update(json={'transfer_pending': True})
-    return gc, tm
+        return None, plan
+    gc = gc or globus_transfer_client()
+    plan.submit(gc)
+    return gc, plan
+
+
+def _globus_successful_transfers(gc, task_id):
+    """
+    Lists the files transferred by a Globus task, page by page.
+    :param gc: globus transfer client
+    :param task_id: globus task id
+    :return: set of the destination paths of the successful transfers, None if the task API
+     call failed
+    """
+    paths, marker = set(), None
+    try:
+        while True:
+            response = gc.task_successful_transfers(task_id, marker=marker)
+            paths.update(item['destination_path'] for item in response['DATA'])
+            marker = response.get('next_marker')
+            if not marker:
+                return paths
+    except (globus_sdk.GlobusAPIError, globus_sdk.NetworkError) as e:
+        logger.warning('Successful transfers of task %s failed: %s', task_id, e)
+
+
+def poll_globus_tasks(gc=None, workers=None):
+    """
+    Updates the unfinished Globus transfer tasks from the Globus task API, instead of listing
+    the destination directories of their file records:
+        -   the task statuses are fetched in batches of GLOBUS_TASK_BATCH_SIZE tasks
+        -   the successful transfers of the finished tasks are listed concurrently, their file
+    records are set to exist and their transfer pending flag is nulled
+        -   the other file records of the finished tasks have their transfer pending flag
+    nulled so that the next bulk transfer submits them again
+    :param gc (optional) globus transfer client. If not given will instantiated within function
+    :param workers (optional) number of concurrent Globus calls, defaults to GLOBUS_LS_WORKERS
+    :return: Counter of the statuses of the polled tasks
+    """
+    tasks = {str(t.task_id): t for t in GlobusTransferTask.objects.filter(
+        status__in=GlobusTransferTask.UNFINISHED)}
+    if not tasks:
+        return Counter()
+    gc = gc or globus_transfer_client()
+    task_ids = list(tasks)
+    changed_tasks = []
+    for i in range(0, len(task_ids), GLOBUS_TASK_BATCH_SIZE):
+        batch = task_ids[i:i + GLOBUS_TASK_BATCH_SIZE]
+        response = gc.task_list(filter='task_id:' + ','.join(batch), limit=len(batch))
+        for info in response['DATA']:
+            task = tasks.get(info['task_id'])
+            if task is not None and task.status != info['status']:
+                task.status = info['status']
+                changed_tasks.append(task)
+    finished = [t for t in changed_tasks if t.status not in GlobusTransferTask.UNFINISHED]
+    workers = workers or GLOBUS_LS_WORKERS
+    with ThreadPoolExecutor(max(1, min(workers, len(finished)))) as executor:
+        transferred = dict(zip(finished, executor.map(
+            lambda t: _globus_successful_transfers(gc, str(t.task_id)), finished)))
+    # the tasks whose transfers could not be listed are polled again next time
+    for task, paths in transferred.items():
+        if paths is None:
+            changed_tasks.remove(task)
+    finished = [t for t in finished if transferred[t] is not None]
+
+    # the file records of the finished tasks, split by whether their file was transferred
+    exist_files, failed_files, datasets = [], [], set()
+    membership = GlobusTransferTask.file_records.through.objects.select_related(
+        'filerecord__data_repository')
+    for i in range(0, len(finished), BULK_BATCH_SIZE):
+        batch = {t.pk: t for t in finished[i:i + BULK_BATCH_SIZE]}
+        for m in membership.filter(globustransfertask__in=list(batch)):
+            fr = m.filerecord
+            if _filename_from_file_record(fr, add_uuid=True) in transferred[
+                    batch[m.globustransfertask_id]]:
+                exist_files.append(fr.pk)
+                datasets.add(fr.dataset_id)
+            else:
+                failed_files.append(fr.pk)
+                logger.warning(str(fr.data_repository.name) + ':' + fr.relative_path +
+                               ' was not transferred')
+    now = timezone.now()
+    for task in finished:
+        task.completed_datetime = now
+    with transaction.atomic():
+        _update_by_pk(FileRecord, failed_files, json=None)
+        _update_by_pk(FileRecord, exist_files, exists=True, json=None)
+        # saving a file record updates the dataset modification time
+        _update_by_pk(Dataset, datasets, auto_datetime=now)
+        GlobusTransferTask.objects.bulk_update(
+            changed_tasks, fields=('status', 'completed_datetime'), batch_size=BULK_BATCH_SIZE)
+    statuses = Counter(t.status for t in tasks.values())
+    print('polled ' + str(len(tasks)) + ' globus tasks: ' + str(dict(statuses)) + ', ' +
+          str(len(exist_files)) + ' files transferred, ' + str(len(failed_files)) + ' failed')
+    return statuses
 
 
 def _get_session(subject=None, date=None, number=None, user=None):
@@ -657,11 +1291,11 @@ def globus_transfer_datasets(dsets, dry=True):
     """
     :param dsets: Dataset queryset
     :param dry:
-    :return: globus_client, transfer_matrix (an array of transfer objects)
+    :return: globus_client, TransferPlan
     """
     frecs = FileRecord.objects.filter(data_repository__globus_is_personal=False, dataset__in=dsets)
-    gc, tm = _globus_transfer_filerecords(frecs, dry=dry)
-    return gc, tm
+    gc, plan = _globus_transfer_filerecords(frecs, dry=dry)
+    return gc, plan
 
 
 def globus_delete_local_datasets(datasets, dry=True, gc=None, label=None):
@@ -690,8 +1324,8 @@ def globus_delete_local_datasets(datasets, dry=True, gc=None, label=None):
         for ntry in range(3):
             try:
                 path = Path(_filename_from_file_record(file_record, add_uuid=add_uuid))
-                ls_obj = gtc.operation_ls(file_record.data_repository.globus_endpoint_id,
-                                          path=path.parent)
+                ls_obj = globus_ls(gtc, file_record.data_repository.globus_endpoint_id,
+                                   path.parent, use_cache=False)
             except globus_sdk.TransferAPIError as err:
                 logger.warning('Globus error trial %i/%i', ntry + 1, N_RETRIES, exc_info=err)
                 if 'ClientError.NotFound' in str(err):
@@ -701,9 +1335,10 @@ def globus_delete_local_datasets(datasets, dry=True, gc=None, label=None):
                 time.sleep(2)
                 continue
             break
-        return [ls for ls in ls_obj['DATA'] if ls['name'] == path.name]
+        return [ls for ls in ls_obj if ls['name'] == path.name]
     # appends each file for deletion
     fr2delete = []
+    deleted_paths = defaultdict(list)  # Globus endpoint UUID -> deleted file paths
     for ds in datasets:
         # check the existence of the server file
         fr_server = ds.file_records.filter(exists=True,
@@ -736,6 +1371,7 @@ def globus_delete_local_datasets(datasets, dry=True, gc=None, label=None):
             del_client = delete_clients[(gid := frloc.data_repository.globus_endpoint_id)]
             assert del_client['endpoint'] == str(gid)
             del_client.add_item(file2del)
+            deleted_paths[gid].append(file2del)
             logger.info('DELETE: ' + _filename_from_file_record(frloc))
     # launch the deletion jobs and remove records from the database
     if dry:
@@ -744,6 +1380,8 @@ def globus_delete_local_datasets(datasets, dry=True, gc=None, label=None):
     for dc in filter(lambda x: x['DATA'], delete_clients.values()):
         logger.info('Submitting delete for %i file(s) on %s', len(dc['DATA']), dc['endpoint'])
         gtc.submit_delete(dc)
+    for gid, paths in deleted_paths.items():
+        invalidate_globus_ls(gid, paths)
     # remove file records
     frecs = FileRecord.objects.filter(id__in=fr2delete).exclude(
         data_repository__globus_is_personal=False)
@@ -794,6 +1432,7 @@ def globus_delete_file_records(file_records, dry=True, gc=None, label=None):
     # create a globus delete_client for each globus endpoint
     gtc = gc or globus_transfer_client()
     delete_clients = []
+    deleted_paths = defaultdict(list)  # Globus endpoint UUID -> deleted file paths
     if not dry:
         # delete_clients = []
         for ge in globus_endpoints:
@@ -825,7 +1464,7 @@ def globus_delete_file_records(file_records, dry=True, gc=None, label=None):
                     current_path = Path(file2del).parent
                     try:
                         ls_current_path = [f['name'] for f in
-                                           gtc.operation_ls(ge, path=current_path)]
+                                           globus_ls(gtc, ge, current_path, use_cache=False)]
                     except globus_sdk.TransferAPIError as err:
                         if 'ClientError.NotFound' in str(err):
                             logger.warning('DIR NOT FOUND: ' + file2del + ' on ' +
@@ -837,6 +1476,7 @@ def globus_delete_file_records(file_records, dry=True, gc=None, label=None):
                     logger.warning(
                         'DELETE: ' + file2del + ' on ' + str(fr.data_repository.name))
                     delete_clients[i].add_item(file2del)
+                    deleted_paths[ge].append(file2del)
                 else:
                     logger.warning(
                         'FILE NOT FOUND: ' + file2del + ' on ' + str(fr.data_repository.name))
@@ -851,6 +1491,8 @@ def globus_delete_file_records(file_records, dry=True, gc=None, label=None):
             continue
         logger.warning('SUBMIT DELETE: ' + str(dc))
         gtc.submit_delete(dc)
+    for ge, paths in deleted_paths.items():
+        invalidate_globus_ls(ge, paths)
     # ideally here we would make some synchronous process and some error handling
     file_records.delete()
 
@@ -3,6 +3,7 @@ import re
 
 from django.contrib.auth import get_user_model
 from django.db import models
+from django.db.models import prefetch_related_objects
 from rest_framework import generics, viewsets, mixins, serializers
 from rest_framework.response import Response
 import django_filters
@@ -34,8 +35,8 @@ from .serializers import (DataRepositoryTypeSerializer,
                           TagSerializer
                           )
 from .transfers import (_get_session, _get_repositories_for_labs,
-                        _create_dataset_file_records, bulk_sync, _check_dataset_protected,
-                        _get_name_collection_revision)
+                        _create_dataset_file_records, _bulk_create_dataset_file_records,
+                        bulk_sync, _check_files_protected, _get_name_collection_revision)
 
 logger = structlog.get_logger(__name__)
 
@@ -281,11 +282,13 @@ class FileRecordDetail(generics.RetrieveUpdateDestroyAPIView):
 # Register file
 # ------------------------------------------------------------------------------------------------
 
-def _make_dataset_response(dataset):
+def _make_dataset_response(dataset, file_records=None):
     if not dataset:
         return None
 
     # Return the file records.
+    if file_records is None:
+        file_records = FileRecord.objects.filter(dataset=dataset)
     file_records = [
         {
             'id': fr.pk,
@@ -293,7 +296,7 @@ def _make_dataset_response(dataset):
             'relative_path': fr.relative_path,
             'exists': fr.exists,
         }
-        for fr in FileRecord.objects.filter(dataset=dataset)]
+        for fr in file_records]
 
     out = {
         'id': dataset.pk,
@@ -317,6 +320,15 @@ def _make_dataset_response(dataset):
     return out
 
 
+def _make_dataset_responses(datasets):
+    """Return the registration response of many datasets, fetching related records at once."""
+    file_records = {dataset.pk: [] for dataset in datasets}
+    for fr in FileRecord.objects.filter(dataset__in=datasets):
+        file_records[fr.dataset_id].append(fr)
+    prefetch_related_objects([dataset.session for dataset in datasets], 'users')
+    return [_make_dataset_response(dataset, file_records[dataset.pk]) for dataset in datasets]
+
+
 def _parse_path(path):
     pattern = regex(spec='{subject}/{date}/{number}').pattern + '.*'
     m = re.match(pattern, path)
@@ -381,18 +393,11 @@ class ProtectedFileViewSet(mixins.ListModelMixin,
             subject=subject, date=date, number=session_number, user=user)
         assert session
 
-        # Loop through the files to see if any are protected
-        prot_response = []
-        protected = []
-        for file in filenames:
-            info, resp = _get_name_collection_revision(file, rel_dir_path)
-            if resp:
-                return resp
-            prot, prot_info = _check_dataset_protected(
-                session, info['collection'], info['filename'])
-            protected.append(prot)
-            prot_response.append({file: prot_info})
-        if any(protected):
+        # Check whether any of the files are protected
+        protected, prot_response, resp = _check_files_protected(session, filenames, rel_dir_path)
+        if resp:
+            return resp
+        if protected:
             data = {'status_code': 403,
                     'error': 'One or more datasets is protected',
                     'details': prot_response}
@@ -544,52 +549,61 @@ class RegisterFileViewSet(mixins.CreateModelMixin,
             subject=subject, date=date, number=session_number, user=user)
         assert session
 
-        # If the check protected flag is True, loop through the files to see if any are protected
+        # If the check protected flag is True, check whether any of the files are protected
         if check_protected:
-            prot_response = []
-            protected = []
-            for file in filenames:
-
-                info, resp = _get_name_collection_revision(file, rel_dir_path)
-
-                if resp:
-                    return resp
-
-                prot, prot_info = _check_dataset_protected(
-                    session, info['collection'], info['filename'])
-                protected.append(prot)
-                prot_response.append({file: prot_info})
+            protected, prot_response, resp = _check_files_protected(
+                session, filenames, rel_dir_path)
+            if resp:
+                return resp
 
-            if any(protected):
+            if protected:
                 data = {'status_code': 403,
                         'error': 'One or more datasets is protected',
                         'details': prot_response}
                 return Response(data=data, status=403)
 
-        response = []
+        # Parse the file paths; files preceding an invalid path are still registered
+        files, path_resp = [], None
         for filename, hash, fsize, version, qc in zip(filenames, hashes, filesizes, versions, qcs):
             if not filename:
                 continue
-            info, resp = _get_name_collection_revision(filename, rel_dir_path)
-
+            info, path_resp = _get_name_collection_revision(filename, rel_dir_path)
+            if path_resp:
+                break
+            info.update(hash=hash or '', file_size=fsize, version=version or '', qc=qc)
+            files.append(info)
+
+        keys = [(info['collection'], info['filename']) for info in files]
+        if len(set(keys)) == len(keys):
+            datasets, resp = _bulk_create_dataset_file_records(
+                files, session=session, user=user, repositories=repositories,
+                exists_in=exists_in, default=default)
             if resp:
                 return resp
+            response = _make_dataset_responses(datasets)
+        else:
+            # If the same dataset is registered more than once, the order of registration
+            # determines the default revision, therefore register the files one by one
+            response = []
+            for info in files:
+                if info['revision']:
+                    revision, _ = Revision.objects.get_or_create(name=info['revision'])
+                else:
+                    revision = None
+
+                dataset, resp = _create_dataset_file_records(
+                    collection=info['collection'], rel_dir_path=info['rel_dir_path'],
+                    filename=info['filename'], session=session, user=user,
+                    repositories=repositories, exists_in=exists_in, hash=info['hash'],
+                    file_size=info['file_size'], version=info['version'], revision=revision,
+                    default=default, qc=info['qc'])
+                if resp:
+                    return resp
+                out = _make_dataset_response(dataset)
+                response.append(out)
 
-            if info['revision']:
-                revision, _ = Revision.objects.get_or_create(name=info['revision'])
-            else:
-                revision = None
-
-            dataset, resp = _create_dataset_file_records(
-                collection=info['collection'], rel_dir_path=info['rel_dir_path'],
-                filename=info['filename'], session=session, user=user, repositories=repositories,
-                exists_in=exists_in, hash=hash or '', file_size=fsize, version=version or '',
-                revision=revision, default=default, qc=qc)
-            if resp:
-                return resp
-            out = _make_dataset_response(dataset)
-            response.append(out)
-
+        if path_resp:
+            return path_resp
         return Response(response, status=201)
 
 
@@ -1,11 +1,14 @@
 from time import time
+from datetime import datetime
 import io
+import hashlib
 import socket
 import json
 import logging
 from pathlib import Path
 import urllib.parse
-from functools import wraps
+from functools import wraps, partial
+from concurrent.futures import ThreadPoolExecutor
 from sys import getsizeof
 import zipfile
 import tempfile
@@ -15,25 +18,30 @@ import numpy as np
 import pandas as pd
 import pyarrow.parquet as pq
 import pyarrow as pa
+import pyarrow.compute as pc
 from tqdm import tqdm
 from one.alf.cache import _metadata, SESSIONS_COLUMNS, DATASETS_COLUMNS
 from one.util import QC_TYPE
 from one.alf.spec import QC
 from one.remote.aws import get_s3_virtual_host
 
-from django.db import connection
-from django.db.models import Q, Exists, OuterRef
-from django.core.management.base import BaseCommand
+from django.db import connection, connections, transaction
+from django.utils import timezone
+from django.db.models import Q, Exists, OuterRef, TextField
+from django.db.models.functions import Cast
+from django.core.management.base import BaseCommand, CommandError
 from django.contrib.postgres.aggregates import ArrayAgg
-from django.core.paginator import Paginator
 
 from alyx.settings import TABLES_ROOT
 from actions.models import Session
-from data.models import Dataset, FileRecord
+from data.models import Dataset, FileRecord, Tombstone
 from experiments.models import ProbeInsertion
 
 logger = logging.getLogger(__name__)
 ONE_API_VERSION = '2.10'  # Minimum compatible ONE api version
+DATASETS_BATCH_SIZE = 100_000  # Number of datasets to fetch per query
+ZIP_NAME = 'cache.zip'
+META_NAME = 'cache_info.json'
 
 
 def measure_time(func):
@@ -65,6 +73,64 @@ def _s3_filesystem(**kwargs) -> pa.fs.S3FileSystem:
     return pa.fs.S3FileSystem(**S3_ACCESS)
 
 
+def _close_connection_after(func, snapshot=None):
+    """Call a function then close the database connections of the current thread.
+
+    :param func: The function to call
+    :param snapshot: An exported PostgreSQL snapshot id; if given the function is called in a
+     REPEATABLE READ transaction that sees the same data as the exporting transaction
+    """
+    try:
+        if snapshot is None:
+            return func()
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+                cursor.execute('SET TRANSACTION SNAPSHOT %s', [snapshot])
+            return func()
+    finally:
+        connections.close_all()
+
+
+def _export_snapshot() -> str:
+    """Start a REPEATABLE READ transaction and export its snapshot for other connections.
+
+    Must be called within an atomic block, which must stay open while the snapshot is used.
+
+    :return: The snapshot id to pass to SET TRANSACTION SNAPSHOT
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        cursor.execute('SELECT pg_export_snapshot()')
+        return cursor.fetchone()[0]
+
+
+def _output_location(filename: str) -> tuple:
+    """
+    Return the path and filesystem to write a given file to.
+
+    :param filename: Save location, may be local file path or S3 location (starting s3://)
+    :return: the path without the scheme and the pyarrow FileSystem object (None if local)
+    """
+    parsed = urllib.parse.urlparse(filename)
+    if parsed.scheme == 's3':
+        # Filename mustn't include scheme
+        return parsed.path[int(parsed.path.startswith('/')):], _s3_filesystem()
+    elif parsed.scheme == '':
+        return filename, None
+    else:
+        raise ValueError(f'Unsupported URI scheme "{parsed.scheme}"')
+
+
+def _file_sha256(filename) -> str:
+    """Return the hex SHA-256 digest of a file, read in chunks."""
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as fp:
+        while chunk := fp.read(1024 ** 2):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
 def _save(filename: str, df: pd.DataFrame, metadata: dict = None, dry=False) -> pa.Table:
     """
     Save pandas dataframe to parquet.
@@ -90,15 +156,8 @@ def _save(filename: str, df: pd.DataFrame, metadata: dict = None, dry=False) ->
     })
 
     if not dry:
-        parsed = urllib.parse.urlparse(filename)
-        if parsed.scheme == 's3':
-            # Filename mustn't include scheme
-            path = parsed.path[int(parsed.path.startswith('/')):]
-            pq.write_table(table, path, filesystem=_s3_filesystem())
-        elif parsed.scheme == '':
-            pq.write_table(table, filename)
-        else:
-            raise ValueError(f'Unsupported URI scheme "{parsed.scheme}"')
+        path, filesystem = _output_location(filename)
+        pq.write_table(table, path, filesystem=filesystem)
     return table
 
 
@@ -123,6 +182,18 @@ class Command(BaseCommand):
                             help="List of tag names to filter datasets by")
         parser.add_argument('--qc', action='store_true',
                             help="Save QC fields to a JSON file")
+        parser.add_argument('--stream', action='store_true',
+                            help="Write the datasets table in batches with constant memory")
+        parser.add_argument('--batch-size', type=int, default=DATASETS_BATCH_SIZE,
+                            help="Number of datasets to fetch per query")
+        parser.add_argument('--incremental', action='store_true',
+                            help="Update the previous tables in the destination with the rows "
+                                 "modified since they were generated")
+        parser.add_argument('--workers', type=int, default=1,
+                            help="Number of tables to generate concurrently")
+        parser.add_argument('--per-tag', action='store_true',
+                            help="Generate a separate cache for each tag in "
+                                 "<destination>/<tag>/, fetching the datasets only once")
 
     def handle(self, *_, **options):
         if options['verbosity'] < 1:
@@ -132,44 +203,252 @@ class Command(BaseCommand):
         self.dst_dir = options.get('destination')
         self.compress = options.get('compress')
         tables, qc = options.get('tables'), options.get('qc')
-        self.generate_tables(tables, export_qc=qc, tags=options.get('tag'))
-
-    def generate_tables(self, tables, export_qc=False, **kwargs) -> list:
+        if options.get('per_tag'):
+            if not options.get('tag'):
+                raise CommandError('--per-tag requires at least one tag')
+            self.generate_tag_tables(
+                options['tag'], tables, export_qc=qc,
+                batch_size=options.get('batch_size') or DATASETS_BATCH_SIZE)
+            return
+        self.generate_tables(tables, export_qc=qc, tags=options.get('tag'),
+                             stream=options.get('stream', False),
+                             batch_size=options.get('batch_size') or DATASETS_BATCH_SIZE,
+                             incremental=options.get('incremental', False),
+                             workers=options.get('workers') or 1)
+
+    def generate_tables(self, tables, export_qc=False, stream=False,
+                        batch_size=DATASETS_BATCH_SIZE, incremental=False, workers=1,
+                        **kwargs) -> list:
         """
         Generate and save a list of tables.  Supported tables include 'sessions' and 'datasets'.
         :param tables: A tuple of table names.
         :param export_qc: If true, the extended QC will be saved to a JSON file.
+        :param stream: If true, the datasets table is written in batches without loading the
+         full table into memory.
+        :param batch_size: The number of datasets fetched per query.
+        :param incremental: If true, the previous tables in the destination are updated with the
+         rows modified since they were generated.  Takes precedence over `stream`.
+        :param workers: The number of tables to generate concurrently, each in its own thread
+         with its own database connection.  The threads share one snapshot of the database so
+         that the tables are consistent, which requires PostgreSQL; on other databases the
+         tables are generated sequentially.
         :param kwargs: Arguments to pass to cache generation functions.
         :return: A list of paths to the saved files.
         """
+        if unknown := [x for x in tables if x.lower() not in ('sessions', 'datasets')]:
+            raise ValueError(f'Unknown table "{unknown[0]}"')
         self.metadata = create_metadata()
+        # Rows modified after this time will be fetched by the next incremental update
+        self.metadata['high_water_mark'] = timezone.now().isoformat()
         if kwargs.get('tags'):
             self.metadata['database_tags'] = kwargs.get('tags')
-        to_compress = {}
         dry = self.compress
-        for table in tables:
-            if table.lower() == 'sessions':
-                logger.debug('Generating sessions DataFrame')
-                tbl, filename = self._save_table(generate_sessions_frame(**kwargs), table, dry=dry)
-                if filename is not None:
-                    to_compress[filename] = tbl
-            elif table.lower() == 'datasets':
-                logger.debug('Generating datasets DataFrame')
-                tbl, filename = self._save_table(generate_datasets_frame(**kwargs), table, dry=dry)
-                if filename is not None:
-                    to_compress[filename] = tbl
+        # When compressing, streamed tables are written to a temporary directory
+        with tempfile.TemporaryDirectory() as tmp:
+            jobs = [partial(self._generate_table, table.lower(), dry=dry, tmp=tmp, stream=stream,
+                            batch_size=batch_size, incremental=incremental, **kwargs)
+                    for table in tables]
+            if export_qc:
+                jobs.append(partial(self._save_qc, dry=dry, tags=kwargs.get('tags')))
+            if workers > 1 and len(jobs) > 1 and connection.vendor == 'postgresql':
+                # The exporting transaction must stay open until the workers have finished
+                with transaction.atomic(), ThreadPoolExecutor(min(workers, len(jobs))) as ex:
+                    run = partial(_close_connection_after, snapshot=_export_snapshot())
+                    results = list(ex.map(run, jobs))
+            else:
+                results = [job() for job in jobs]
+            to_compress = {filename: tbl for tbl, filename in results if filename is not None}
+
+            if self.compress and len(to_compress) > 0:
+                return list(self._compress_tables(to_compress))
+            else:
+                return list(to_compress.keys())
+
+    def generate_tag_tables(self, tags, tables, export_qc=False,
+                            batch_size=DATASETS_BATCH_SIZE) -> list:
+        """
+        Generate and save the tables of each tag in <dst_dir>/<tag>/.
+
+        Unlike calling `generate_tables` for each tag, the datasets and sessions are fetched once
+        for all tags.  The datasets table is always streamed.
+
+        :param tags: A list of tag names.
+        :param tables: A tuple of table names.
+        :param export_qc: If true, the extended QC will be saved to a JSON file for each tag.
+        :param batch_size: The number of datasets fetched per query.
+        :return: A list of paths to the saved files.
+        """
+        if unknown := [x for x in tables if x.lower() not in ('sessions', 'datasets')]:
+            raise ValueError(f'Unknown table "{unknown[0]}"')
+        tables = [x.lower() for x in tables]
+        metadata = create_metadata()
+        metadata['high_water_mark'] = timezone.now().isoformat()
+        root, dry = self.dst_dir, self.compress
+        tag_dirs = {tag: root.rstrip('/') + '/' + tag for tag in tags}
+        saved = []
+        with tempfile.TemporaryDirectory() as tmp:
+            try:
+                if 'datasets' in tables:
+                    datasets = {}
+                    for tag, tag_dir in tag_dirs.items():
+                        self.dst_dir = tag_dir
+                        if dry:  # When compressing, write to a temporary directory
+                            datasets[tag] = Path(tmp) / tag / 'datasets.pqt'
+                            datasets[tag].parent.mkdir()
+                        else:
+                            logger.info(f'Saving table "datasets" to {self.dst_dir}...')
+                            datasets[tag] = self._table_filename('datasets')
+                    write_tag_datasets_tables(datasets, batch_size=batch_size, metadata=metadata)
+                if 'sessions' in tables:
+                    logger.debug('Generating sessions DataFrame')
+                    sessions = generate_sessions_frame(tags=list(tags))
+                    tagged = (Dataset.tags.through.objects
+                              .filter(tag__name__in=tags)
+                              .values_list('dataset__session', 'tag__name')
+                              .distinct())
+                    session_ids = {tag: set() for tag in tags}
+                    for eid, tag in tagged:
+                        session_ids[tag].add(str(eid))
+
+                for tag, tag_dir in tag_dirs.items():
+                    self.dst_dir = tag_dir
+                    self.metadata = {**metadata, 'database_tags': [tag]}
+                    to_compress = {}
+                    if 'sessions' in tables:
+                        df = sessions[sessions.index.isin(session_ids[tag])]
+                        tbl, filename = self._save_table(df, 'sessions', dry=dry)
+                        to_compress[filename] = tbl
+                    if 'datasets' in tables:
+                        to_compress[str(self._table_filename('datasets'))] = datasets[tag]
+                    if export_qc:
+                        tbl, filename = self._save_qc(dry=dry, tags=tag)
+                        if filename is not None:
+                            to_compress[filename] = tbl
+                    if self.compress and len(to_compress) > 0:
+                        saved.extend(self._compress_tables(to_compress))
+                    else:
+                        saved.extend(to_compress.keys())
+            finally:
+                self.dst_dir = root
+        return saved
+
+    def _generate_table(self, name, dry=False, tmp=None, stream=False,
+                        batch_size=DATASETS_BATCH_SIZE, incremental=False, **kwargs):
+        """Generate and save a given table.
+
+        :param name: table name, either 'sessions' or 'datasets'
+        :param dry: If true, the table is not written to the destination
+        :param tmp: A local directory to write streamed tables to when dry is true
+        For the other parameters, see `generate_tables`.
+        :return: The table (or path of a streamed table) and the full path of the table
+        """
+        if incremental:
+            df = self._update_table(name, batch_size=batch_size, **kwargs)
+            if df is not None:
+                return self._save_table(df, name, dry=dry)
+        if name == 'sessions':
+            logger.debug('Generating sessions DataFrame')
+            return self._save_table(generate_sessions_frame(**kwargs), name, dry=dry)
+        elif stream:
+            logger.debug('Streaming datasets table')
+            return self._stream_table(write_datasets_table, name, tmp=tmp if dry else None,
+                                      batch_size=batch_size, **kwargs)
+        else:
+            logger.debug('Generating datasets DataFrame')
+            return self._save_table(
+                generate_datasets_frame(batch_size=batch_size, **kwargs), name, dry=dry)
+
+    def _read_previous(self, name):
+        """Read a previously generated table from the destination.
+
+        :param name: table name
+        :return: The table as a DataFrame, or None if not found, and its ONE metadata
+        """
+        parsed = urllib.parse.urlparse(self.dst_dir)
+        if parsed.scheme == 's3':
+            filesystem = _s3_filesystem()
+            root = f'{parsed.netloc}/{parsed.path.strip("/")}'
+        elif parsed.scheme == '':
+            filesystem = pa.fs.LocalFileSystem()
+            root = Path(self.dst_dir).absolute().as_posix()
+        else:
+            raise ValueError(f'Unsupported URI scheme "{parsed.scheme}"')
+        # When compressing, the previous tables are in the zip file
+        path = f'{root}/{ZIP_NAME if self.compress else name + ".pqt"}'
+        if filesystem.get_file_info(path).type == pa.fs.FileType.NotFound:
+            return None, {}
+        with filesystem.open_input_file(path) as f:
+            if self.compress:
+                with zipfile.ZipFile(f) as zip:
+                    if f'{name}.pqt' not in zip.namelist():
+                        return None, {}
+                    table = pq.read_table(io.BytesIO(zip.read(f'{name}.pqt')))
             else:
-                raise ValueError(f'Unknown table "{table}"')
+                table = pq.read_table(f)
+        metadata = json.loads((table.schema.metadata or {}).get(b'one_metadata', b'{}'))
+        return table.to_pandas(), metadata
+
+    @measure_time
+    def _update_table(self, name, batch_size=DATASETS_BATCH_SIZE, tags=None):
+        """Update a previously generated table with the rows modified since it was generated.
+
+        Only the rows modified or deleted since then are fetched: the rows that no longer belong
+        in the table, e.g. deleted or untagged datasets, are removed.
+
+        :param name: table name, either 'sessions' or 'datasets'
+        :param batch_size: The number of datasets fetched per query
+        :param tags: A tag name or list of tag names to filter datasets by
+        :return: The updated table, or None if there is no previous table to update
+        """
+        previous, metadata = self._read_previous(name)
+        if previous is None or 'high_water_mark' not in metadata:
+            logger.warning(f'No previous "{name}" table found; generating full table')
+            return
+        if metadata.get('database_tags') != self.metadata.get('database_tags'):
+            logger.warning(f'Previous "{name}" table has different tags; generating full table')
+            return
+        since = datetime.fromisoformat(metadata['high_water_mark'])
+        logger.info(f'Updating table "{name}" with rows modified since {since}')
+        deleted = Tombstone.objects.filter(deleted_datetime__gte=since)
+        if name == 'sessions':
+            changed = generate_sessions_frame(tags=tags, modified_since=since)
+            modified = Session.objects.filter(_modified_sessions(since)).values_list('pk')
+            deleted = deleted.filter(model='session').values_list('object_id')
+            df = update_table(previous, changed, _str_ids(modified) | _str_ids(deleted))
+            return df.sort_values(['date', 'subject', 'number'], ascending=False)
+        else:
+            changed = generate_datasets_frame(
+                tags=tags, batch_size=batch_size, modified_since=since)
+            modified = Dataset.objects.filter(auto_datetime__gte=since).values_list('pk')
+            deleted = deleted.filter(model='dataset').values_list('object_id')
+            return update_table(previous, changed, _str_ids(modified) | _str_ids(deleted))
+
+    def _table_filename(self, name):
+        """Return the full path of a given table, i.e. <dst_dir>/<name>.pqt"""
+        scheme = urllib.parse.urlparse(self.dst_dir).scheme or 'file'
+        if scheme == 'file':
+            Path(self.dst_dir).mkdir(exist_ok=True, parents=True)
+            return Path(self.dst_dir) / f'{name}.pqt'  # Save to parquet
+        else:
+            return self.dst_dir.strip('/') + f'/{name}.pqt'  # Save to parquet
 
-        if export_qc:
-            tbl, filename = self._save_qc(dry=dry, tags=kwargs.get('tags'))
-            if filename is not None:
-                to_compress[filename] = tbl
+    def _stream_table(self, writer, name, tmp=None, **kwargs):
+        """Stream a given table to <dst_dir>/<name>.pqt.
 
-        if self.compress and len(to_compress) > 0:
-            return list(self._compress_tables(to_compress))
+        :param writer: a function that writes the table to a given filename in batches
+        :param name: table name
+        :param tmp: If not None, the table is written to this local directory instead
+        :param kwargs: Arguments to pass to the writer function
+        :return: The path of the written file and the full path of the table
+        """
+        filename = self._table_filename(name)
+        if tmp is None:
+            logger.info(f'Saving table "{name}" to {self.dst_dir}...')
+            path = filename
         else:
-            return list(to_compress.keys())
+            path = Path(tmp) / f'{name}.pqt'
+        writer(str(path), metadata=self.metadata, **kwargs)
+        return path, str(filename)
 
     def _save_table(self, table, name, **kwargs):
         """Save a given table to <dst_dir>/<name>.pqt.
@@ -189,12 +468,7 @@ class Command(BaseCommand):
 
         if not kwargs.get('dry'):
             logger.info(f'Saving table "{name}" to {self.dst_dir}...')
-        scheme = urllib.parse.urlparse(self.dst_dir).scheme or 'file'
-        if scheme == 'file':
-            Path(self.dst_dir).mkdir(exist_ok=True)
-            filename = Path(self.dst_dir) / f'{name}.pqt'  # Save to parquet
-        else:
-            filename = self.dst_dir.strip('/') + f'/{name}.pqt'  # Save to parquet
+        filename = self._table_filename(name)
         pa_table = _save(str(filename), table, self.metadata, **kwargs)
         return pa_table, str(filename)
 
@@ -210,7 +484,7 @@ class Command(BaseCommand):
         if sessions.count() == 0:
             logger.warning(f'No datasets associated with sessions found for {tags}, '
                            f'returning empty dataframe')
-            return
+            return None, None
 
         qc = list(sessions.values('pk', 'qc', 'extended_qc').distinct())
         outcome_map = dict(Session.QC_CHOICES)
@@ -243,7 +517,7 @@ class Command(BaseCommand):
                 'extended_qc': ins['json'].pop('extended_qc')
             })
 
-        filename = self.dst_dir.strip('/') + '/QC.json'  # Save to JSON
+        filename = self.dst_dir.rstrip('/') + '/QC.json'  # Save to JSON
         if not dry:
             with open(filename, 'w') as fp:
                 json.dump(qc, fp)
@@ -253,72 +527,114 @@ class Command(BaseCommand):
         """
         Write cache_info JSON and create zip file comprising parquet tables + JSON
 
-        :param table_map: a dict of filenames and corresponding
-        :return:
+        The tables are compressed straight into the output stream so that the archive is never
+        held in memory.  S3 output streams are uploaded in parts as they are written.
+
+        :param table_map: a dict of filenames and corresponding tables, paths of local parquet
+         files, or JSON serializable objects
+        :return: The zip file and cache info JSON file locations
         """
-        ZIP_NAME = 'cache.zip'
-        META_NAME = 'cache_info.json'
+        parsed = urllib.parse.urlparse(self.dst_dir)
+        scheme = parsed.scheme or 'file'
+        if scheme == 's3':
+            zip_file = f'{parsed.netloc}/{parsed.path.strip("/")}/{ZIP_NAME}'
+            tag_file = f'{parsed.netloc}/{parsed.path.strip("/")}/{META_NAME}'
+            s3 = _s3_filesystem()
+            logger.debug(f'Opening output stream to {zip_file}')
+            stream = s3.open_output_stream(zip_file)
+        elif scheme == 'file' or os.name == 'nt':
+            Path(self.dst_dir).mkdir(exist_ok=True, parents=True)
+            tag_file = Path(self.dst_dir) / META_NAME
+            zip_file = Path(self.dst_dir) / ZIP_NAME
+            # Write to a temporary file so that the previous archive may be served until done
+            stream = open(zip_file.with_suffix('.zip.part'), 'wb')
+        else:
+            raise ValueError(f'Unsupported URI scheme "{scheme}"')
 
-        logger.info('Compressing tables...')  # Write zip in memory
-        zip_buffer = io.BytesIO()  # Mem buffer to store compressed table data
-        with tempfile.TemporaryDirectory() as tmp, \
-                zipfile.ZipFile(zip_buffer, 'a', zipfile.ZIP_DEFLATED, False) as zip:
+        logger.info('Compressing tables...')
+        with stream, zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED, True) as zip:
             jsonmeta = {}
             for filename, table in table_map.items():
-                tmp_filename = Path(tmp) / Path(filename).name  # Table filename in temp dir
+                name = Path(filename).name
                 ext = Path(filename).suffix
                 if ext == '.pqt':
-                    pq.write_table(table, tmp_filename)  # Write table to tempdir
-                    zip.write(tmp_filename, Path(filename).name)  # Load and compress
-                    pqtinfo = pq.read_metadata(tmp_filename)  # Load metadata for cache_info file
+                    if isinstance(table, pa.Table):
+                        collector = []
+                        with zip.open(name, 'w', force_zip64=True) as fp:
+                            pq.write_table(table, fp, metadata_collector=collector)
+                        # Round trip the metadata for its serialized size
+                        buffer = io.BytesIO()
+                        collector[0].write_metadata_file(buffer)
+                        buffer.seek(0)
+                        pqtinfo = pq.read_metadata(buffer)
+                    else:  # Table already streamed to a local file
+                        zip.write(table, name)
+                        pqtinfo = pq.read_metadata(table)  # Load metadata for cache_info file
                     jsonmeta[Path(filename).stem] = {
                         'nrecs': pqtinfo.num_rows,
                         'size': pqtinfo.serialized_size
                     }
                 elif ext == '.json':
-                    with open(tmp_filename, 'w') as fp:
-                        json.dump(table, fp)
-                    zip.write(tmp_filename, Path(filename).name)
+                    zip.writestr(name, json.dumps(table))
                 else:
                     raise NotImplementedError(f'Unable to save table with extension "{ext}"')
             metadata = {**self.metadata, 'tables': jsonmeta}
             zip.writestr(META_NAME, json.dumps(metadata, indent=1))  # Compress cache info
 
-        logger.info('Writing to file...')
-        parsed = urllib.parse.urlparse(self.dst_dir)
-        scheme = parsed.scheme or 'file'
-        try:
-            if scheme == 's3':
-                zip_file = f'{parsed.netloc}/{parsed.path.strip("/")}/{ZIP_NAME}'
-                tag_file = f'{parsed.netloc}/{parsed.path.strip("/")}/{META_NAME}'
-                s3 = _s3_filesystem()
-                metadata['location'] = get_s3_virtual_host(zip_file, s3.region)  # Add URL
-                # Write cache info json to s3
-                logger.debug(f'Opening output stream to {tag_file}')
-                with s3.open_output_stream(tag_file) as stream:
-                    stream.write(json.dumps(metadata, indent=1).encode())
-                # Write zip file to s3
-                logger.debug(f'Opening output stream to {zip_file}')
-                with s3.open_output_stream(zip_file) as stream:
-                    stream.write(zip_buffer.getbuffer())
-            elif scheme == 'file' or os.name == 'nt':
-                # creates a json file containing metadata and add it to the zip file
-                Path(self.dst_dir).mkdir(exist_ok=True, parents=True)
-                tag_file = Path(self.dst_dir) / META_NAME
-                zip_file = Path(self.dst_dir) / ZIP_NAME
-                with open(tag_file, 'w') as fid:
-                    json.dump(metadata, fid, indent=1)
-                with open(zip_file, 'wb') as fid:
-                    fid.write(zip_buffer.getbuffer())
-            else:
-                raise ValueError(f'Unsupported URI scheme "{scheme}"')
-        finally:
-            zip_buffer.close()
+        logger.info('Writing cache info...')
+        if scheme == 's3':
+            metadata['location'] = get_s3_virtual_host(zip_file, s3.region)  # Add URL
+            # Write cache info json to s3
+            logger.debug(f'Opening output stream to {tag_file}')
+            with s3.open_output_stream(tag_file) as stream:
+                stream.write(json.dumps(metadata, indent=1).encode())
+        else:
+            # The digest is served by the cache download view, which doesn't read the archive
+            metadata['sha256'] = _file_sha256(zip_file.with_suffix('.zip.part'))
+            os.replace(zip_file.with_suffix('.zip.part'), zip_file)
+            # creates a json file containing metadata and add it to the zip file
+            with open(tag_file, 'w') as fid:
+                json.dump(metadata, fid, indent=1)
         return zip_file, tag_file
 
 
+def _modified_sessions(since) -> Q:
+    """
+    Return a filter of the sessions modified since a given time, including the sessions whose
+    datasets were modified (e.g. tagged) or deleted since then.
+
+    :param since: A datetime
+    :return: A Q object filtering a Session QuerySet
+    """
+    datasets = Dataset.objects.filter(auto_datetime__gte=since).values('session')
+    deleted = Tombstone.objects.filter(deleted_datetime__gte=since, model='dataset')
+    return (Q(auto_datetime__gte=since) | Q(pk__in=datasets) |
+            Q(pk__in=deleted.values('session_id')))
+
+
+def _str_ids(values_list) -> set:
+    """Return the ids of a values_list QuerySet of a single UUID field as strings."""
+    return {str(pk) for pk, in values_list}
+
+
+def _sessions_queryset(tags=None):
+    """
+    Return the sessions to include in the sessions table.
+
+    :param tags: A tag name or list of tag names to filter the sessions' datasets by
+    :return: A Session QuerySet
+    """
+    query = Session.objects.all()
+    if tags:
+        if not isinstance(tags, str):
+            query = query.filter(data_dataset_session_related__tags__name__in=tags)
+        else:
+            query = query.filter(data_dataset_session_related__tags__name=tags)
+    return query
+
+
 @measure_time
-def generate_sessions_frame(tags=None) -> pd.DataFrame:
+def generate_sessions_frame(tags=None, modified_since=None) -> pd.DataFrame:
     """SESSIONS_COLUMNS = (
         'id',               # uuid str
         'lab',              # str
@@ -328,24 +644,24 @@ def generate_sessions_frame(tags=None) -> pd.DataFrame:
         'task_protocol',    # str
         'projects'           # str
     )
+
+    If modified_since is not None, only the sessions modified, or with datasets modified or
+    deleted, since then are returned.
     """
     fields = ('id', 'lab__name', 'subject__nickname', 'start_time__date',
               'number', 'task_protocol', 'all_projects')
-    query = (Session
-             .objects
+    query = (_sessions_queryset(tags)
              .select_related('subject', 'lab')
              .prefetch_related('projects')
              .annotate(all_projects=ArrayAgg('projects__name'))
              .order_by('-start_time', 'subject__nickname', '-number'))  # FIXME Ignores nickname :(
-    if tags:
-        if not isinstance(tags, str):
-            query = query.filter(data_dataset_session_related__tags__name__in=tags)
-        else:
-            query = query.filter(data_dataset_session_related__tags__name=tags)
+    if modified_since is not None:
+        query = query.filter(_modified_sessions(modified_since))
 
     if query.count() == 0:
-        logger.warning(f'No datasets associated with sessions found for {tags}, '
-                       f'returning empty dataframe')
+        if modified_since is None:
+            logger.warning(f'No datasets associated with sessions found for {tags}, '
+                           f'returning empty dataframe')
         return pd.DataFrame(columns=SESSIONS_COLUMNS).set_index('id')
 
     df = pd.DataFrame.from_records(query.values(*fields).distinct())
@@ -368,16 +684,13 @@ def generate_sessions_frame(tags=None) -> pd.DataFrame:
     return df
 
 
-@measure_time
-def generate_datasets_frame(tags=None, batch_size=100_000) -> pd.DataFrame:
-    """DATASETS_COLUMNS = (
-        'id',               # uuid str
-        'eid',              # uuid str
-        'rel_path',         # relative to the session path, includes the filename
-        'file_size',        # float, bytes, optional
-        'hash',             # sha1/md5 str, recomputed in load function
-        'exists'            # bool
-    )
+def _datasets_queryset(tags=None, modified_since=None):
+    """
+    Return the datasets to include in the datasets table.
+
+    :param tags: A tag name or list of tag names to filter datasets by
+    :param modified_since: If not None, only datasets modified since this datetime are returned
+    :return: A Dataset QuerySet of datasets that exist on FlatIron or AWS and have a session
     """
     # Determine which file records are on AWS and which are on FlatIron
     fr = FileRecord.objects.select_related('data_repository')
@@ -389,53 +702,288 @@ def generate_datasets_frame(tags=None, batch_size=100_000) -> pd.DataFrame:
                        data_repository__name__startswith='aws').values('pk')
     # Fetch datasets and their related tables
     ds = Dataset.objects
+    if modified_since is not None:
+        ds = ds.filter(auto_datetime__gte=modified_since)
     if tags:
         kw = {'tags__name__in' if not isinstance(tags, str) else 'tags__name': tags}
         ds = ds.prefetch_related('tag').filter(**kw)
     # Filter out datasets that do not exist on either repository or have no associated session
     ds = ds.annotate(exists_flatiron=Exists(on_flatiron), exists_aws=Exists(on_aws))
-    ds = ds.filter(Q(exists_flatiron=True) | Q(exists_aws=True), session__isnull=False)
+    return ds.filter(Q(exists_flatiron=True) | Q(exists_aws=True), session__isnull=False)
+
+
+# fields to keep from Dataset table
+DATASETS_FIELDS = (
+    'id', 'name', 'file_size', 'hash', 'collection', 'revision__name', 'default_dataset',
+    'session__id', 'qc'
+)
+
+
+@measure_time
+def generate_datasets_frame(tags=None, batch_size=DATASETS_BATCH_SIZE,
+                            modified_since=None) -> pd.DataFrame:
+    """DATASETS_COLUMNS = (
+        'id',               # uuid str
+        'eid',              # uuid str
+        'rel_path',         # relative to the session path, includes the filename
+        'file_size',        # float, bytes, optional
+        'hash',             # sha1/md5 str, recomputed in load function
+        'exists'            # bool
+    )
+
+    If modified_since is not None, only the datasets modified since then are returned.
+    """
+    ds = _datasets_queryset(tags, modified_since=modified_since)
 
     if ds.count() == 0:
-        logger.warning(f'No datasets associated with sessions found for {tags}, '
-                       f'returning empty dataframe')
+        if modified_since is None:
+            logger.warning(f'No datasets associated with sessions found for {tags}, '
+                           f'returning empty dataframe')
         return (pd.DataFrame(columns=DATASETS_COLUMNS)
                 .set_index(['eid', 'id'])
                 .astype({'qc': QC_TYPE, 'file_size': np.uint64}))
 
-    # fields to keep from Dataset table
-    fields = (
-        'id', 'name', 'file_size', 'hash', 'collection', 'revision__name', 'default_dataset',
-        'session__id', 'qc'
-    )
-    fields_map = {'session__id': 'eid', 'default_dataset': 'default_revision'}
+    schema = datasets_schema()
+    batches = []
+    with tqdm(total=ds.count()) as progress:
+        for records in _iter_datasets_records(ds, batch_size):
+            batches.append(_datasets_record_batch(records, schema))
+            progress.update(len(records))
+    all_df = pa.Table.from_batches(batches, schema=schema).to_pandas()
+
+    logger.debug(f'Final datasets frame = {getsizeof(all_df) / 1024 ** 2:.1f} MiB')
+    return all_df.sort_index()
+
 
-    paginator = Paginator(ds.order_by('pk'), batch_size)
-    all_df = pd.DataFrame([])
-    for i in tqdm(paginator.page_range):
-        data = paginator.get_page(i)
-        current_qs = data.object_list
-        df = (pd.DataFrame
-              .from_records(current_qs.values(*fields))
-              .rename(fields_map, axis=1)
-              .astype({'id': str, 'eid': str, 'file_size': 'UInt64'}))
-        df['exists'] = True
+def datasets_schema(metadata: dict = None) -> pa.Schema:
+    """
+    Return the schema of the datasets table, as generated by `generate_datasets_frame`.
 
-        # relative_path
-        revision = map(lambda x: None if not x else f'#{x}#', df.pop('revision__name'))
-        zipped = zip(df.pop('collection'), revision, df.pop('name'))
-        df['rel_path'] = ['/'.join(filter(None, x)) for x in zipped]
+    The schema includes the pandas metadata, so that the table is loaded with the (eid, id)
+    index and categorical QC column.
 
-        # UUIDs converted to str: not supported by parquet
-        df = df.set_index(['eid', 'id'])
+    :param metadata: A dict of optional ONE metadata
+    :return: The pyarrow schema
+    """
+    # A single typed row is required for pandas to infer the arrow types
+    row = pd.DataFrame({
+        'eid': [''], 'id': [''], 'file_size': pd.array([0], dtype='UInt64'), 'hash': [''],
+        'default_revision': [True], 'qc': pd.Categorical(['NOT_SET'], dtype=QC_TYPE),
+        'exists': [True], 'rel_path': ['']
+    })
+    schema = pa.Schema.from_pandas(row.set_index(['eid', 'id']))
+    return schema.with_metadata({
+        'one_metadata': json.dumps(metadata or {}).encode(),
+        **schema.metadata
+    })
 
-        # Convert QC enum int to pandas category
-        df['qc'] = pd.Categorical([QC(i).name for i in df['qc']], dtype=QC_TYPE)
 
-        all_df = pd.concat([all_df, df], ignore_index=False, copy=False)
+# Look up table of QC enum int to QC_TYPE category code
+QC_CODES = np.full(max(QC).value + 1, -1, dtype=np.int8)
+QC_CODES[[QC[x].value for x in QC_TYPE.categories]] = np.arange(len(QC_TYPE.categories))
 
-    logger.debug(f'Final datasets frame = {getsizeof(all_df) / 1024 ** 2:.1f} MiB')
-    return all_df.sort_index()
+
+def _datasets_values(queryset):
+    """
+    Return the DATASETS_FIELDS values of a Dataset QuerySet.
+
+    On PostgreSQL the UUIDs are rendered as text by the database rather than in Python.
+
+    :param queryset: A Dataset QuerySet
+    :return: A ValuesListQuerySet
+    """
+    if connection.vendor != 'postgresql':
+        return queryset.values_list(*DATASETS_FIELDS)
+    text = {f'{x}_text': Cast(x, output_field=TextField()) for x in ('id', 'session__id')}
+    fields = [f'{x}_text' if f'{x}_text' in text else x for x in DATASETS_FIELDS]
+    return queryset.annotate(**text).values_list(*fields)
+
+
+def _uuid_array(values) -> pa.Array:
+    """Return a string array of UUIDs, which may already be text."""
+    if len(values) == 0 or isinstance(values[0], str):
+        return pa.array(values, type=pa.string())
+    # Hex encode all UUIDs at once then insert the hyphens, i.e. 8-4-4-4-12 characters
+    hexed = b''.join(x.bytes for x in values).hex().encode()
+    hexed = np.frombuffer(hexed, dtype=np.uint8).reshape(-1, 32)
+    text = np.full((len(values), 36), ord('-'), dtype=np.uint8)
+    for n, (i, j) in enumerate(((0, 8), (8, 12), (12, 16), (16, 20), (20, 32))):
+        text[:, i + n:j + n] = hexed[:, i:j]
+    offsets = np.arange(0, text.size + 1, 36, dtype=np.int32)
+    return pa.StringArray.from_buffers(len(values), pa.py_buffer(offsets), pa.py_buffer(text))
+
+
+def _non_empty_array(values) -> pa.Array:
+    """Return a string array where empty strings are null, so they are skipped when joined."""
+    array = pa.array(values, type=pa.string())
+    return pc.if_else(pc.equal(array, ''), pa.scalar(None, pa.string()), array)
+
+
+def _datasets_record_batch(records: list, schema: pa.Schema) -> pa.RecordBatch:
+    """
+    Convert a list of dataset records to a record batch of the datasets table.
+
+    The columns are built with Arrow compute kernels rather than looping over the rows.
+
+    :param records: A list of tuples of values for the fields in DATASETS_FIELDS
+    :param schema: The datasets table schema, see `datasets_schema`
+    :return: A pyarrow RecordBatch
+    """
+    id, name, file_size, hash, collection, revision, default, eid, qc = zip(*records)
+    # rel_path is <collection>/#<revision>#/<name>, without the missing parts
+    revision = pc.binary_join_element_wise('#', _non_empty_array(revision), '#', '')
+    rel_path = pc.binary_join_element_wise(
+        _non_empty_array(collection), revision, pa.array(name, type=pa.string()), '/',
+        null_handling='skip')
+    # QC enum ints are converted to their index in the categories
+    qc_type = schema.field('qc').type
+    qc = pa.DictionaryArray.from_arrays(
+        pa.array(QC_CODES[np.array(qc, dtype=np.int64)], type=qc_type.index_type),
+        pa.array(QC_TYPE.categories, type=qc_type.value_type), ordered=qc_type.ordered)
+    columns = {
+        'file_size': pa.array(file_size, type=schema.field('file_size').type),
+        'hash': pa.array(hash, type=schema.field('hash').type),
+        'default_revision': pa.array(default, type=schema.field('default_revision').type),
+        'qc': qc,
+        'exists': pa.repeat(pa.scalar(True), len(records)),
+        'rel_path': rel_path,
+        'eid': _uuid_array(eid),  # UUIDs not supported by parquet
+        'id': _uuid_array(id)
+    }
+    return pa.RecordBatch.from_arrays([columns[f.name] for f in schema], schema=schema)
+
+
+def iter_datasets_batches(tags=None, batch_size=DATASETS_BATCH_SIZE, schema=None):
+    """
+    Iterate over the datasets table in record batches.
+
+    The datasets are fetched in order of primary key, using the last key of each batch as a
+    cursor so that each query is as fast as the first.  Unlike `generate_datasets_frame`, the
+    rows are therefore not sorted by session.
+
+    :param tags: A tag name or list of tag names to filter datasets by
+    :param batch_size: The number of datasets to fetch per query
+    :param schema: The datasets table schema, see `datasets_schema`
+    :return: A generator of pyarrow RecordBatch objects
+    """
+    schema = schema or datasets_schema()
+    for records in _iter_datasets_records(_datasets_queryset(tags), batch_size):
+        yield _datasets_record_batch(records, schema)
+
+
+def _iter_datasets_records(queryset, batch_size=DATASETS_BATCH_SIZE):
+    """
+    Iterate over a Dataset QuerySet in lists of DATASETS_FIELDS records, ordered by primary key.
+
+    :param queryset: A Dataset QuerySet
+    :param batch_size: The number of datasets to fetch per query
+    :return: A generator of lists of tuples
+    """
+    ds = _datasets_values(queryset.order_by('pk'))
+    last = None
+    while True:
+        records = list((ds if last is None else ds.filter(pk__gt=last))[:batch_size])
+        if not records:
+            break
+        yield records
+        last = records[-1][0]
+        if len(records) < batch_size:
+            break
+
+
+@measure_time
+def write_datasets_table(filename: str, tags=None, batch_size=DATASETS_BATCH_SIZE,
+                         metadata: dict = None) -> int:
+    """
+    Write the datasets table to parquet in batches.
+
+    Each batch of datasets is written as a row group so that memory use is bounded by the batch
+    size rather than the size of the table.
+
+    :param filename: Parquet save location, may be local file path or S3 location (starting s3://)
+    :param tags: A tag name or list of tag names to filter datasets by
+    :param batch_size: The number of datasets to fetch per query and write per row group
+    :param metadata: A dict of optional ONE metadata
+    :return: The number of rows written
+    """
+    schema = datasets_schema(metadata)
+    path, filesystem = _output_location(filename)
+    nrows = 0
+    with pq.ParquetWriter(path, schema, filesystem=filesystem) as writer:
+        for batch in iter_datasets_batches(tags, batch_size, schema=schema):
+            writer.write_batch(batch)
+            nrows += batch.num_rows
+            logger.debug(f'Written {nrows} datasets')
+    if nrows == 0:
+        logger.warning(f'No datasets associated with sessions found for {tags}')
+    return nrows
+
+
+@measure_time
+def write_tag_datasets_tables(filenames: dict, batch_size=DATASETS_BATCH_SIZE,
+                              metadata: dict = None) -> dict:
+    """
+    Write the datasets table of several tags in a single pass over the datasets.
+
+    The datasets of all tags are fetched in batches as in `write_datasets_table`, then the rows
+    of each batch are split between the tables of the tags they belong to.
+
+    :param filenames: A map of tag name to parquet save location, may be local file path or S3
+     location (starting s3://)
+    :param batch_size: The number of datasets to fetch per query
+    :param metadata: A dict of optional ONE metadata shared by all tables
+    :return: A map of tag name to the number of rows written
+    """
+    tagged = Dataset.tags.through.objects.filter(tag__name__in=list(filenames))
+    ds = _datasets_queryset().filter(pk__in=tagged.values('dataset'))
+    schema = datasets_schema(metadata)
+    nrows = dict.fromkeys(filenames, 0)
+    writers = {}
+    try:
+        for tag, filename in filenames.items():
+            tag_schema = datasets_schema({**(metadata or {}), 'database_tags': [tag]})
+            path, filesystem = _output_location(str(filename))
+            writers[tag] = pq.ParquetWriter(path, tag_schema, filesystem=filesystem)
+        for records in _iter_datasets_records(ds, batch_size):
+            batch = _datasets_record_batch(records, schema)
+            # Records are ordered by primary key so the tags of the batch are in this range
+            rows = {str(pk): i for i, (pk, *_) in enumerate(records)}
+            batch_tags = tagged.filter(
+                dataset_id__gte=records[0][0], dataset_id__lte=records[-1][0])
+            indices = {tag: [] for tag in filenames}
+            for dataset, tag in batch_tags.values_list('dataset_id', 'tag__name'):
+                if str(dataset) in rows:
+                    indices[tag].append(rows[str(dataset)])
+            for tag, idx in indices.items():
+                if idx:
+                    writers[tag].write_batch(batch.take(pa.array(sorted(idx))))
+                    nrows[tag] += len(idx)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    logger.debug(f'Written datasets {nrows}')
+    return nrows
+
+
+def update_table(previous: pd.DataFrame, changed: pd.DataFrame, modified) -> pd.DataFrame:
+    """
+    Merge modified rows into a previously generated table.
+
+    :param previous: A previously generated sessions or datasets table
+    :param changed: A table of the modified rows that belong in the table
+    :param modified: The ids of all rows modified or deleted since the previous table was
+     generated; previous rows in this list but not in `changed`, e.g. those of deleted or
+     untagged datasets, are removed
+    :return: The updated table
+    """
+    previous_ids = previous.index.get_level_values('id')
+    changed_ids = changed.index.get_level_values('id')
+    removed = previous_ids.isin(list(modified)) & ~previous_ids.isin(changed_ids)
+    keep = ~removed & ~previous_ids.isin(changed_ids)
+    logger.debug(f'{len(changed)} rows modified, {removed.sum()} rows removed')
+    if len(changed) == 0:  # Avoid casting the column types
+        return previous[keep]
+    return pd.concat([previous[keep], changed]).sort_index()
 
 
 def create_metadata() -> dict:
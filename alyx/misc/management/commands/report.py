@@ -12,7 +12,7 @@ from django.core.management.base import BaseCommand
 from django.utils import timezone
 
 from alyx.base import alyx_mail
-from actions.models import Surgery, WaterRestriction, Session
+from actions.models import Surgery, WaterRestriction, WaterStatus, training_session_dates
 from subjects.models import Subject
 
 logger = logging.getLogger(__name__)
@@ -157,19 +157,22 @@ class Command(BaseCommand):
         if self.lab:
             wr = wr.filter(subject__lab__name=self.lab)
         subject_ids = [_[0] for _ in wr.values_list('subject').distinct()]
+        subjects = Subject.objects.filter(pk__in=subject_ids).select_related(
+            'lab', 'responsible_user').in_bulk()
+        statuses = WaterStatus.for_subjects(subjects.values())
         text = ''
         for subject_id in subject_ids:
-            subject = Subject.objects.get(pk=subject_id)
-            wc = subject.water_control
-            w = wc.weight()
-            e = wc.expected_weight()
-            p = wc.percentage_weight()
-            last_weighing = wc.last_weighing_before()
-            if not last_weighing:
+            subject = subjects[subject_id]
+            status = statuses[subject_id]
+            w = status.weight
+            e = status.expected_weight
+            p = status.percentage_weight
+            if not status.last_weighing:
                 continue
-            date = last_weighing[0]
-            threshold = max(wc.zscore_weight_pct, wc.reference_weight_pct)
-            if wc.weight_status() > 0:
+            date = status.last_weighing
+            lab = subject.lab
+            threshold = max(lab.zscore_weight_pct, lab.reference_weight_pct) if lab else 0
+            if status.weight_status > 0:
                 text += ('* {subject} ({user} <{email}>) weighed {weight:.1f}g '
                          'instead of {expected:.1f}g ({percentage:.1f}%) on {date}\n').format(
                              subject=subject,
@@ -210,17 +213,10 @@ class Command(BaseCommand):
 
     def make_training(self, user):
         """Send training report to the specified user."""
-        wr = WaterRestriction.objects.filter(
-            start_time__isnull=False, end_time__isnull=True,
-        ).order_by('subject__responsible_user__username', 'subject__nickname')
         last_monday = date.today() - timedelta(days=date.today().weekday() + 5)
         next_monday = last_monday + timedelta(days=7)
         text = "Sessions between %s and %s:\n\n" % (last_monday, next_monday)
-        for w in wr:
-            sessions = Session.objects.filter(
-                subject=w.subject, start_time__gte=last_monday, start_time__lt=next_monday)
-            dates = sorted(set([_[0] for _ in sessions.order_by('start_time').
-                                values_list('start_time__date')]))
+        for w, dates in training_session_dates(last_monday, next_monday):
             if len(dates) < 5:
                 text += '* %s (%s) was trained %d days: %s\n' % (
                     w.subject.nickname, w.subject.responsible_user.username, len(dates),
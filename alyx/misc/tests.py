@@ -1,21 +1,29 @@
+import io
+import hashlib
+import json
 import zipfile
 from pathlib import Path
 from datetime import datetime, timedelta
 import tempfile
+import uuid
 import unittest
+from unittest import mock
 from django.test import TestCase
+from django.core.management import CommandError
 from one.alf.spec import QC
 from one.alf.cache import DATASETS_COLUMNS, SESSIONS_COLUMNS
+from one.util import QC_TYPE
 import pandas as pd
 
 from subjects.models import Subject
 from misc.models import Housing, HousingSubject, CageType, LabMember, Lab
 from actions.models import Session
-from data.models import Dataset, DatasetType, DataRepository, FileRecord, DataFormat
+from data.models import Dataset, DatasetType, DataRepository, FileRecord, DataFormat, Tag
 
 SKIP_ONE_CACHE = False
 try:
     import pyarrow as pa
+    import pyarrow.parquet as pq
     from misc.management.commands import one_cache
 except ImportError as ex:
     print(f'Failed to import one_cache: {ex}')
@@ -192,7 +200,8 @@ class ONECache(TestCase):
             tables=('sessions', 'datasets')
         )
         self.assertCountEqual(
-            ['date_created', 'origin', 'min_api_version'], self.command.metadata)
+            ['date_created', 'origin', 'min_api_version', 'high_water_mark'],
+            self.command.metadata)
         tables = sorted(self.tmp.glob('*.pqt'))
         self.assertEqual(len(tables), 2)
         datasets, sessions = pd.read_parquet(tables[0]), pd.read_parquet(tables[1])
@@ -210,6 +219,206 @@ class ONECache(TestCase):
         zip = zipfile.ZipFile(zip_file)
         self.assertCountEqual(['sessions.pqt', 'cache_info.json', 'QC.json'], zip.namelist())
 
+    def test_workers(self):
+        """Test that concurrently generated tables share one database snapshot"""
+        # Without PostgreSQL snapshots the tables are generated sequentially
+        with mock.patch.object(one_cache, 'ThreadPoolExecutor') as executor:
+            self.command.handle(destination=str(self.tmp), compress=False, verbosity=1,
+                                tables=('datasets',), qc=True, workers=2)
+        executor.assert_not_called()
+        self.assertTrue((self.tmp / 'datasets.pqt').exists())
+        self.assertTrue((self.tmp / 'QC.json').exists())
+        # Check the worker transaction is set to the exported snapshot before the call
+        func = mock.Mock(return_value='foo')
+        with mock.patch.object(one_cache, 'connection') as conn, \
+                mock.patch.object(one_cache, 'connections') as connections:
+            cursor = conn.cursor.return_value.__enter__.return_value
+            cursor.execute.side_effect = lambda *_: func.assert_not_called()
+            self.assertEqual('foo', one_cache._close_connection_after(func, '00000003-1'))
+        self.assertEqual(cursor.execute.call_args_list, [
+            mock.call('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ'),
+            mock.call('SET TRANSACTION SNAPSHOT %s', ['00000003-1'])
+        ])
+        connections.close_all.assert_called_once()
+
+    def test_stream_datasets(self):
+        """Test streaming the datasets table in batches"""
+        expected = one_cache.generate_datasets_frame()
+        filename = self.tmp / 'datasets.pqt'
+        n = one_cache.write_datasets_table(str(filename), batch_size=3, metadata={'foo': 'bar'})
+        self.assertEqual(n, 10)
+        self.assertEqual(pq.read_metadata(filename).num_row_groups, 4)
+        datasets = pd.read_parquet(filename)
+        pd.testing.assert_frame_equal(datasets.sort_index(), expected)
+        meta = json.loads(pq.read_schema(filename).metadata[b'one_metadata'])
+        self.assertEqual(meta, {'foo': 'bar'})
+        # Check empty table
+        n = one_cache.write_datasets_table(str(filename), tags='foo')
+        self.assertEqual(n, 0)
+        self.assertTrue(pd.read_parquet(filename).empty)
+        # Check command with compression
+        self.command.handle(destination=str(self.tmp), compress=True, verbosity=1,
+                            tables=('datasets',), stream=True, batch_size=4)
+        zip = zipfile.ZipFile(self.tmp / 'cache.zip')
+        self.assertCountEqual(['datasets.pqt', 'cache_info.json'], zip.namelist())
+        with zip.open('datasets.pqt') as f:
+            datasets = pd.read_parquet(io.BytesIO(f.read()))
+        pd.testing.assert_frame_equal(datasets.sort_index(), expected)
+
+    def test_incremental(self):
+        """Test updating the datasets table with the datasets modified since it was generated"""
+        for compress in (False, True):
+            with self.subTest(compress=compress):
+                dst = self.tmp / str(compress)
+                kwargs = dict(destination=str(dst), compress=compress, verbosity=1,
+                              tables=('datasets',))
+                # Without a previous table the full table is generated
+                with self.assertLogs(one_cache.logger, 'WARNING'):
+                    self.command.handle(incremental=True, **kwargs)
+                hwm = self.command.metadata['high_water_mark']
+                # Modify, delete and add some datasets
+                datasets = Dataset.objects.order_by('pk')
+                modified, deleted = datasets[0], datasets[1]
+                modified.file_size = 10_000
+                modified.save()
+                deleted.delete()
+                new = Dataset.objects.create(
+                    session=modified.session, dataset_type=modified.dataset_type,
+                    collection='raw', name=f'foo_{compress}.bar.npy',
+                    data_format=modified.data_format)
+                FileRecord.objects.create(
+                    relative_path=f'foo/raw/foo_{compress}.bar.npy', dataset=new, exists=True,
+                    data_repository=DataRepository.objects.get(name='flatiron'))
+                with mock.patch.object(one_cache, 'update_table',
+                                       wraps=one_cache.update_table) as update:
+                    self.command.handle(incremental=True, **kwargs)
+                    update.assert_called_once()
+                self.assertGreater(self.command.metadata['high_water_mark'], hwm)
+                if compress:
+                    with zipfile.ZipFile(dst / 'cache.zip') as zip:
+                        datasets = pd.read_parquet(io.BytesIO(zip.read('datasets.pqt')))
+                        info = json.loads(zip.read('cache_info.json'))
+                        self.assertEqual(
+                            info['high_water_mark'], self.command.metadata['high_water_mark'])
+                else:
+                    datasets = pd.read_parquet(dst / 'datasets.pqt')
+                pd.testing.assert_frame_equal(datasets, one_cache.generate_datasets_frame())
+                self.assertEqual(datasets.loc[(slice(None), str(modified.pk)), 'file_size'][0],
+                                 10_000)
+
+    def test_incremental_tags(self):
+        """Test updating a tagged datasets table after datasets are tagged, untagged or deleted"""
+        datasets = list(Dataset.objects.order_by('pk'))
+        tag = Tag.objects.create(name='foo')
+        tag.datasets.set(datasets[:4])
+        kwargs = dict(destination=str(self.tmp), verbosity=1, tables=('datasets',), tag=['foo'])
+        with self.assertLogs(one_cache.logger, 'WARNING'):
+            self.command.handle(incremental=True, **kwargs)
+        expected = {str(d.pk) for d in (datasets[1], datasets[2], datasets[5])}
+        tag.datasets.add(datasets[5])
+        datasets[1].tags.remove(tag)
+        datasets[2].delete()
+        with mock.patch.object(one_cache, 'update_table',
+                               wraps=one_cache.update_table) as update:
+            self.command.handle(incremental=True, **kwargs)
+            update.assert_called_once()
+        # Only the ids of the modified and deleted datasets are fetched
+        self.assertEqual(update.call_args.args[2], expected)
+        df = pd.read_parquet(self.tmp / 'datasets.pqt')
+        pd.testing.assert_frame_equal(df, one_cache.generate_datasets_frame(tags=['foo']))
+        self.assertCountEqual(df.index.get_level_values('id'),
+                              [str(d.pk) for d in (datasets[0], datasets[3], datasets[5])])
+
+    def test_datasets_record_batch(self):
+        """Test conversion of dataset records to the datasets table"""
+        ids = [uuid.uuid4() for _ in range(4)]
+        records = [
+            (ids[0], 'foo.bar.npy', 1024, 'abc', 'alf', None, True, ids[3], QC.PASS),
+            (ids[1], 'foo.bar.npy', None, None, 'alf/probe00', 'v1', False, ids[3], QC.FAIL),
+            (ids[2], 'bar.baz.bin', 0, 'def', '', '', True, ids[3], QC.NOT_SET),
+        ]
+        batch = one_cache._datasets_record_batch(records, one_cache.datasets_schema())
+        df = batch.to_pandas()
+        self.assertEqual(df.index.names, ['eid', 'id'])
+        self.assertEqual(df.index.get_level_values('id').tolist(), [str(x) for x in ids[:3]])
+        self.assertEqual(set(df.index.get_level_values('eid')), {str(ids[3])})
+        expected = ['alf/foo.bar.npy', 'alf/probe00/#v1#/foo.bar.npy', 'bar.baz.bin']
+        self.assertEqual(df['rel_path'].tolist(), expected)
+        self.assertEqual(df['qc'].tolist(), ['PASS', 'FAIL', 'NOT_SET'])
+        self.assertEqual(df['qc'].dtype, QC_TYPE)
+        self.assertEqual(df['file_size'].tolist(), [1024, pd.NA, 0])
+        self.assertTrue(df['exists'].all())
+
+    def test_compress_tables(self):
+        """Test compressing tables and files straight into the zip file"""
+        self.command.dst_dir = str(self.tmp)
+        self.command.metadata = {'origin': 'test'}
+        table = pa.Table.from_pandas(one_cache.generate_datasets_frame())
+        streamed = self.tmp / 'streamed.pqt'
+        one_cache.write_datasets_table(str(streamed))
+        table_map = {
+            str(self.tmp / 'datasets.pqt'): table,
+            str(self.tmp / 'streamed.pqt'): streamed,
+            str(self.tmp / 'QC.json'): [{'eid': 'foo'}]
+        }
+        zip_file, tag_file = self.command._compress_tables(table_map)
+        self.assertEqual(['cache.zip', 'cache_info.json', 'streamed.pqt'],
+                         sorted(x.name for x in self.tmp.iterdir()))
+        with zipfile.ZipFile(zip_file) as zip:
+            self.assertEqual(['datasets.pqt', 'streamed.pqt', 'QC.json', 'cache_info.json'],
+                             zip.namelist())
+            self.assertEqual(json.loads(zip.read('QC.json')), [{'eid': 'foo'}])
+            datasets = pd.read_parquet(io.BytesIO(zip.read('datasets.pqt')))
+        pd.testing.assert_frame_equal(datasets, table.to_pandas())
+        info = json.loads(tag_file.read_text())
+        self.assertEqual(info['origin'], 'test')
+        self.assertEqual(info['sha256'], hashlib.sha256(zip_file.read_bytes()).hexdigest())
+        for name in ('datasets', 'streamed'):
+            self.assertEqual(info['tables'][name]['nrecs'], 10)
+            self.assertGreater(info['tables'][name]['size'], 0)
+
+    def test_generate_tag_tables(self):
+        """Test generating the tables of several tags at once"""
+        datasets = list(Dataset.objects.order_by('?'))
+        Tag.objects.create(name='foo').datasets.set(datasets[:6])
+        Tag.objects.create(name='bar').datasets.set(datasets[4:])
+        Tag.objects.create(name='baz')
+        tags = ['foo', 'bar', 'baz']
+        # Check per-tag tables
+        with self.assertRaises(CommandError):
+            self.command.handle(destination=str(self.tmp), verbosity=1, tables=('datasets',),
+                                per_tag=True, tag=None)
+        files = self.command.handle(
+            destination=str(self.tmp), verbosity=1, tables=('datasets',), tag=tags,
+            per_tag=True, batch_size=3, compress=False)
+        for tag in tags:
+            filename = self.tmp / tag / 'datasets.pqt'
+            self.assertTrue(filename.exists())
+            df = pd.read_parquet(filename)
+            if tag == 'baz':
+                self.assertTrue(df.empty)
+            else:
+                expected = one_cache.generate_datasets_frame(tags=tag)
+                pd.testing.assert_frame_equal(df.sort_index(), expected)
+            meta = json.loads(pq.read_schema(filename).metadata[b'one_metadata'])
+            self.assertEqual(meta['database_tags'], [tag])
+        # Check compression and QC
+        files = self.command.generate_tag_tables(['foo'], ('datasets',), export_qc=True)
+        self.assertEqual(files, [str(self.tmp / 'foo' / x) for x in ('datasets.pqt', 'QC.json')])
+        self.command.compress = True
+        files = self.command.generate_tag_tables(tags, ('datasets',), export_qc=True)
+        self.assertEqual(self.command.dst_dir, str(self.tmp))
+        for tag in tags:
+            self.assertIn(self.tmp / tag / 'cache.zip', files)
+            with zipfile.ZipFile(self.tmp / tag / 'cache.zip') as zip:
+                expected = ['datasets.pqt', 'QC.json', 'cache_info.json']
+                if tag == 'baz':  # No sessions so no QC
+                    expected.remove('QC.json')
+                self.assertEqual(zip.namelist(), expected)
+                info = json.loads(zip.read('cache_info.json'))
+            self.assertEqual(info['database_tags'], [tag])
+            self.assertEqual(info['tables']['datasets']['nrecs'], {'foo': 6, 'bar': 6}.get(tag, 0))
+
     def test_s3_filesystem(self):
         """Test the _s3_filesystem function"""
         region = 'eu-east-1'
@@ -1,7 +1,10 @@
 from datetime import datetime
 from unittest import mock
 from pathlib import Path
+import base64
+import hashlib
 import json
+import os
 import tempfile
 
 from django.urls import reverse
@@ -9,7 +12,8 @@ from django.contrib.auth import get_user_model
 
 from alyx.base import BaseTests
 from misc.models import LabMembership, Lab
-from misc.views import _get_cache_info
+from misc import views
+from misc.views import _get_cache_info, get_cache_info
 from data.models import Tag
 
 
@@ -82,6 +86,8 @@ class TestCacheView(BaseTests):
         self.superuser = get_user_model().objects.create_user('test', 'test', 'test')
         self.client.login(username='test', password='test')
         self.tag = Tag.objects.create(name='2022_Q1_paper')
+        views._cache_info_docs.clear()
+        views._s3_filesystem.cache_clear()
 
     def test_cache_version_view(self):
         r = self.client.get(reverse('cache-info', args=['TAG_NAME_2021']), follow=True)
@@ -90,9 +96,114 @@ class TestCacheView(BaseTests):
         with mock.patch('misc.views.requests') as req, mock.patch('misc.views.TABLES_ROOT', URL):
             cache_info = {'date_created': '2022-08-10 13:33', 'min_api_version': '1.13.0'}
             req.get().json.return_value = cache_info
+            modified = 'Wed, 10 Aug 2022 13:33:00 GMT'
+            req.head().headers = {'ETag': '"foo"', 'Last-Modified': modified}
             r = self.client.get(reverse('cache-info'), follow=True)
             self.assertEqual(200, r.status_code)
             self.assertEqual(r.json(), cache_info)
+            self.assertEqual(r['Last-Modified'], modified)
+            etag = r['ETag']
+            # Conditional requests should return 304 without fetching the file again
+            req.reset_mock()
+            r = self.client.get(reverse('cache-info'), HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(304, r.status_code)
+            r = self.client.get(reverse('cache-info'), HTTP_IF_MODIFIED_SINCE=modified)
+            self.assertEqual(304, r.status_code)
+            req.head.assert_not_called()
+            req.get.assert_not_called()
+
+    def test_get_cache_info_cached(self):
+        """Test the in-memory cache info cache and its revalidation"""
+        cache_info = {'date_created': '2022-08-10 13:33', 'min_api_version': '1.13.0'}
+        with tempfile.TemporaryDirectory() as URI, mock.patch('misc.views.TABLES_ROOT', URI):
+            (new_path := Path(URI, self.tag.name)).mkdir()
+            with open(new_path / 'cache_info.json', 'w') as fp:
+                json.dump(cache_info, fp)
+            with mock.patch('misc.views._get_cache_info', wraps=_get_cache_info) as get:
+                cached = get_cache_info(self.tag.name)
+                self.assertEqual(cached.cache_info, cache_info)
+                self.assertIsNotNone(cached.last_modified)
+                # Within the TTL the file and tag are not checked
+                with self.assertNumQueries(0), mock.patch('misc.views.os.stat') as stat:
+                    self.assertIs(get_cache_info(self.tag.name), cached)
+                    stat.assert_not_called()
+                # After the TTL the file is only loaded again if modified
+                cached.checked -= views.CACHE_INFO_TTL
+                self.assertIs(get_cache_info(self.tag.name), cached)
+                get.assert_called_once()
+                cached.checked -= views.CACHE_INFO_TTL
+                cache_info['min_api_version'] = '1.14.0'
+                with open(new_path / 'cache_info.json', 'w') as fp:
+                    json.dump(cache_info, fp)
+                os.utime(new_path / 'cache_info.json', ns=(0, 0))
+                new = get_cache_info(self.tag.name)
+                self.assertEqual(new.cache_info, cache_info)
+                self.assertNotEqual(new.etag, cached.etag)
+                self.assertEqual(get.call_count, 2)
+                # Deleted tags are no longer served after the TTL
+                new.checked -= views.CACHE_INFO_TTL
+                self.tag.delete()
+                self.assertRaises(Tag.DoesNotExist, get_cache_info, self.tag.name)
+
+    def test_cache_download_view(self):
+        """Test conditional and range requests for the cache download"""
+        url = reverse('cache-download')
+        data = bytes(range(256)) * 4
+        with tempfile.TemporaryDirectory() as URI, mock.patch('misc.views.TABLES_ROOT', URI):
+            Path(URI, 'cache.zip').write_bytes(data)
+            # The digest is only sent if recorded in the cache info
+            r = self.client.get(url)
+            self.assertEqual(r.status_code, 200)
+            self.assertNotIn('Digest', r)
+            Path(URI, 'cache_info.json').write_text(
+                json.dumps({'sha256': hashlib.sha256(data).hexdigest()}))
+            r = self.client.get(url)
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(b''.join(r.streaming_content), data)
+            self.assertEqual(r['Accept-Ranges'], 'bytes')
+            self.assertEqual(r['Digest'], 'SHA-256=' + base64.b64encode(
+                hashlib.sha256(data).digest()).decode())
+            # The cache info of a previous zip file is ignored
+            os.utime(Path(URI, 'cache_info.json'), ns=(0, 0))
+            self.assertNotIn('Digest', self.client.get(url))
+            etag, modified = r['ETag'], r['Last-Modified']
+            # Conditional requests
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            r = self.client.get(url, HTTP_IF_MODIFIED_SINCE=modified)
+            self.assertEqual(r.status_code, 304)
+            self.assertEqual(r['ETag'], etag)
+            # Range requests
+            ranges = {'bytes=2-5': (2, 5), 'bytes=1000-': (1000, 1023), 'bytes=-4': (1020, 1023),
+                      'bytes=1020-2000': (1020, 1023)}
+            for header, (start, end) in ranges.items():
+                with self.subTest(range=header):
+                    r = self.client.get(url, HTTP_RANGE=header)
+                    self.assertEqual(r.status_code, 206)
+                    self.assertEqual(b''.join(r.streaming_content), data[start:end + 1])
+                    self.assertEqual(r['Content-Range'], f'bytes {start}-{end}/{len(data)}')
+                    self.assertEqual(int(r['Content-Length']), end - start + 1)
+            r = self.client.get(url, HTTP_RANGE='bytes=2000-')
+            self.assertEqual(r.status_code, 416)
+            self.assertEqual(r['Content-Range'], f'bytes */{len(data)}')
+            # Multiple ranges and stale If-Range return the full file
+            for kwargs in ({'HTTP_RANGE': 'bytes=0-1,4-5'},
+                           {'HTTP_RANGE': 'bytes=2-5', 'HTTP_IF_RANGE': '"foo"'}):
+                r = self.client.get(url, **kwargs)
+                self.assertEqual(r.status_code, 200)
+                self.assertEqual(b''.join(r.streaming_content), data)
+            r = self.client.get(url, HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE=etag)
+            self.assertEqual(r.status_code, 206)
+            # Send file by web server
+            with self.settings(CACHE_SENDFILE_HEADER='X-Accel-Redirect',
+                               CACHE_SENDFILE_PREFIX='/protected/tables'):
+                r = self.client.get(url, HTTP_RANGE='bytes=2-5')
+                self.assertEqual(r.status_code, 200)
+                self.assertEqual(r['X-Accel-Redirect'], '/protected/tables/cache.zip')
+                self.assertEqual(r.content, b'')
+                self.assertEqual(r['ETag'], etag)
+            with self.settings(CACHE_SENDFILE_HEADER='X-Sendfile'):
+                r = self.client.get(url)
+                self.assertEqual(r['X-Sendfile'], str(Path(URI, 'cache.zip').absolute()))
 
     def test_get_cache_info(self):
         # First test with local file path
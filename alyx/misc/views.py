@@ -1,14 +1,26 @@
 from pathlib import Path
+import os
 import os.path as op
 import json
+import base64
+import hashlib
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
 
 import urllib.parse
 import requests
 from one.remote.aws import get_s3_virtual_host
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.http import (
-    HttpResponse, FileResponse, JsonResponse, HttpResponseRedirect, HttpResponseNotFound
+    HttpResponse, FileResponse, JsonResponse, HttpResponseRedirect, HttpResponseNotFound,
+    StreamingHttpResponse
 )
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag, parse_etags, parse_http_date_safe
 
 from rest_framework import views
 from rest_framework.response import Response
@@ -155,6 +167,13 @@ class UploadedView(views.APIView):
         return HttpResponse(path)
 
 
+@lru_cache(maxsize=1)
+def _s3_filesystem():
+    """Return an S3 FileSystem object, reused across requests."""
+    from misc.management.commands.one_cache import _s3_filesystem
+    return _s3_filesystem()
+
+
 def _get_cache_info(tag=None):
     """
     Load and return the cache info JSON file. Contains information such as cache table timestamp,
@@ -193,7 +212,6 @@ def _get_cache_info(tag=None):
             cache_info['location'] = cache_root + '/cache.zip'
     elif scheme == 's3':
         # Use PyArrow to read file from s3
-        from misc.management.commands.one_cache import _s3_filesystem
         s3 = _s3_filesystem()
         cache_root = parsed.netloc + '/' + parsed.path.strip('/') + (f'/{tag}' if tag else '')
         file_json_cache = f'{cache_root}/{META_NAME}'
@@ -208,23 +226,223 @@ def _get_cache_info(tag=None):
     return cache_info
 
 
+def _cache_info_version(tag=None):
+    """
+    Return a cheap fingerprint of the cache info JSON file without loading it.
+
+    :param: optional tag name for fetching a specific cache
+    :return: a value that changes when the file changes (None if unknown), and the file's
+     modification time as a POSIX timestamp (None if unknown)
+    """
+    META_NAME = 'cache_info.json'
+    parsed = urllib.parse.urlparse(TABLES_ROOT)
+    scheme = parsed.scheme or 'file'
+    if scheme == 'file':
+        stat = os.stat(Path(TABLES_ROOT).joinpath(tag or '', META_NAME))
+        return (stat.st_mtime_ns, stat.st_size), stat.st_mtime
+    elif scheme.startswith('http'):
+        cache_root = TABLES_ROOT.strip('/') + (f'/{tag}' if tag else '')
+        resp = requests.head(f'{cache_root}/{META_NAME}')
+        resp.raise_for_status()
+        modified = resp.headers.get('Last-Modified')
+        modified = parsedate_to_datetime(modified).timestamp() if modified else None
+        return resp.headers.get('ETag') or modified, modified
+    elif scheme == 's3':
+        cache_root = parsed.netloc + '/' + parsed.path.strip('/') + (f'/{tag}' if tag else '')
+        info = _s3_filesystem().get_file_info(f'{cache_root}/{META_NAME}')
+        return (info.mtime_ns, info.size), info.mtime.timestamp() if info.mtime else None
+    else:
+        raise ValueError(f'Unsupported URI scheme "{scheme}"')
+
+
+class CachedInfo:
+    """A cache info document along with the validators used for conditional requests."""
+
+    def __init__(self, cache_info, version=None, last_modified=None):
+        self.cache_info = cache_info
+        self.version = version
+        self.last_modified = int(last_modified) if last_modified else None
+        digest = hashlib.md5(json.dumps(cache_info, sort_keys=True).encode()).hexdigest()
+        self.etag = quote_etag(digest)
+        self.checked = time.monotonic()
+
+
+_cache_info_docs = {}  # map of (TABLES_ROOT, tag) to CachedInfo
+_cache_info_lock = threading.Lock()
+CACHE_INFO_TTL = 30  # seconds before a cached cache info document is revalidated
+
+
+def get_cache_info(tag=None) -> CachedInfo:
+    """
+    Return the cache info JSON file, cached in memory.
+
+    Once the cached document is older than `CACHE_INFO_TTL`, the file's modification time or
+    ETag is checked and the file is only loaded again if it has changed.  The tag is validated
+    at the same time.
+
+    :param: optional tag name for fetching a specific cache
+    :return: the cached cache info document
+    """
+    key = (TABLES_ROOT, tag)
+    cached = _cache_info_docs.get(key)
+    if cached is not None and time.monotonic() - cached.checked < CACHE_INFO_TTL:
+        return cached
+    # Only one thread revalidates while the others wait for the result
+    with _cache_info_lock:
+        cached = _cache_info_docs.get(key)
+        if cached is not None and time.monotonic() - cached.checked < CACHE_INFO_TTL:
+            return cached
+        if tag:  # Validate
+            Tag.objects.get(name=tag)
+        version, last_modified = _cache_info_version(tag)
+        if cached is not None and version is not None and version == cached.version:
+            cached.checked = time.monotonic()
+        else:
+            cached = CachedInfo(_get_cache_info(tag), version, last_modified)
+            _cache_info_docs[key] = cached
+    return cached
+
+
 class CacheVersionView(views.APIView):
     permission_classes = rest_permission_classes()
 
     def get(self, request=None, tag=None, **kwargs):
         try:
-            return JsonResponse(_get_cache_info(tag))
+            cached = get_cache_info(tag)
         except Tag.DoesNotExist as ex:
             return HttpResponseNotFound(str(ex))
+        response = JsonResponse(cached.cache_info)
+        response['ETag'] = cached.etag
+        if cached.last_modified:
+            response['Last-Modified'] = http_date(cached.last_modified)
+        if request is None:
+            return response
+        # Respond with 304 Not Modified if the client's copy is current
+        return get_conditional_response(
+            request, etag=cached.etag, last_modified=cached.last_modified, response=response)
+
+
+def _cache_digest(cache_file, stat):
+    """
+    Return the base64 encoded SHA-256 digest of the cache zip file.
+
+    The digest is computed by the one_cache command and stored in the cache info file, which is
+    written after the zip file.  None is returned if the cache info predates the zip file.
+
+    :param cache_file: the path of the cache zip file
+    :param stat: the os.stat result of the cache zip file
+    :return: the digest, or None if unknown
+    """
+    info_file = Path(cache_file).with_name('cache_info.json')
+    try:
+        if os.stat(info_file).st_mtime_ns < stat.st_mtime_ns:
+            return
+        with open(info_file, 'r') as fid:
+            digest = json.load(fid).get('sha256')
+    except (OSError, ValueError):
+        return
+    return base64.b64encode(bytes.fromhex(digest)).decode() if digest else None
+
+
+def _parse_range(header, size):
+    """
+    Parse a single byte range of an HTTP Range header.
+
+    :param header: the Range header value, e.g. 'bytes=0-1023'
+    :param size: the size of the file in bytes
+    :return: the first and last byte positions, or None if the header should be ignored
+    :raises ValueError: the range is not satisfiable
+    """
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', (header or '').strip())
+    if not match or match.groups() == ('', ''):
+        return  # Invalid or multiple ranges: respond with the full file
+    start, end = match.groups()
+    if start == '':  # Suffix range, i.e. the last n bytes
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        raise ValueError(f'Range {header} not satisfiable')
+    return start, end
+
+
+def _iter_file(fp, start, length, chunk_size=FileResponse.block_size):
+    """Yield a length of bytes of a file from a start position, then close it."""
+    with fp:
+        fp.seek(start)
+        while length > 0 and (chunk := fp.read(min(chunk_size, length))):
+            length -= len(chunk)
+            yield chunk
 
 
 class CacheDownloadView(views.APIView):
+    """
+    Download the cache tables.
+
+    Supports conditional requests and single byte-range requests.  If the CACHE_SENDFILE_HEADER
+    setting is 'X-Accel-Redirect' (nginx) or 'X-Sendfile' (Apache), the file is sent by the web
+    server instead of the application.  For nginx, CACHE_SENDFILE_PREFIX is the internal
+    location that serves TABLES_ROOT.
+    """
     permission_classes = rest_permission_classes()
 
     def get(self, request=None, **kwargs):
         if TABLES_ROOT.startswith('http'):
-            response = HttpResponseRedirect(TABLES_ROOT.strip('/') + '/cache.zip')
-        else:
-            cache_file = Path(TABLES_ROOT).joinpath('cache.zip')
-            response = FileResponse(open(cache_file, 'br'))
+            return HttpResponseRedirect(TABLES_ROOT.strip('/') + '/cache.zip')
+        cache_file = Path(TABLES_ROOT).joinpath('cache.zip')
+        stat = os.stat(cache_file)
+        etag = quote_etag(f'{stat.st_mtime_ns:x}-{stat.st_size:x}')
+        last_modified = int(stat.st_mtime)
+        headers = {
+            'ETag': etag,
+            'Last-Modified': http_date(last_modified),
+            'Accept-Ranges': 'bytes',
+        }
+        if digest := _cache_digest(cache_file, stat):
+            headers['Digest'] = 'SHA-256=' + digest
+        if request is not None:
+            not_modified = get_conditional_response(
+                request, etag=etag, last_modified=last_modified)
+            if not_modified is not None:  # 304 Not Modified or 412 Precondition Failed
+                for key, value in headers.items():
+                    not_modified.setdefault(key, value)
+                return not_modified
+
+        if sendfile := getattr(settings, 'CACHE_SENDFILE_HEADER', None):
+            # The web server handles the range requests
+            response = HttpResponse(content_type='application/zip', headers=headers)
+            if sendfile == 'X-Accel-Redirect':
+                prefix = getattr(settings, 'CACHE_SENDFILE_PREFIX', '/tables/')
+                response[sendfile] = prefix.rstrip('/') + '/cache.zip'
+            else:
+                response[sendfile] = str(cache_file.absolute())
+            return response
+
+        byte_range = None
+        if request is not None and self._if_range(request, etag, last_modified):
+            try:
+                byte_range = _parse_range(request.META.get('HTTP_RANGE'), stat.st_size)
+            except ValueError:
+                response = HttpResponse(status=416, headers=headers)
+                response['Content-Range'] = f'bytes */{stat.st_size}'
+                return response
+        if byte_range is None:
+            return FileResponse(open(cache_file, 'rb'), headers=headers)
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            _iter_file(open(cache_file, 'rb'), start, end - start + 1),
+            status=206, content_type='application/zip', headers=headers)
+        response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+        response['Content-Length'] = end - start + 1
         return response
+
+    @staticmethod
+    def _if_range(request, etag, last_modified):
+        """Return True if a range request may be honoured, as per the If-Range header."""
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if not if_range:
+            return True
+        elif if_range.startswith(('"', 'W/')):  # Weak ETags do not match
+            return parse_etags(if_range) == [etag]
+        else:
+            return parse_http_date_safe(if_range) == last_modified
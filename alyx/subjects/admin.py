@@ -1,12 +1,13 @@
 from django import forms
 from django_admin_listfilter_dropdown.filters import RelatedDropdownFilter
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
 from django.contrib.auth import get_user_model
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.forms import UserChangeForm
 from django.contrib.auth.models import Group
 from django.core.exceptions import ValidationError
-from django.db.models import Case, When, Count, Prefetch
+from django.db.models import Case, When, Count
 from django.forms import BaseInlineFormSet
 from django.utils.html import format_html
 from django.urls import reverse
@@ -18,8 +19,7 @@ from .models import (Allele, BreedingPair, GenotypeTest, Line, Litter, Sequence,
                      Species, Strain, Subject, SubjectRequest, Zygosity, ZygosityRule,
                      Project,
                      )
-from actions.models import (
-    Surgery, Session, OtherAction, WaterAdministration, WaterRestriction, Weighing)
+from actions.models import Surgery, Session, OtherAction, WaterStatus
 from actions.admin import BaseActionForm
 from misc.models import LabMember, Housing
 from misc.admin import NoteInline
@@ -315,6 +315,16 @@ class SubjectForm(forms.ModelForm):
         return new_ru
 
 
+class SubjectChangeList(ChangeList):
+    def get_results(self, request):
+        super(SubjectChangeList, self).get_results(request)
+        # Load the water status of the subjects of the page at once, the ones that are not
+        # current are recomputed together.
+        statuses = WaterStatus.for_subjects(self.result_list)
+        for subject in self.result_list:
+            subject.water_status = statuses[subject.pk]
+
+
 class SubjectAdmin(BaseAdmin):
     HOUSING_FIELDS = ('housing_l', 'cage_name', 'cage_type', 'light_cycle', 'enrichment',
                       'food', 'cage_mates_l')
@@ -394,20 +404,11 @@ class SubjectAdmin(BaseAdmin):
             'request', 'request__user', 'litter', 'litter__breeding_pair',
             'responsible_user',
             'line', 'lab', 'cull', 'cull__cull_method', 'cull__cull_reason',
-            'species', 'strain', 'source',
+            'species', 'strain', 'source', 'water_status',
         ).prefetch_related(
             'zygosity_set',
             'zygosity_set__allele',
             'line__alleles',
-            Prefetch(
-                'actions_waterrestrictions',
-                queryset=WaterRestriction.objects.order_by('start_time')),
-            Prefetch(
-                'water_administrations',
-                queryset=WaterAdministration.objects.order_by('date_time')),
-            Prefetch(
-                'weighings',
-                queryset=Weighing.objects.order_by('date_time')),
         )
         q = q.annotate(sessions_count=Count('actions_sessions'))
         return q
@@ -421,8 +422,7 @@ class SubjectAdmin(BaseAdmin):
     session_count.short_description = '# sess'
 
     def weight_percent(self, sub):
-        wc = sub.water_control
-        return wc.percentage_weight_html()
+        return WaterStatus.for_subject(sub).percentage_weight_html()
     weight_percent.short_description = 'Weight %'
 
     def ear_mark_(self, obj):
@@ -575,6 +575,12 @@ class SubjectAdmin(BaseAdmin):
 
         return field
 
+    def get_changelist(self, request, **kwargs):
+        # The water status is only loaded for the pages displaying it
+        if 'weight_percent' in self.get_list_display(request):
+            return SubjectChangeList
+        return super(SubjectAdmin, self).get_changelist(request, **kwargs)
+
     def changelist_view(self, request, extra_context=None):
         """Restrict ability to change responsible user on the subjects list view."""
         if self.__class__.__name__ == 'SubjectAdmin':
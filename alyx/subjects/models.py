@@ -199,7 +199,7 @@ class Subject(BaseModel):
     _fields_history = ('nickname', 'responsible_user', 'cage')
     # We track the changes of these fields without saving their history in the JSON.
     _track_field_changes = ('request', 'responsible_user', 'litter', 'genotype_date',
-                            'death_date', 'reduced')
+                            'death_date', 'reduced', 'sex', 'birth_date', 'lab')
 
     class Meta:
         ordering = ['nickname', '-birth_date']
@@ -149,7 +149,7 @@ class SubjectListSerializer(_WaterRestrictionBaseSerializer):
     def setup_eager_loading(queryset):
         """ Perform necessary eager loading of data to avoid horrible performance."""
         queryset = queryset.select_related(
-            'responsible_user', 'species', 'strain', 'line', 'litter')
+            'responsible_user', 'species', 'strain', 'line', 'litter', 'lab')
         queryset = queryset.prefetch_related('zygosity_set', 'zygosity_set__allele')
         return queryset
 
@@ -14,7 +14,7 @@ from django.test.client import RequestFactory
 
 from .admin import mysite
 from subjects.models import Subject
-from actions.models import Cull, CullMethod, WaterRestriction
+from actions.models import Cull, CullMethod, WaterRestriction, WaterStatus
 from misc.models import Lab
 
 logger = logging.getLogger(__file__)
@@ -101,6 +101,29 @@ class ModelAdminTests(TestCase, metaclass=MyTestsMeta):
             self.request.user = user
             self._test_list_change(self.site._registry[cls])
 
+    def test_subject_changelist_water_status(self):
+        ma = self.site._registry[Subject]
+        self.request.user = self.users[0]
+        WaterStatus.objects.all().delete()
+        r = ma.changelist_view(self.request)
+        self.ar(r)
+        subjects = list(r.context_data['cl'].result_list)
+        # The statuses of the page were computed together and are used by the column
+        self.assertEqual(WaterStatus.objects.filter(subject__in=subjects).count(), len(subjects))
+        with self.assertNumQueries(0):
+            for subject in subjects:
+                ma.weight_percent(subject)
+
+    def test_subject_changelist_class(self):
+        from django.contrib.admin.views.main import ChangeList
+        from subjects.admin import SubjectChangeList, SubjectAdverseEffectsAdmin, CullMiceAdmin
+        # Only the pages displaying the water status load it
+        ma = self.site._registry[Subject]
+        self.assertIs(ma.get_changelist(self.request), SubjectChangeList)
+        for ma in self.site._registry.values():
+            if isinstance(ma, (SubjectAdverseEffectsAdmin, CullMiceAdmin)):
+                self.assertIs(ma.get_changelist(self.request), ChangeList)
+
     def test_validation(self):
         # Expect raises when using special characters
         self.assertRaises(ValidationError, Subject.objects.create, nickname='~mango.*')
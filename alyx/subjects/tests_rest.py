@@ -1,7 +1,10 @@
 from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from alyx.base import BaseTests
-from actions.models import WaterAdministration, Weighing
+from actions.models import WaterAdministration, Weighing, WaterRestriction
 from subjects.models import Subject, Project
 from misc.models import Lab
 
@@ -124,3 +127,29 @@ class APISubjectsTests(BaseTests):
         response = self.client.get(url)
         d = self.ar(response)
         self.assertTrue({'nickname', 'expected_water', 'remaining_water'} <= set(d[0]))
+
+    def test_subject_restricted_queries(self):
+        """The water control of the listed subjects is loaded in a fixed number of queries."""
+        url = reverse('water-restricted-subject-list')
+        WaterRestriction.objects.filter(end_time__isnull=True).delete()
+        subjects = Subject.objects.filter(
+            cull__isnull=True, death_date__isnull=True).order_by('nickname')[:6]
+        start = timezone.now() - timezone.timedelta(days=3)
+        n_queries = []
+        for subs in (subjects[:2], subjects[2:]):
+            for sub in subs:
+                Weighing.objects.create(subject=sub, weight=20., date_time=start)
+                WaterAdministration.objects.create(
+                    subject=sub, water_administered=1., date_time=timezone.now())
+                WaterRestriction.objects.create(subject=sub, start_time=start)
+            with CaptureQueriesContext(connection) as ctx:
+                d = self.ar(self.client.get(url))
+            n_queries.append(len(ctx.captured_queries))
+        self.assertEqual(len(d), 6)
+        self.assertEqual(n_queries[0], n_queries[1])
+        # The values should match those computed subject by subject
+        for rec in d:
+            wc = Subject.objects.get(nickname=rec['nickname']).water_control
+            self.assertEqual(rec['reference_weight'], wc.reference_weight())
+            self.assertEqual(rec['expected_water'], wc.expected_water())
+            self.assertAlmostEqual(rec['remaining_water'], wc.remaining_water())
@@ -2,6 +2,7 @@ from rest_framework import generics
 import django_filters
 
 from alyx.base import BaseFilterSet, rest_permission_classes
+from actions.water_control import water_control_bulk
 from .models import Subject, Project
 from .serializers import (SubjectListSerializer,
                           SubjectDetailSerializer,
@@ -44,7 +45,18 @@ class SubjectFilter(BaseFilterSet):
         exclude = []
 
 
-class SubjectList(generics.ListCreateAPIView):
+class WaterControlListMixin:
+    """Load the water control of all the listed subjects in a few queries."""
+
+    def get_serializer(self, *args, **kwargs):
+        if kwargs.get('many') and args:
+            subjects = list(args[0])
+            water_control_bulk(subjects)
+            args = (subjects, *args[1:])
+        return super().get_serializer(*args, **kwargs)
+
+
+class SubjectList(WaterControlListMixin, generics.ListCreateAPIView):
     queryset = Subject.objects.all()
     queryset = SubjectListSerializer.setup_eager_loading(queryset)
     serializer_class = SubjectListSerializer
@@ -73,8 +85,8 @@ class ProjectDetail(generics.RetrieveUpdateDestroyAPIView):
     lookup_field = 'name'
 
 
-class WaterRestrictedSubjectList(generics.ListAPIView):
-    queryset = Subject.objects.all().extra(where=['''
+class WaterRestrictedSubjectList(WaterControlListMixin, generics.ListAPIView):
+    queryset = Subject.objects.select_related('lab').extra(where=['''
         subjects_subject.id IN
         (SELECT subject_id FROM actions_waterrestriction
          WHERE end_time IS NULL)'''])
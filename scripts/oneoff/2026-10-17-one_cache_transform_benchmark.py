@@ -0,0 +1,74 @@
+"""Compare the per-row and Arrow-native datasets table transforms of the one_cache command.
+
+Usage: python 2026-10-17-one_cache_transform_benchmark.py [N_ROWS]
+
+The transform is timed on N_ROWS (default 5,000,000) synthetic dataset records, as returned
+by the database, i.e. excluding the time spent querying.
+"""
+import os
+import sys
+import uuid
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(str(Path(__file__).parents[2].joinpath('alyx')))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'alyx.settings')
+import django  # noqa: E402
+django.setup()
+from one.alf.spec import QC  # noqa: E402
+from one.util import QC_TYPE  # noqa: E402
+from misc.management.commands import one_cache  # noqa: E402
+
+
+def per_row(records):
+    """The original pandas transform of generate_datasets_frame."""
+    fields_map = {'session__id': 'eid', 'default_dataset': 'default_revision'}
+    df = (pd.DataFrame
+          .from_records(records, columns=one_cache.DATASETS_FIELDS)
+          .rename(fields_map, axis=1)
+          .astype({'id': str, 'eid': str, 'file_size': 'UInt64'}))
+    df['exists'] = True
+    revision = map(lambda x: None if not x else f'#{x}#', df.pop('revision__name'))
+    zipped = zip(df.pop('collection'), revision, df.pop('name'))
+    df['rel_path'] = ['/'.join(filter(None, x)) for x in zipped]
+    df = df.set_index(['eid', 'id'])
+    df['qc'] = pd.Categorical([QC(i).name for i in df['qc']], dtype=QC_TYPE)
+    return df
+
+
+def arrow_native(records):
+    """The Arrow-native transform of generate_datasets_frame and write_datasets_table."""
+    return one_cache._datasets_record_batch(records, one_cache.datasets_schema())
+
+
+def synthetic_records(n, seed=0):
+    """Return n records of DATASETS_FIELDS values with a realistic mix of values."""
+    rng = np.random.default_rng(seed)
+    eids = [uuid.UUID(bytes=rng.bytes(16)) for _ in range(max(n // 50, 1))]
+    collections = ['alf', 'alf/probe00', 'raw_ephys_data/probe00', '']
+    revisions = [None, None, None, '2024-01-01']
+    qc = [x.value for x in QC]
+    return [
+        (uuid.UUID(bytes=rng.bytes(16)), f'_ibl_trials.table_{i}.pqt', int(i * 1024), 'f' * 32,
+         collections[i % 4], revisions[i % 4], i % 4 != 3, eids[i % len(eids)], qc[i % len(qc)])
+        for i in range(n)
+    ]
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5_000_000
+    print(f'Generating {n:,} records...')
+    records = synthetic_records(n)
+    t0 = perf_counter()
+    expected = per_row(records)
+    print(f'per-row (DataFrame): {perf_counter() - t0:.2f}s')
+    t0 = perf_counter()
+    batch = arrow_native(records)
+    print(f'Arrow (RecordBatch): {perf_counter() - t0:.2f}s')
+    t0 = perf_counter()
+    actual = batch.to_pandas()
+    print(f' + to DataFrame:     {perf_counter() - t0:.2f}s')
+    pd.testing.assert_frame_equal(actual, expected, check_like=True)